@@ -0,0 +1,1268 @@
+import os
+import sys
+import time
+import random
+import struct
+import tempfile
+import tracemalloc
+import zlib
+import json
+import queue
+import socket
+import threading
+import collections
+import select
+import multiprocessing
+import contextlib
+
+import cantools
+import serial
+
+import mcan
+from mcan import frames, sources, codegen, logs, recorder, mcan_dash, bootloader, firmware, telemetry
+
+import mcan_sim
+
+
+def make_cf(nframes, seed=0):
+    """Generate a buffer in the MCAN wire format with a timestamp frame every 64 frames"""
+    rng = random.Random(seed)
+    parts = []
+    ts = 0
+    for i in range(nframes):
+        if i % 64 == 0:
+            parts.append(struct.pack("<BBHII", 4, 4, 0, 0, (i//64) + 1))
+        length = rng.choice((8, 8, 8, 64))
+        ts = (ts + rng.randrange(50)) & 0xffff
+        parts.append(struct.pack("<BBHI", rng.choice((1, 2, 3)), length | (0x80 if length > 8 else 0), ts, rng.randrange(0x800)))
+        parts.append(bytes(rng.randrange(256) for _ in range(length)))
+    return b"".join(parts)
+
+
+def make_datagrams(nframes, per_datagram):
+    """Split a generated buffer into datagrams of per_datagram frames each"""
+    buf = make_cf(nframes)
+    offsets, end = frames.scan_cf(buf)
+    offsets.append(end)
+    return [buf[offsets[i]:offsets[min(i + per_datagram, len(offsets) - 1)]] for i in range(0, len(offsets) - 1, per_datagram)]
+
+
+def timeit(func, n, repeat=3):
+    """Return the best rate of n items per second over several runs"""
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        if best is None or dt < best: best = dt
+    return n/best
+
+
+def bench_parse(nframes=200000):
+    buf = make_cf(nframes)
+    expected = [p for n, p in sources.read_cf(buf)]
+    got = frames.parse_cf(buf)[0].packets()
+    assert got == expected, "parse_cf does not match read_cf"
+
+    print("Parsing {} frames ({} B)".format(nframes, len(buf)))
+    print("    read_cf:              {:12.0f} frames/s".format(timeit(lambda: list(sources.read_cf(buf)), nframes)))
+    print("    parse_cf (columns):   {:12.0f} frames/s".format(timeit(lambda: frames.parse_cf(buf), nframes)))
+    print("    parse_cf (packets):   {:12.0f} frames/s".format(timeit(lambda: frames.parse_cf(buf)[0].packets(), nframes)))
+
+    datagrams = make_datagrams(nframes, 20)
+    def per_datagram(parse):
+        state = frames.TimestampState()
+        for d in datagrams:
+            parse(d, state)
+    print("Parsing {} datagrams".format(len(datagrams)))
+    print("    read_cf:              {:12.0f} frames/s".format(timeit(lambda: per_datagram(lambda d, s: list(sources.read_cf(d))), nframes)))
+    print("    parse_cf (columns):   {:12.0f} frames/s".format(timeit(lambda: per_datagram(frames.parse_cf), nframes)))
+    print("    parse_cf (packets):   {:12.0f} frames/s".format(timeit(lambda: per_datagram(lambda d, s: frames.parse_cf(d, s)[0].packets()), nframes)))
+
+
+class DashSink:
+    """Stands in for MainWindow so dash_func can be used without a display"""
+    def __init__(self, inst):
+        self.inst = inst
+        self.count = 0
+        inst.main_window = self
+
+    def dash_update(self, packet, target):
+        self.count += 1
+
+
+def legacy_apply(stream, element):
+    """Previous CANStream.apply, walks every branch for every packet"""
+    for b in stream.branches:
+        if b[0]:
+            part = b[1](element)
+            if part is not None: legacy_apply(b[2], part)
+
+
+def make_packets(npackets, seed=0):
+    rng = random.Random(seed)
+    packets = []
+    for i in range(npackets):
+        bus = rng.choice((1, 2, 3, 6))
+        packets.append(frames.CANFrame(bus, rng.randrange(0x900), b"\x00"*8, i, 0))
+    return packets
+
+
+def make_inst(command_server=False):
+    """An MCan with its settings in a temporary directory, without the bootloader command server unless asked for"""
+    return mcan.MCan(tempfile.mkdtemp(), command_server)
+
+
+def setup_streams(m):
+    """Stream setup from mcan_test.py"""
+    win = DashSink(m)
+    m.rxrootstream.filter_range(busses={1,2,3,5}).exec(mcan.MainWindow.dash_func(win, {1: "sensor", 2: "main", 3: "inverter", 5: "control"}))
+    m.rxrootstream.filter_range(min_id=501, max_id=501, busses={1}).exec(mcan.MainWindow.dash_func(win, "SSDB"))
+    return win
+
+
+def bench_stream(npackets=200000):
+    m = make_inst()
+    try:
+        win = setup_streams(m)
+        packets = make_packets(npackets)
+        def run():
+            for p in packets: m.onrecv(p)
+
+        print("MCan.onrecv with the mcan_test.py stream setup, {} packets".format(npackets))
+        root = m.rxrootstream
+        m.rxrootstream = type("LegacyStream", (), {"apply": lambda self, e: legacy_apply(root, e)})()
+        print("    branch walk:          {:12.0f} packets/s".format(timeit(run, npackets)))
+        legacy_count = win.count
+        m.rxrootstream = root
+        win.count = 0
+        print("    dispatch table:       {:12.0f} packets/s".format(timeit(run, npackets)))
+        assert win.count == legacy_count
+    finally:
+        m.boot_manager.close()
+
+
+def bench_batch(nframes=200000, sizes=(5, 20, 48, 80, 200)):
+    m = make_inst()
+    try:
+        win = setup_streams(m)
+        for per_datagram in sizes:
+            datagrams = make_datagrams(nframes, per_datagram)
+            print("Datagram receive path with the mcan_test.py stream setup, {} datagrams of {} frames".format(len(datagrams), per_datagram))
+            def per_packet():
+                for d in datagrams:
+                    for n, p in sources.read_cf(d): m.onrecv(p)
+            print("    read_cf, onrecv:                 {:12.0f} frames/s".format(timeit(per_packet, nframes)))
+            count = win.count
+            win.count = 0
+            def per_list():
+                state = frames.TimestampState()
+                for d in datagrams: m.onrecv_batch(frames.parse_cf(d, state)[0].packets())
+            print("    parse_cf, onrecv_batch (list):   {:12.0f} frames/s".format(timeit(per_list, nframes)))
+            assert win.count == count
+            win.count = 0
+            def per_batch():
+                state = frames.TimestampState()
+                for d in datagrams: m.onrecv_batch(frames.parse_cf(d, state)[0])
+            print("    parse_cf, onrecv_batch (batch):  {:12.0f} frames/s".format(timeit(per_batch, nframes)))
+            assert win.count == count
+            win.count = 0
+            def per_receive():
+                state = frames.TimestampState()
+                for d in datagrams: m.onrecv_batch(frames.parse_cf(d, state, small=frames.SMALL_BATCH)[0])
+            print("    parse_cf small, onrecv_batch:    {:12.0f} frames/s".format(timeit(per_receive, nframes)))
+            assert win.count == count
+            win.count = 0
+    finally:
+        m.boot_manager.close()
+
+
+def bench_decode(dbc="../Formula-DBC/main_dbc.dbc", samples=2000):
+    db = cantools.database.load_file(dbc)
+    decoders = codegen.compile_database(db)
+    print("Compiled {} of {} messages in {}".format(len(decoders), len(db.messages), dbc))
+    errors = codegen.verify_database(db, decoders)
+    for name, data, expected, result in errors[:10]:
+        print("    mismatch in {} for {}: {} != {}".format(name, data.hex(), expected, result))
+    assert not errors, "{} mismatches against cantools".format(len(errors))
+
+    rng = random.Random(0)
+    t_cantools = t_compiled = 0
+    total = 0
+    for message in db.messages:
+        if codegen.database_id(message) not in decoders: continue
+        payloads = []
+        for i in range(samples*500):
+            data = rng.randbytes(message.length)
+            try:
+                message.decode(data)
+            except Exception:
+                # e.g. an unknown multiplexer value, which both decoders reject
+                continue
+            payloads.append(data)
+            if len(payloads) == samples: break
+        func = decoders[codegen.database_id(message)]
+        n = len(payloads)
+        tc = n/timeit(lambda: [message.decode(d) for d in payloads], n)
+        tg = n/timeit(lambda: [func(d) for d in payloads], n)
+        t_cantools += tc
+        t_compiled += tg
+        total += n
+        print("    {:40s} cantools {:10.0f} msg/s, compiled {:10.0f} msg/s".format(message.name, n/tc, n/tg))
+    print("    {:40s} cantools {:10.0f} msg/s, compiled {:10.0f} msg/s".format("all messages", total/t_cantools, total/t_compiled))
+
+
+def make_log(fname, db, nframes, seed=0):
+    """Write a ZCF log with random valid frames of the messages in db"""
+    rng = random.Random(seed)
+    payloads = {}
+    for message in db.messages:
+        payloads[message] = []
+        for i in range(1000):
+            data = rng.randbytes(message.length)
+            try:
+                message.decode(data)
+            except Exception:
+                continue
+            payloads[message].append(data)
+    messages = [m for m in payloads if payloads[m] and not m.is_container]
+    parts = []
+    ts = 0
+    for i in range(nframes):
+        if i % 64 == 0:
+            parts.append(struct.pack("<BBHII", 4, 4, 0, 0, (i//64) + 1))
+        message = rng.choice(messages)
+        data = rng.choice(payloads[message])
+        ts = (ts + rng.randrange(50)) & 0xffff
+        id = message.frame_id | (1<<30) if message.is_extended_frame else message.frame_id
+        parts.append(struct.pack("<BBHI", 2, len(data) | (0x80 if len(data) > 8 else 0), ts, id) + data)
+    with open(fname, "wb") as f:
+        f.write(zlib.compress(b"".join(parts)))
+
+
+def bench_log(dbc="../Formula-DBC/main_dbc.dbc", nframes=500000):
+    db = cantools.database.load_file(dbc)
+    with tempfile.TemporaryDirectory() as d:
+        fname = os.path.join(d, "log.zcf")
+        make_log(fname, db, nframes)
+        print("Decoding a ZCF log with {} frames of {}".format(nframes, dbc))
+        def per_packet():
+            with open(fname, "rb") as f:
+                for n, packet in sources.read_cf(zlib.decompress(f.read())):
+                    try:
+                        db.decode_message(packet["id"], packet["data"], decode_choices=False)
+                    except Exception:
+                        pass
+        print("    read_cf, decode_message:      {:12.0f} frames/s".format(timeit(per_packet, nframes, 1)))
+        print("    load_log:                     {:12.0f} frames/s".format(timeit(lambda: mcan.load_log(fname, {2: db}), nframes, 1)))
+
+
+def bench_zcf(nframes=500000):
+    with tempfile.TemporaryDirectory() as d:
+        fname = os.path.join(d, "log.zcf")
+        buf = make_cf(nframes)
+        with open(fname, "wb") as f:
+            f.write(zlib.compress(buf))
+        expected = frames.parse_cf(buf)[0].packets()
+        del buf
+        for chunk_size in (1000, frames.ZCF_CHUNK_SIZE):
+            with open(fname, "rb") as f:
+                assert [p for b in frames.iter_zcf(f, chunk_size) for p in b] == expected
+        del expected
+
+        print("Reading a ZCF log with {} frames ({} B compressed)".format(nframes, os.path.getsize(fname)))
+        def whole():
+            with open(fname, "rb") as f:
+                return iter(frames.parse_cf(zlib.decompressobj().decompress(f.read()))[0])
+        def streaming():
+            f = open(fname, "rb")
+            return (p for b in frames.iter_zcf(f) for p in b)
+        for name, func in (("whole file", whole), ("streaming", streaming)):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            it = func()
+            next(it)
+            first = time.perf_counter() - t0
+            for p in it: pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("    {:12s} first frame after {:8.2f} ms, peak memory {:8.1f} MB".format(name, first*1000, peak/1e6))
+
+
+def bench_index(nframes=500000):
+    with tempfile.TemporaryDirectory() as d:
+        fname = os.path.join(d, "log.zcf")
+        buf = make_cf(nframes)
+        with open(fname, "wb") as f:
+            f.write(zlib.compress(buf))
+        packets = frames.parse_cf(buf)[0].packets()
+        del buf
+        t0 = time.perf_counter()
+        index = logs.load_index(fname)
+        print("Indexing a ZCF log with {} frames: {:.2f} s, {} points".format(nframes, time.perf_counter() - t0, len(index.points)))
+        target = (index.start + index.end)//2
+        expected = next(p for p in packets if p["ts"] >= target)
+        def linear():
+            with open(fname, "rb") as f:
+                return next(p for b in frames.iter_zcf(f) for p in b if p["ts"] >= target)
+        def indexed(index, fname=fname):
+            reader = logs.LogReader(fname, index=index)
+            try:
+                return next(reader.packets(target))
+            finally:
+                reader.close()
+        assert linear() == expected and indexed(index) == expected
+        # The same frames written by the Recorder, which flushes the compressor at its index points
+        rname = os.path.join(d, "recorded.zcf")
+        r = recorder.Recorder(rname, "zcf", ring_size=1 << 26)
+        for i in range(0, nframes, 5000):
+            for p in packets[i:i+5000]: r.record(p)
+            r.flush()
+        r.close()
+        assert indexed(logs.find_index(rname), rname) == expected
+        print("Seeking to the middle of the log")
+        print("    linear scan:          {:8.2f} ms".format(1000/timeit(linear, 1)))
+        print("    sidecar index:        {:8.2f} ms".format(1000/timeit(lambda: indexed(logs.LogIndex.load(fname + ".idx")), 1)))
+        print("    index with snapshots: {:8.2f} ms".format(1000/timeit(lambda: indexed(index), 1)))
+        print("    Recorder sidecar:     {:8.2f} ms".format(1000/timeit(lambda: indexed(logs.LogIndex.load(rname + ".idx"), rname), 1)))
+        os.remove(fname + ".idx")
+        t0 = time.perf_counter()
+        reader = logs.LogReader(fname)
+        next(reader.packets())
+        print("First frame of a log without sidecar after {:.2f} ms, indexed in the background".format((time.perf_counter() - t0)*1000))
+        reader.builder.join()
+        reader.close()
+
+
+def legacy_log(f, packet):
+    """Previous CANDashboard.dash_update logging"""
+    length = len(packet["data"]) + 8
+    can_head = struct.pack(">I", packet["id"])
+    can_head += struct.pack("<4B", len(packet["data"]), 0x04 if packet["fd"] else 0x00, 0, 0)
+    f.write(struct.pack("<4I", int(packet["ts"]//1000000), int(packet["ts"]%1000000), length, length)+can_head+packet["data"])
+
+
+def bench_record(nframes=200000):
+    packets = frames.parse_cf(make_cf(nframes))[0].packets()
+    with tempfile.TemporaryDirectory() as d:
+        print("Logging {} packets, time spent on the receiving thread".format(nframes))
+        def legacy():
+            with open(os.path.join(d, "legacy.pcap"), "wb") as f:
+                f.write(recorder.PCAP_FILE_HEADER)
+                for p in packets: legacy_log(f, p)
+        print("    inline write:         {:12.0f} packets/s".format(timeit(legacy, nframes)))
+        for format in ("pcap", "zcf"):
+            r = recorder.Recorder(os.path.join(d, "log." + format), format, ring_size=1 << 26)
+            def record():
+                for p in packets: r.record(p)
+            try:
+                print("    Recorder ({}):      {:12.0f} packets/s".format(format, timeit(record, nframes, 1)))
+            finally:
+                r.close()
+            assert r.dropped == 0
+            assert len(logs.read_log(os.path.join(d, "log." + format))) == nframes
+
+
+def bench_dash(npackets=200000):
+    packets = make_packets(npackets)
+    expected = collections.Counter((p["bus"], p["id"]) for p in packets)
+    print("Dashboard hand-off of {} packets to a UI thread that has fallen behind".format(npackets))
+    def legacy():
+        q = queue.Queue()
+        for p in packets: q.put((p, "main"))
+        backlog = q.qsize()
+        try:
+            while True: q.get_nowait()
+        except queue.Empty: pass
+        return backlog
+    def coalesced():
+        store = mcan_dash.FrameStore()
+        for p in packets: store.put(p, "main")
+        backlog = len(store)
+        counts = {(bus, id): e[1] for (target, bus, id), e in store.drain().items()}
+        assert counts == expected
+        return backlog
+    print("    queue.Queue:          {:12.0f} packets/s, backlog {} packets".format(timeit(legacy, npackets), legacy()))
+    print("    FrameStore:           {:12.0f} packets/s, backlog {} IDs".format(timeit(coalesced, npackets), coalesced()))
+
+
+class FakeTree:
+    """Counts the Treeview calls of a CANDashboard"""
+    def __init__(self):
+        self.rows = {}
+        self.updates = 0
+
+    def insert(self, parent, index, iid, text, values):
+        self.rows[iid] = values
+
+    def item(self, iid, values, text=""):
+        self.rows[iid] = values
+        self.updates += 1
+
+    def delete(self, iid):
+        del self.rows[iid]
+
+    def set(self, first, last):
+        pass
+
+
+def make_dbc(fname, nmessages=300, nsignals=8):
+    """Write a DBC with nmessages messages of nsignals byte-sized signals"""
+    messages = []
+    for i in range(nmessages):
+        signals = [cantools.database.can.Signal("S{}_{}".format(i, k), start=8*k, length=8, conversion=cantools.database.conversion.LinearConversion(0.5, 0, False)) for k in range(nsignals)]
+        messages.append(cantools.database.can.Message(0x100 + i, "M{}".format(i), nsignals, signals))
+    cantools.database.dump_file(cantools.database.can.Database(messages), fname)
+
+
+def make_dashboard(m, virtual=False, visible_rows=40):
+    dash = mcan_dash.CANDashboard.__new__(mcan_dash.CANDashboard)
+    dash.dash = FakeTree()
+    dash.vsb = dash.dash
+    dash.virtual = virtual
+    dash.expanded = set()
+    dash.flat = None
+    dash.top = 0
+    dash.visible_rows = visible_rows
+    dash.pool = []
+    dash.dash_elements = []
+    dash.dash_ids = []
+    dash.dash_index = {}
+    dash.dirty = {}
+    dash.rows_updated = 0
+    win = mcan.MainWindow.__new__(mcan.MainWindow)
+    win.inst = m
+    dash.can_decode = win.can_decode
+    return dash
+
+
+def legacy_refresh(dash, el):
+    """Previous CANDashboard.update_element, rewrites every row"""
+    dash.dash.updates += 1
+    if "signals" in el:
+        for l in el["signals"]: legacy_refresh(dash, l)
+    elif el["mux"]:
+        for m in el["value"]: legacy_refresh(dash, el["value"][m])
+
+
+def bench_dashboard(dbc=None, ticks=200, per_tick=5):
+    m = make_inst()
+    try:
+        if dbc is None:
+            with tempfile.TemporaryDirectory() as d:
+                dbc = os.path.join(d, "synthetic.dbc")
+                make_dbc(dbc)
+                m.load_file(2, dbc)
+        else:
+            m.load_file(2, dbc)
+        db = m.can_db[2]
+        rng = random.Random(0)
+        payloads = {}
+        for message in db.messages:
+            if message.is_container: continue
+            for i in range(100):
+                data = rng.randbytes(message.length)
+                try:
+                    message.decode(data)
+                except Exception:
+                    continue
+                payloads.setdefault(message.frame_id, []).append(data)
+        dash = make_dashboard(m)
+        ts = 0
+        for id, p in payloads.items():
+            for data in p:
+                ts += 1
+                dash.dash_update({"bus": 2, "id": id, "data": data, "ts": ts, "fd": 0})
+        dash.update_elements()
+        assert dash.dash_ids == sorted(dash.dash_ids)
+        rows = len(dash.dash.rows)
+        print("Dashboard refresh with {} IDs and {} rows of {}, {} changed IDs per tick".format(len(dash.dash_ids), rows, dbc, per_tick))
+        ids = list(payloads)
+        updates = [[(id, rng.choice(payloads[id])) for id in rng.sample(ids, per_tick)] for i in range(ticks)]
+        def tick(refresh):
+            nonlocal ts
+            dash.dash.updates = 0
+            for u in updates:
+                for id, data in u:
+                    ts += 1
+                    dash.dash_update({"bus": 2, "id": id, "data": data, "ts": ts, "fd": 0})
+                refresh()
+            return dash.dash.updates/ticks
+        def full():
+            dash.dirty = {}
+            for el in dash.dash_elements: legacy_refresh(dash, el)
+        print("    full refresh:         {:8.3f} ms/tick, {:8.1f} rows/tick".format(1000/timeit(lambda: tick(full), ticks), tick(full)))
+        print("    dirty refresh:        {:8.3f} ms/tick, {:8.1f} rows/tick".format(1000/timeit(lambda: tick(dash.update_elements), ticks), tick(dash.update_elements)))
+    finally:
+        m.boot_manager.close()
+
+
+def bench_virtual(sizes=(100, 500, 1500), nsignals=8, scrolls=200):
+    print("Virtual dashboard with {} signals per message, all messages expanded".format(nsignals))
+    for nmessages in sizes:
+        m = make_inst()
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                dbc = os.path.join(d, "synthetic.dbc")
+                make_dbc(dbc, nmessages, nsignals)
+                m.load_file(2, dbc)
+            packets = [{"bus": 2, "id": message.frame_id, "data": bytes(range(nsignals)), "ts": i, "fd": 0} for i, message in enumerate(m.can_db[2].messages)]
+            result = []
+            for virtual in (False, True):
+                dash = make_dashboard(m, virtual)
+                t0 = time.perf_counter()
+                for p in packets: dash.dash_update(p)
+                dash.update_elements()
+                result.append((time.perf_counter() - t0, len(dash.dash.rows)))
+            dash.expanded.update(el["iid"] for el in dash.dash_elements)
+            dash.flat = None
+            dash.render()
+            def scroll():
+                for i in range(scrolls): dash.scroll("scroll", 1, "pages")
+            t_scroll = 1000/timeit(scroll, scrolls)
+            print("    {:5d} messages: startup {:7.1f} ms ({:6d} rows) tree, {:7.1f} ms ({:3d} rows) virtual, scrolling {:6.3f} ms/page".format(
+                nmessages, result[0][0]*1000, result[0][1], result[1][0]*1000, result[1][1], t_scroll))
+        finally:
+            m.boot_manager.close()
+
+
+def bench_runtime(nframes=100000, per_datagram=16, window=32):
+    datagrams = make_datagrams(nframes, per_datagram)
+    expected = frames.parse_cf(b"".join(datagrams))[0].packets()
+    print("UDP loopback ingest of {} datagrams of {} frames".format(len(datagrams), per_datagram))
+    for mode in (False, True):
+        m = make_inst()
+        try:
+            m.setup["options"]["async_sources"] = mode
+            got = []
+            m.rxrootstream.exec_batch(got.extend)
+            m.source(sources.MCAN_Ethernet(m, "127.0.0.1", 40001))
+            m.start_sources()
+            time.sleep(0.2)
+            threads = threading.active_count()
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Send windows of datagrams that fit into the socket's receive buffer and wait for them to be delivered
+            counts = [len(frames.parse_cf(d)[0]) for d in datagrams]
+            t0 = time.perf_counter()
+            sent = 0
+            for i in range(0, len(datagrams), window):
+                for d in datagrams[i:i+window]: s.sendto(d, ("127.0.0.1", 40000))
+                sent += sum(counts[i:i+window])
+                t1 = time.perf_counter()
+                while len(got) < sent and time.perf_counter() - t1 < 0.1:
+                    time.sleep(0.0001)
+            dt = time.perf_counter() - t0
+            s.close()
+            received = [p if isinstance(p, frames.CANFrame) else None for p in got]
+            print("    {:20s}  {:10.0f} frames/s, {} of {} frames in order, {} threads".format(
+                "asyncio runtime:" if mode else "thread per source:", len(got)/dt, sum(a == b for a, b in zip(received, expected)), nframes, threads))
+        finally:
+            m.stop_sources()
+            m.boot_manager.close()
+
+
+def bench_ingest(nframes=200000, duration=3.0, counts=(1, 2, 4)):
+    """Unpaced replays of several logs in the source threads or in worker processes
+
+    The main process CPU time per frame bounds the rate that can be reached
+    with enough cores.
+    """
+    print("Ingest of unpaced replays, {} cores".format(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as d:
+        logs = []
+        for i in range(max(counts)):
+            logs.append(os.path.join(d, "log{}.zcf".format(i)))
+            with open(logs[-1], "wb") as f:
+                f.write(zlib.compress(make_cf(nframes, seed=i)))
+        for n in counts:
+            for processes in (False, True):
+                m = make_inst()
+                try:
+                    m.setup["options"]["ingest_processes"] = processes
+                    for i in range(n):
+                        m.source(sources.Replay(m, logs[i], i + 1, scale=1e-9))
+                    m.start_sources()
+                    # Skip the start of the workers
+                    t0 = time.perf_counter()
+                    while m.total_packets == 0 and time.perf_counter() - t0 < 10: time.sleep(0.01)
+                    count = m.total_packets
+                    t0 = time.perf_counter()
+                    c0 = time.process_time()
+                    time.sleep(duration)
+                    frames_done = m.total_packets - count
+                    rate = frames_done/(time.perf_counter() - t0)
+                    cpu = (time.process_time() - c0)/max(frames_done, 1)
+                finally:
+                    m.stop_sources()
+                    m.boot_manager.close()
+                print("    {} sources, {:9s}: {:12.0f} frames/s, {:6.2f} us CPU per frame in the main process".format(n, "processes" if processes else "threads", rate, cpu*1e6))
+
+
+def make_dict(bus, id, data, ts, fd):
+    """Packet dict as created before CANFrame"""
+    return {"bus": bus, "id": id, "data": data, "ts": ts, "fd": fd}
+
+
+def bench_frame(nframes=200000):
+    """Packet dicts against CANFrame: memory and allocations per frame and the receive path
+
+    The payloads are shared by both representations and not counted.
+    """
+    batch = frames.parse_cf(make_cf(nframes))[0]
+    rows = list(zip(batch.bus.tolist(), batch.id.tolist(), [batch.data(i) for i in range(len(batch))], batch.ts.tolist(), batch.fd.tolist()))
+    decoded = {"signal": 1.0}
+    m = make_inst()
+    try:
+        setup_streams(m)
+        print("Frame representation, {} frames (onrecv converts packet dicts to CANFrames)".format(nframes))
+        for name, make in (("dict", make_dict), ("CANFrame", frames.CANFrame)):
+            tracemalloc.start()
+            blocks = sys.getallocatedblocks()
+            packets = [make(*r) for r in rows]
+            size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(packets)
+            blocks = sys.getallocatedblocks() - blocks - 1
+            for p in packets:
+                p["message"] = None
+                p["decoded"] = decoded
+            decoded_size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(packets)
+            tracemalloc.stop()
+            create = timeit(lambda: [make(*r) for r in rows], nframes)
+            def run():
+                for p in packets: m.onrecv(p)
+            print("    {:8s}: {:5.0f} B, {:4.2f} allocations per frame, {:5.0f} B decoded, {:10.0f} frames/s created, {:10.0f} frames/s onrecv".format(
+                name, size/nframes, blocks/nframes, decoded_size/nframes, create, timeit(run, nframes)))
+            del packets
+    finally:
+        m.boot_manager.close()
+
+
+def send_datagrams(datagrams, port, rate, duration, sent):
+    """Stand-in for the logger: send datagrams to port at rate bytes/s, in bursts every millisecond"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    t0 = time.perf_counter()
+    n = nbytes = 0
+    while True:
+        t = time.perf_counter() - t0
+        if t >= duration: break
+        while nbytes < rate*t:
+            d = datagrams[n % len(datagrams)]
+            try:
+                s.sendto(d, ("127.0.0.1", port))
+            except OSError:
+                pass
+            n += 1
+            nbytes += len(d)
+        time.sleep(0.001)
+    sent.value = n
+    s.close()
+
+
+def legacy_receive(sock, sink, stop):
+    """Previous MCAN_Ethernet receive loop"""
+    ts_state = frames.TimestampState()
+    frame = b""
+    while not stop.is_set():
+        if not select.select([sock], [], [], 0.05)[0]: continue
+        frame += sock.recv(1500)
+        batch, i = frames.parse_cf(frame, ts_state)
+        sink(batch)
+        frame = frame[i:]
+
+
+def buffered_receive(sock, sink, stop):
+    receiver = sources.CFReceiver()
+    while not stop.is_set():
+        if not select.select([sock], [], [], 0.05)[0]: continue
+        receiver.receive(sock, True)
+        batch = receiver.parse()
+        if len(batch): sink(batch)
+
+
+def make_mtu_datagrams(nframes, size=1472):
+    """Pack generated frames into datagrams of up to size bytes, without timestamp frames so they can be sent in a loop"""
+    buf = make_cf(nframes)
+    datagrams = [b""]
+    for o in frames.scan_cf(buf)[0]:
+        if buf[o] == frames.CF_TIMESTAMP_BUS: continue
+        frame = buf[o:o+frames.CF_HEADER_SIZE+(buf[o+1] & 0x7f)]
+        if len(datagrams[-1]) + len(frame) > size: datagrams.append(b"")
+        datagrams[-1] += frame
+    return datagrams
+
+
+def bench_receive(duration=2.0, rates=(12.5e6, 125e6)):
+    """UDP receive path against a sender process pacing datagrams at 100 Mbit/s and 1 Gbit/s
+
+    The CPU time of this process per received frame is the cost of the
+    receive loop, the sender runs in its own process.
+    """
+    datagrams = make_mtu_datagrams(20000)
+    counts = [len(frames.parse_cf(d)[0]) for d in datagrams]
+    context = multiprocessing.get_context("fork")
+    print("UDP receive of datagrams with {} frames ({} B) on average, {} cores".format(sum(counts)//len(counts), sum(map(len, datagrams))//len(datagrams), os.cpu_count()))
+    for rate in rates:
+        for name, loop in (("recv, concatenate", legacy_receive), ("recv_into buffer", buffered_receive)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sources.RECV_SOCKET_BUFFER)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(0)
+            received = [0]
+            def sink(batch):
+                received[0] += len(batch)
+            stop = threading.Event()
+            thread = threading.Thread(target=loop, args=(sock, sink, stop))
+            thread.start()
+            sent = context.Value("q", 0)
+            sender = context.Process(target=send_datagrams, args=(datagrams, sock.getsockname()[1], rate, duration, sent))
+            t0 = time.perf_counter()
+            c0 = time.process_time()
+            sender.start()
+            sender.join()
+            # Let the receiver empty the socket buffer
+            time.sleep(0.2)
+            dt = time.perf_counter() - t0
+            cpu = time.process_time() - c0
+            stop.set()
+            thread.join()
+            sock.close()
+            offered = sum(counts[i % len(counts)] for i in range(sent.value))
+            print("    {:5.0f} Mbit/s offered, {:18s}: {:10.0f} frames/s, {:5.1f}% lost, {:5.2f} us CPU per frame".format(
+                rate*8/1e6, name, received[0]/dt, 100*(1 - received[0]/max(offered, 1)), cpu*1e6/max(received[0], 1)))
+
+
+def legacy_transmit(eth, packet):
+    """Previous MCAN_Ethernet.transmit, one datagram per frame"""
+    eth.send(struct.pack("<BBHI", packet["bus"], (0x80 if packet["fd"] else 0) | (len(packet["data"])), 0, packet["id"])+packet["data"])
+
+
+def record_sends(eth):
+    """Replace the send of eth's transmit queue, returns the list of (time, datagram) it fills"""
+    sent = []
+    send = eth.tx.send
+    def record(datagram):
+        sent.append((time.perf_counter(), datagram))
+        send(datagram)
+    eth.tx.send = record
+    return sent
+
+
+def wait_sent(eth, timeout=30):
+    t = time.perf_counter()
+    while eth.tx.depth and time.perf_counter() - t < timeout: time.sleep(0.001)
+
+
+def bench_transmit(nframes=20000, rate=5000, backlog=5000):
+    """Transmit path to a loopback receiver: datagrams and CPU per frame, the
+    per-bus rate limit and the latency of a command queued behind bulk traffic"""
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    port = rx.getsockname()[1]
+    packets = make_packets(nframes)
+    print("Transmit of {} frames".format(nframes))
+    for name, queued in (("datagram per frame", False), ("transmit queue", True)):
+        eth = sources.MCAN_Ethernet(None, "127.0.0.1", port)
+        sent = record_sends(eth)
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        for p in packets:
+            if queued: eth.transmit(p)
+            else: legacy_transmit(eth, p)
+        wait_sent(eth)
+        dt = time.perf_counter() - t0
+        cpu = time.process_time() - c0
+        eth.stop()
+        datagrams = len(sent) if queued else nframes
+        print("    {:20s}: {:6d} datagrams, {:5.1f} frames per datagram, {:8.0f} frames/s, {:5.2f} us CPU per frame".format(
+            name, datagrams, nframes/datagrams, nframes/dt, cpu*1e6/nframes))
+
+    # Bus 1 limited to rate, bus 2 unlimited
+    eth = sources.MCAN_Ethernet(None, "127.0.0.1", port, tx_rate={"1": rate})
+    sent = record_sends(eth)
+    t0 = time.perf_counter()
+    for i in range(backlog):
+        eth.transmit(frames.CANFrame(1, i, b"\x00"*8))
+        eth.transmit(frames.CANFrame(2, i, b"\x00"*8))
+    wait_sent(eth)
+    eth.stop()
+    done = {}
+    for t, d in sent:
+        for bus in frames.parse_cf(d)[0].bus: done[int(bus)] = t - t0
+    print("    {} frames each on bus 1 limited to {} frames/s and unlimited bus 2: bus 1 at {:.0f} frames/s, bus 2 done after {:.1f} ms".format(
+        backlog, rate, backlog/done[1], 1000*done[2]))
+
+    # A command behind a backlog of flash writes on the same rate limited bus
+    for name, priority in (("normal priority", sources.TX_PRIORITY_NORMAL), ("high priority", sources.TX_PRIORITY_HIGH)):
+        eth = sources.MCAN_Ethernet(None, "127.0.0.1", port, tx_rate={1: rate})
+        sent = record_sends(eth)
+        for i in range(backlog):
+            eth.transmit(frames.CANFrame(1, i % 0x700, b"\x00"*64, fd=True))
+        time.sleep(0.05)
+        command = frames.CANFrame(1, 0x7ff, b"\x55"*8)
+        command["priority"] = priority
+        t0 = time.perf_counter()
+        eth.transmit(command)
+        wait_sent(eth)
+        eth.stop()
+        latency = next(t for t, d in sent if 0x7ff in frames.parse_cf(d)[0].id) - t0
+        print("    command behind {} frames at {} frames/s, {:15s}: {:8.2f} ms".format(backlog, rate, name, 1000*latency))
+
+    # Frames one at a time on an idle queue, before and after the source is stopped and started again
+    eth = sources.MCAN_Ethernet(None, "127.0.0.1", port)
+    sent = record_sends(eth)
+    latencies = []
+    for i in range(200):
+        if i == 100:
+            eth.stop()
+            eth.tx.start()
+        t0 = time.perf_counter()
+        eth.transmit(frames.CANFrame(2, i, b"\x00"*8))
+        while len(sent) <= i and time.perf_counter() - t0 < 1: time.sleep(0)
+        latencies.append(sent[-1][0] - t0)
+        time.sleep(0.002)
+    eth.stop()
+    print("    single frames on an idle queue: {} of 200 sent, {:.3f} ms on average, {:.3f} ms at most".format(
+        len(sent), 1000*sum(latencies)/len(latencies), 1000*max(latencies)))
+    rx.close()
+
+
+def write_ihex(fname, image, address=0x08000000):
+    with open(fname, "w") as f:
+        for o in range(0, len(image), 16):
+            a = address + o
+            if o == 0 or (a & 0xffff) == 0:
+                record = bytes([2, 0, 0, 4]) + struct.pack(">H", a >> 16)
+                f.write(":{}{:02X}\n".format(record.hex().upper(), -sum(record) & 0xff))
+            record = bytes([len(image[o:o+16])]) + struct.pack(">H", a & 0xffff) + b"\x00" + image[o:o+16]
+            f.write(":{}{:02X}\n".format(record.hex().upper(), -sum(record) & 0xff))
+        f.write(":00000001FF\n")
+
+
+def make_ihex(fname, nbytes, seed=0):
+    """Write an IHEX file of nbytes random bytes at the start of FLASH, returns the bytes"""
+    rng = random.Random(seed)
+    image = bytes(rng.randrange(256) for i in range(nbytes))
+    write_ihex(fname, image)
+    return image
+
+
+@contextlib.contextmanager
+def simulated_boards(m, targets):
+    """Run simulated targets as sources of m and make their boards known to the boot manager
+
+    Afterwards the boards, their settings and page hashes are as they were
+    before, so the next targets of m start from the same state.
+    """
+    bm = m.boot_manager
+    added = [b for t in targets for b in t.flash if b not in bm.boards]
+    configs = {b: dict(bm.boards[b]["config"]) for b in bm.boards}
+    hashes = dict(bm.page_hashes)
+    for t in targets:
+        m.source(t)
+        m.txrootstream.exec(t.transmit)
+    m.start_sources()
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            for t in targets:
+                for b in t.flash: bm.send_command(t.bus, b, b"\x00")
+            t = time.time()
+            while any("last_packet" not in bm.boards.get(b, {}) for t in targets for b in t.flash) and time.time() - t < 5: time.sleep(0.01)
+        yield [b for t in targets for b in t.flash]
+    finally:
+        m.stop_sources()
+        for b in configs: bm.boards[b]["config"] = configs[b]
+        for b in added: bm.boards.pop(b, None)
+        bm.page_hashes = hashes
+        bm.save_page_hashes()
+
+
+def wait_operations(bm, boards, timeout=120):
+    t = time.time()
+    while any(bm.boards[b]["op_generator"] is not None for b in boards) and time.time() - t < timeout: time.sleep(0.01)
+
+
+def flash_image(m, fname, window=None, delta=False, board=1):
+    """Write fname into the other bank of a simulated board, returns the time taken or None if the operation failed"""
+    bm = m.boot_manager
+    errors = []
+    bm.on_error = errors.append
+    t = time.time()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        bm.start_operation(board, bm.write_and_verify_from_file_gen(board, fname, window, delta))
+        wait_operations(bm, [board])
+    return None if errors else time.time() - t
+
+
+def bench_flash(nbytes=32768, windows=(1, 4, 16, 32), latency=0.002):
+    """Programming a simulated bootloader with 2 ms round trip and 0.4 ms per write on the target"""
+    fname = os.path.join(tempfile.mkdtemp(), "image.hex")
+    image = make_ihex(fname, nbytes)
+    for loss in (0, 0.01):
+        m = make_inst()
+        try:
+            target = mcan_sim.SimulatedTarget(m, latency=latency, loss=loss, corrupt=loss)
+            with simulated_boards(m, [target]):
+                print("{} bytes, {:.0f}% of the frames lost and of the read-backs corrupted".format(nbytes, 100*loss))
+                for window in windows:
+                    target.bank(1)[:] = b"\xff"*len(target.bank(1))
+                    dt = flash_image(m, fname, window)
+                    ok = target.bank(1)[:nbytes] == image
+                    print("    window {:3d}: {}, image {}".format(window, "failed" if dt is None else "{:8.0f} B/s".format(nbytes/dt), "verified" if ok else "incorrect"))
+        finally:
+            m.boot_manager.close()
+
+
+def bench_program_all(nbytes=16384, latency=0.002):
+    """Four simulated boards on two busses, programmed one after another and with program_all"""
+    fname = os.path.join(tempfile.mkdtemp(), "image.hex")
+    image = make_ihex(fname, nbytes)
+    m = make_inst()
+    bm = m.boot_manager
+    try:
+        targets = [mcan_sim.SimulatedTarget(m, boards=(1, 2), bus=1, latency=latency), mcan_sim.SimulatedTarget(m, boards=(3, 4), bus=2, latency=latency)]
+        with simulated_boards(m, targets) as boards:
+            # Only the simulated boards are programmed
+            for b in bm.boards: bm.boards[b]["config"]["program"] = fname if b in boards else ""
+            print("{} boards on {} busses, {} bytes each".format(len(boards), len(targets), nbytes))
+            t0 = time.time()
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                for b in boards:
+                    bm.program(b)
+                    wait_operations(bm, [b])
+            print("    one after another: {:6.2f} s".format(time.time() - t0))
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                bm.program_all()
+                wait_operations(bm, boards)
+            print("    program_all:       {:6.2f} s".format(bm.last_batch["time"]))
+            for t in targets:
+                for b in t.flash:
+                    # The programmed bank is running after the bank swap
+                    print("        board {} (bus {}): {}, {:6.0f} B/s, image {}".format(b, t.bus, bm.boards[b]["status"], bm.boards[b]["write_rate"],
+                          "verified" if t.bank(b, 0)[:nbytes] == image else "incorrect"))
+    finally:
+        bm.close()
+
+
+def bench_delta(nbytes=131072, changes=4, size=200, latency=0.002):
+    """Reprogramming a simulated board after changes of a few places in the image"""
+    d = tempfile.mkdtemp()
+    old = make_ihex(os.path.join(d, "old.hex"), nbytes)
+    rng = random.Random(1)
+    new = bytearray(old)
+    for i in range(changes):
+        o = rng.randrange(nbytes - size)
+        new[o:o+size] = bytes(rng.randrange(256) for i in range(size))
+    write_ihex(os.path.join(d, "new.hex"), new)
+    m = make_inst()
+    bm = m.boot_manager
+    try:
+        target = mcan_sim.SimulatedTarget(m, latency=latency)
+        with simulated_boards(m, [target]):
+            print("{} bytes with {} changes of {} bytes".format(nbytes, changes, size))
+            for name, delta, known in (("full", False, True), ("delta, hashes", True, True), ("delta, no hashes", True, False)):
+                flash_image(m, os.path.join(d, "old.hex"))
+                if not known: bm.page_hashes.clear()
+                dt = flash_image(m, os.path.join(d, "new.hex"), delta=delta)
+                print("    {:16s}: {:6.2f} s, image {}".format(name, dt, "verified" if target.bank(1)[:nbytes] == new else "incorrect"))
+    finally:
+        bm.close()
+
+
+def legacy_read_ihex(fname):
+    """Previous IHEX parsing of write_and_verify_from_file_gen, returns the doublewords"""
+    base_address = 0
+    dwords = {}
+    with open(fname) as f:
+        for record in f:
+            length = int(record[1:3], 16)
+            if record[7:9] == "02":
+                base_address = 16*int(record[9:13], 16)
+            elif record[7:9] == "04":
+                base_address = int(record[9:13], 16)<<16
+            elif record[7:9] == "00":
+                address = base_address + int(record[3:7], 16)
+                for i in range(length):
+                    if (address & 0xfffffff8) not in dwords:
+                        dwords[(address & 0xfffffff8)] = bytearray([255]*8)
+                    dwords[(address & 0xfffffff8)][address & 0x07] = int(record[9+2*i:11+2*i], 16)
+                    address += 1
+    return [dwords[a] for a in sorted(dwords)]
+
+
+def bench_firmware(nbytes=262144):
+    """Time until the chunks of an image are ready: previous parsing, parsing and a cached load"""
+    fname = os.path.join(tempfile.mkdtemp(), "image.hex")
+    make_ihex(fname, nbytes)
+    with open(fname, "rb") as f:
+        raw = f.read()
+    print("{} byte image, {} bytes of IHEX".format(nbytes, len(raw)))
+    for name, func in (("previous parser", lambda: legacy_read_ihex(fname)), ("parse_image", lambda: firmware.parse_image(raw, fname)),
+                       ("load_image, cached", lambda: firmware.load_image(fname))):
+        firmware.load_image(fname)
+        t = time.perf_counter()
+        for i in range(5): func()
+        print("    {:20s}: {:8.2f} ms".format(name, (time.perf_counter() - t)*1000/5))
+
+
+def legacy_timeouts(timeouts, event):
+    """Previous BootManager.check_timeouts"""
+    while True:
+        t = time.time()
+        tv = list(timeouts.keys())
+        for x in tv:
+            if t >= timeouts[x][0]:
+                func = timeouts[x][1]
+                del timeouts[x]
+                func(x)
+        if event.wait(0.1): break
+
+
+def bench_timers(ntimers=200, loss=0.2, ops=50, stale=0.3):
+    """Lateness of timeouts, and bootloader operations over a simulated bus that loses frames or answers late"""
+    rng = random.Random(0)
+    delays = [rng.uniform(0.001, 0.05) for i in range(ntimers)]
+    late = []
+    timeouts = {}
+    event = threading.Event()
+    thread = threading.Thread(target=legacy_timeouts, args=(timeouts, event))
+    thread.start()
+    for i, d in enumerate(delays):
+        due = time.time() + d
+        timeouts[i] = (due, lambda x, due=due: late.append(time.time() - due))
+    time.sleep(0.3)
+    event.set()
+    thread.join()
+    print("Lateness of {} timeouts of 1-50 ms".format(ntimers))
+    print("    polling every 100 ms: {:6.2f} ms on average, {:6.2f} ms at most".format(1000*sum(late)/len(late), 1000*max(late)))
+    late = []
+    timers = bootloader.Timers()
+    for i, d in enumerate(delays):
+        due = time.monotonic() + d
+        timers.schedule(i, d, lambda x, due=due: late.append(time.monotonic() - due))
+    time.sleep(0.1)
+    timers.close()
+    print("    Timers:               {:6.2f} ms on average, {:6.2f} ms at most".format(1000*sum(late)/len(late), 1000*max(late)))
+
+    for kind, options in (("{:.0f}% of the frames lost".format(100*loss), {"loss": loss}), ("{:.0f}% of the responses late".format(100*stale), {"late": stale})):
+        m = make_inst()
+        bm = m.boot_manager
+        try:
+            target = mcan_sim.SimulatedTarget(m, **options)
+            names = (b"FIRST", b"SECOND")
+            for bank, name in enumerate(names):
+                target.flash[1][bank][0x3ffe0:0x3ffe0+len(name)] = name
+            with simulated_boards(m, [target]):
+                results = collections.Counter()
+                t0 = time.time()
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    for i in range(ops):
+                        bm.start_operation(1, bm.read_bank_identifiers_gen(1))
+                        wait_operations(bm, [1], timeout=5)
+                        if bm.boards[1]["op_generator"] is not None:
+                            results["stalled"] += 1
+                        elif bm.boards[1]["status"] == "done" and tuple(bm.boards[1][k].rstrip(b"\xff") for k in ("bank1", "bank2")) != names:
+                            results["wrong"] += 1
+                        else:
+                            results[bm.boards[1]["status"]] += 1
+                print("{} bank identifier reads with {}: {}, {:.1f} ms each".format(
+                    ops, kind, ", ".join("{} {}".format(n, s) for s, n in results.items()), 1000*(time.time() - t0)/ops))
+        finally:
+            bm.close()
+
+def bench_server(nclients=50, ncommands=100):
+    """Bootloader command server: status commands pipelined by many clients at once, served on one thread"""
+    m = make_inst(command_server=True)
+    bm = m.boot_manager
+    try:
+        target = mcan_sim.SimulatedTarget(m, boards=(1, 2, 3, 4))
+        with simulated_boards(m, [target]):
+            clients = [socket.create_connection(("127.0.0.1", bootloader.SERVER_PORT)) for i in range(nclients)]
+            t0 = time.perf_counter()
+            for c in clients: c.sendall(b"status\n"*ncommands)
+            replies = 0
+            for c in clients:
+                f = c.makefile("rb")
+                for i in range(ncommands):
+                    json.loads(f.readline())
+                    replies += 1
+            dt = time.perf_counter() - t0
+            for c in clients: c.close()
+            print("{} clients, {} status commands each: {:.0f} commands/s, {} server threads".format(nclients, ncommands, replies/dt, 1))
+    finally:
+        bm.close()
+
+
+def make_telemetry(nframes, nids=40, seed=0):
+    """Generate car traffic: every id has a counter, slowly changing 16 bit signals and constant status bytes"""
+    rng = random.Random(seed)
+    ids = [(rng.choice((1, 2, 3)), 0x100 + 8*i, rng.choice((10, 10, 20, 100))) for i in range(nids)]
+    values = {id: [rng.randrange(1000, 30000) for k in range(3)] for bus, id, period in ids}
+    packets = []
+    t = 0
+    while len(packets) < nframes:
+        for bus, id, period in ids:
+            if t % period: continue
+            v = values[id]
+            for k in range(3): v[k] = min(max(v[k] + rng.randrange(-20, 21), 0), 0xffff)
+            packets.append(frames.CANFrame(bus, id, struct.pack("<BHHHB", (t//period) & 0xff, *v, 0x11), t, 0))
+        t += 1
+    return packets[:nframes]
+
+
+def legacy_lora_packets(packets, max_size=240):
+    """Previous logger format: 8 byte headers, as many frames as fit a zlib compressed packet"""
+    out = []
+    i = 0
+    while i < len(packets):
+        parts = []
+        data = b""
+        for p in packets[i:]:
+            parts.append(struct.pack("<BBHHH", p.bus, len(p.data), p.ts & 0xffff, p.id, p.ts >> 16) + p.data)
+            candidate = zlib.compress(b"".join(parts), 9)
+            if len(candidate) > max_size: break
+            data = candidate
+        n = max(len(parts) - 1 if len(candidate) > max_size else len(parts), 1)
+        out.append((n, data))
+        i += n
+    return out
+
+
+def legacy_parse_lora(data):
+    """Previous LoRATelemetry.run parsing"""
+    i = 0
+    batch = []
+    while i < len(data):
+        bus, length, tsl, id, tsh = struct.unpack("<BBHHH", data[i:i+8])
+        batch.append(frames.CANFrame(bus, id, data[i+8:i+8+(length&0x7f)], tsl | (tsh << 16), length>>7))
+        i += (length & 0x7f)+8
+    return batch
+
+
+def bench_telemetry(nframes=20000):
+    """Frames per LoRa packet for the previous format and the telemetry codec, and decoding speed"""
+    packets = make_telemetry(nframes)
+    zdict = telemetry.build_zdict(make_telemetry(5000, seed=1))
+    airtime = telemetry.lora_airtime(telemetry.LORA_MAX_PAYLOAD)
+    print("{} frames of {} ids, a {} byte packet every {:.1f} ms".format(nframes, len({p.id for p in packets}), telemetry.LORA_MAX_PAYLOAD, 1250*airtime))
+    legacy = legacy_lora_packets(packets)
+    print("    previous format:          {:6.1f} frames/packet, {:6.0f} frames/s".format(nframes/len(legacy), nframes/len(legacy)/(1.25*airtime)))
+    for name, kwargs in (("codec, no delta", {"key_interval": 1}), ("codec", {}), ("codec, preset dictionary", {"zdict": zdict})):
+        encoder = telemetry.TelemetryEncoder(**kwargs)
+        decoder = telemetry.TelemetryDecoder(kwargs.get("zdict"))
+        # Keep one more frame queued than fit into the last packet, so packets are full but few frames are replaced
+        encoded = []
+        for p in packets:
+            encoder.put(p)
+            if encoder.backlog() > encoder.hint: encoded.append(encoder.packet())
+        while encoder.backlog(): encoded.append(encoder.packet())
+        sent = encoder.stats["sent"]
+        t = time.perf_counter()
+        received = sum(len(decoder.decode(p)) for p in encoded)
+        dt = time.perf_counter() - t
+        assert received == sent
+        print("    {:25s} {:6.1f} frames/packet, {:6.0f} frames/s, {:5.0f} kframes/s decoded".format(name + ":", sent/len(encoded), sent/len(encoded)/(1.25*airtime), sent/dt/1000))
+    old = [zlib.decompress(d) for n, d in legacy]
+    print("Decoding previous format packets")
+    print("    struct.unpack per frame:  {:10.0f} frames/s".format(timeit(lambda: [legacy_parse_lora(d) for d in old], nframes)))
+    print("    parse_lora:               {:10.0f} frames/s".format(timeit(lambda: [telemetry.parse_lora(d) for d in old], nframes)))
+
+
+class LegacyLoRA(sources.LoRATelemetry):
+    """LoRATelemetry with the previous readline based receive loop"""
+    def start(self):
+        self.s = serial.Serial(self.port, 115200)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            l = self.s.readline()
+            if l.startswith(b"+RCV"):
+                ch, length, data = l.split(b",", 2)
+                length = int(length)
+                while len(data) <= length:
+                    data += self.s.readline()
+                self.receive(int(ch[5:]), data.rsplit(b",", 2)[0])
+
+
+class LoRASink:
+    """Stands in for MCan, records when frames arrive"""
+    def __init__(self):
+        self.arrivals = []
+
+    def onrecv_batch(self, batch):
+        self.arrivals.append(time.perf_counter())
+
+
+def bench_lora(npackets=200, gap=0.005):
+    """Receiving from a fake RYLR radio on a pty: latency and CPU time per packet, and a burst of packets"""
+    packets = make_telemetry(npackets*40)
+    encoder = telemetry.TelemetryEncoder()
+    encoded = []
+    for p in packets:
+        encoder.put(p)
+        if encoder.backlog() > encoder.hint: encoded.append(encoder.packet())
+    encoded = encoded[:npackets]
+    print("{} packets of {:.0f} bytes on average".format(len(encoded), sum(map(len, encoded))/len(encoded)))
+    for name, cls in (("readline", LegacyLoRA), ("ATParser", sources.LoRATelemetry)):
+        radio = telemetry.FakeRadio()
+        radio.start()
+        sink = LoRASink()
+        source = cls(sink, radio.port)
+        source.start()
+        time.sleep(0.1)
+        sent = []
+        cpu = time.process_time()
+        for p in encoded:
+            sent.append(time.perf_counter())
+            radio.receive(telemetry.LORA_SENDER_ADDRESS, p)
+            time.sleep(gap)
+        time.sleep(0.1)
+        cpu = time.process_time() - cpu
+        latency = [a - s for a, s in zip(sink.arrivals, sent)]
+        received = len(sink.arrivals)
+        t = time.perf_counter()
+        for p in encoded: radio.receive(telemetry.LORA_SENDER_ADDRESS, p)
+        while len(sink.arrivals) < received + len(encoded) and time.perf_counter() - t < 10: time.sleep(0.001)
+        burst = time.perf_counter() - t
+        source.running = False
+        # The previous loop blocks in readline until a line arrives
+        radio.write(b"+OK\r\n")
+        source.stop()
+        radio.stop()
+        print("    {:9s}: {:6.3f} ms latency, {:6.3f} ms CPU per packet, burst of {} packets in {:6.1f} ms".format(
+            name, 1000*sum(latency)/len(latency), 1000*cpu/len(encoded), len(encoded), 1000*burst))
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "stream": bench_stream,
+    "batch": bench_batch,
+    "decode": bench_decode,
+    "log": bench_log,
+    "zcf": bench_zcf,
+    "index": bench_index,
+    "record": bench_record,
+    "dash": bench_dash,
+    "dashboard": bench_dashboard,
+    "virtual": bench_virtual,
+    "runtime": bench_runtime,
+    "ingest": bench_ingest,
+    "frame": bench_frame,
+    "receive": bench_receive,
+    "transmit": bench_transmit,
+    "flash": bench_flash,
+    "program_all": bench_program_all,
+    "delta": bench_delta,
+    "firmware": bench_firmware,
+    "timers": bench_timers,
+    "server": bench_server,
+    "telemetry": bench_telemetry,
+    "lora": bench_lora,
+}
+
+if __name__ == "__main__":
+    # Arguments are benchmark names, optionally followed by :argument (e.g. decode:main_dbc.dbc)
+    for arg in (sys.argv[1:] or BENCHMARKS):
+        name, *args = arg.split(":", 1)
+        BENCHMARKS[name](*args)
@@ -0,0 +1,128 @@
+import time
+import random
+import struct
+import threading
+import collections
+import heapq
+
+from mcan import frames, firmware
+from mcan.bootloader import OP_TIMEOUT, BOOT_STATUS_OK, BOOT_STATUS_ALREADY_BOOTED, BOOT_STATUS_SOFTSWAP_SUCCESS, BOOT_STATE_KEY, BOOT_STATE_SOFT_SWITCHED, BOOT_STATE_VERIFIED
+
+
+class SimulatedTarget:
+    """Stands in for the bootloaders of boards on one bus, answers the frames given to transmit
+
+    Each board has two FLASH banks, writes go to the bank that is not running
+    and are read back with the address in the identifier, the hard bank swap
+    command switches the running bank. Each frame keeps the target busy for
+    service seconds (writes for another program seconds) and its response
+    arrives latency seconds after that. Frames are dropped when more than
+    fifo are waiting and with the probability loss, read-backs are corrupted
+    with the probability corrupt. With the probability late a response
+    arrives after the sender timed out (1.5*OP_TIMEOUT late).
+    """
+    def __init__(self, inst, boards=(1,), bus=1, latency=0.002, service=0.0002, program=0.0002, fifo=32, loss=0, corrupt=0, late=0, flash_size=firmware.FLASH_SIZE, seed=0):
+        self.inst = inst
+        self.bus = bus
+        self.latency = latency
+        self.service = service
+        self.program = program
+        self.fifo = fifo
+        self.loss = loss
+        self.corrupt = corrupt
+        self.late = late
+        self.flash = {board: [bytearray(b"\xff"*flash_size), bytearray(b"\xff"*flash_size)] for board in boards}
+        self.running_bank = {board: 0 for board in boards}
+        self.random = random.Random(seed)
+        self.busy = 0
+        # Times the frames waiting on the target are done
+        self.waiting = collections.deque()
+        self.responses = []
+        self.count = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def bank(self, board, bankmode=1):
+        """FLASH of the running (bankmode 0) or the other bank (bankmode 1) of a board"""
+        return self.flash[board][self.running_bank[board] ^ bankmode]
+
+    def respond(self, board, packet):
+        id = packet["id"]
+        address = id & 0x7fff
+        if id & (1<<17):
+            o = address*8
+            if id & (1<<16):
+                length, bankmode = struct.unpack("<BB", packet["data"][:2])
+                data = bytes(self.bank(board, bankmode & 1)[o:o+length])
+            else:
+                data = bytearray(packet["data"])
+                self.bank(board)[o:o+len(data)] = data
+                self.busy += self.program
+                if self.random.random() < self.corrupt: data[0] ^= 0xff
+            return frames.CANFrame(self.bus, (1<<30) | (board<<18) | (1<<16) | (id & 0xffff), bytes(data), fd=True)
+        if packet["data"] == b"\x03": self.running_bank[board] ^= 1
+        # Boot, soft bank swap and verify succeed, everything else (reset, hard bank swap) is acknowledged
+        status, state = {
+            b"\x55"*8: (BOOT_STATUS_ALREADY_BOOTED, BOOT_STATE_KEY),
+            b"\x01": (BOOT_STATUS_SOFTSWAP_SUCCESS, BOOT_STATE_KEY | BOOT_STATE_SOFT_SWITCHED),
+            b"\x02": (BOOT_STATUS_OK, BOOT_STATE_KEY | BOOT_STATE_VERIFIED)
+        }.get(bytes(packet["data"]), (BOOT_STATUS_OK, BOOT_STATE_KEY))
+        return frames.CANFrame(self.bus, (1<<30) | (board<<18), struct.pack("<BBHI", status, self.running_bank[board], 0, state), fd=True)
+
+    def transmit(self, packet):
+        if packet["bus"] != self.bus or not (packet["id"] & (1<<30)): return
+        board = (packet["id"]>>18) & 0x7f
+        boards = list(self.flash) if board == 0x7f else [board]
+        with self.cond:
+            now = time.monotonic()
+            while self.waiting and self.waiting[0] <= now: self.waiting.popleft()
+            if self.fifo is not None and len(self.waiting) >= self.fifo: return
+            if self.random.random() < self.loss: return
+            for board in boards:
+                if board not in self.flash: continue
+                self.busy = max(self.busy, now) + self.service
+                self.count += 1
+                response = self.respond(board, packet)
+                self.waiting.append(self.busy)
+                delay = self.latency + (1.5*OP_TIMEOUT if self.random.random() < self.late else 0)
+                heapq.heappush(self.responses, (self.busy + delay, self.count, response))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running: return
+                    if not self.responses:
+                        self.cond.wait()
+                        continue
+                    wait = self.responses[0][0] - time.monotonic()
+                    if wait <= 0: break
+                    self.cond.wait(wait)
+                packet = heapq.heappop(self.responses)[2]
+            packet.ts = time.time()*1000000
+            self.inst.onrecv(packet)
+
+    def dump(self):
+        return {
+            "type": "simulated_bootloader",
+            "boards": list(self.flash),
+            "bus": self.bus,
+            "latency": self.latency,
+            "service": self.service,
+            "fifo": self.fifo,
+            "loss": self.loss,
+            "corrupt": self.corrupt,
+            "late": self.late
+        }
@@ -1,6 +1,8 @@
 __version__ = "1.3.0"
 
 from .mcan_main import *
+from .logs import load_log
+from .frames import CANFrame
 import sys
 import os.path
 
@@ -7,8 +7,11 @@ import time
 import os
 import select
 import socket
+import selectors
+import heapq
+import hashlib
 
-from mcan import mcan_utils
+from mcan import mcan_utils, frames, sources, firmware
 
 BOOT_STATE_KEY =          0xABCDEF00
 BOOT_STATE_NORMAL =             0x00
@@ -32,11 +35,128 @@ BOOT_STATUS_NO_BSM =            0x07
 BOOT_STATUS_SOFTSWAP_SUCCESS =  0x08
 BOOT_STATUS_MAINBANK =          0x09
 
+# Writes in flight while programming, seconds until an unacknowledged write is sent again and how often
+WRITE_WINDOW = 16
+WRITE_TIMEOUT = 0.2
+WRITE_RETRIES = 3
+# Writes in flight on a bus, shared between the boards that are programmed on it
+BUS_WINDOW = 32
+# Seconds an operation waits for the response to a frame and how often the frame is sent again
+OP_TIMEOUT = 0.5
+OP_RETRIES = 3
+# Seconds after the last copy of a frame that was sent again was sent that its late answers are still expected
+LATE_TIMEOUT = 2*OP_TIMEOUT
+# Commands that can be sent again when their response is lost: boot, reset and verify. Bank swaps toggle and are not repeated
+RETRANSMIT_COMMANDS = (b"\x55"*8, b"\x00", b"\x02")
+# Port of the command server, longest command line and seconds between progress events of a board
+SERVER_PORT = 4445
+SERVER_MAX_LINE = 4096
+PROGRESS_INTERVAL = 0.1
+# Hashes of the chunks programmed into each board's banks, used by delta programming, and how many chunks are read back to check them
+PAGE_HASHES = "flash_pages.json"
+DELTA_SAMPLES = 4
+# Offset of the name of the program in a bank
+BANK_IDENTIFIER = 0x3ffe0
+
 class BootloaderError(Exception):
     pass
 
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+def command(packet):
+    """Send a frame ahead of queued bulk traffic, flash writes keep the normal priority"""
+    packet["priority"] = sources.TX_PRIORITY_HIGH
+    return packet
+
+def retransmittable(packet):
+    if packet["id"] & (1<<17): return bool(packet["id"] & (1<<16))
+    return bytes(packet["data"]) in RETRANSMIT_COMMANDS
+
+def answers(response, packet):
+    """Whether a parsed response can be the answer to a command (None waits for any status)"""
+    if packet is not None and packet["id"] & (1<<17) and packet["id"] & (1<<16):
+        return response["type"] == "data" and response["id"] & 0x7fff == packet["id"] & 0x7fff
+    return response["type"] == "status"
+
+
+class Timers:
+    """Runs callbacks at their deadlines on a thread
+
+    Timers are kept in a heap and the thread sleeps until the earliest
+    deadline. There is at most one timer per key, scheduling a key again
+    replaces its timer. Cancelled timers stay in the heap until they come up
+    and are skipped then. Can be used from any thread.
+
+    Callbacks run holding lock if one is given. A timer that is cancelled or
+    replaced by a thread holding the lock does not run afterwards, even if it
+    was already due.
+    """
+    def __init__(self, lock=None):
+        self.lock = lock if lock is not None else threading.RLock()
+        self.heap = []
+        # key: [deadline, sequence number, key, func, active]
+        self.entries = {}
+        self.count = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def schedule(self, key, delay, func):
+        """Call func(key) in delay seconds"""
+        with self.cond:
+            old = self.entries.get(key)
+            if old is not None: old[4] = False
+            self.count += 1
+            entry = [time.monotonic() + delay, self.count, key, func, True]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry: self.cond.notify()
+
+    def cancel(self, key):
+        """Cancel the timer of key, returns False if there was none"""
+        with self.cond:
+            entry = self.entries.pop(key, None)
+            if entry is None: return False
+            entry[4] = False
+            return True
+
+    def __contains__(self, key):
+        with self.cond:
+            return key in self.entries
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed: return
+                    while self.heap and not self.heap[0][4]: heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0: break
+                    self.cond.wait(wait)
+                entry = heapq.heappop(self.heap)
+            with self.lock:
+                with self.cond:
+                    if not entry[4]: continue
+                    entry[4] = False
+                    del self.entries[entry[2]]
+                try:
+                    entry[3](entry[2])
+                except Exception as e:
+                    print("Error in timer {}: {}".format(entry[2], e))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
 class BootManager:
-    def __init__(self, inst):
+    def __init__(self, inst, command_server=True):
         self.inst = inst
         self.boards = {}
 
@@ -64,119 +184,162 @@ class BootManager:
 
         self.c70_state = False
 
-        self.timeouts = {}
-
-        self.event = threading.Event()
-        self.timeout_thread = threading.Thread(target=self.check_timeouts)
-        self.timeout_thread.start()
+        # Held while the boards and their operations change: by onrecv, the
+        # timer callbacks and whatever starts operations
+        self.lock = threading.RLock()
+        self.timers = Timers(self.lock)
 
-        self.server_socket = None
-        self.clinet_sockets = []
-        self.server_thread = threading.Thread(target=self.run_server);
-        self.server_thread.start()
+        # The running program_all
+        self.batch = None
+        self.last_batch = None
 
-    def check_timeouts(self):
-        while True:
-            t = time.time()
-            tv = list(self.timeouts.keys())
-            for x in tv:
-                if t >= self.timeouts[x][0]:
-                    func = self.timeouts[x][1]
-                    del self.timeouts[x]
-                    func(x)
-            if self.event.wait(0.1): break
-
-    def receive_from_client(self, sock):
-        print("handling", sock)
+        # Chunk hashes by (board, physical bank), a bank without hashes is written in full
+        self.page_hashes = {}
         try:
-            buf = b""
-            while True:
-                data = sock.recv(1500)
-                if not data: break
-                buf += data
-                commands = buf.split(b"\n")
-                buf = commands[-1]
-                for i in range(0, len(commands)-1):
-                    cmd = commands[i].strip().decode().split(" ")
-                    print("command", cmd)
-                    if cmd[0] == "quit":
-                        break
-                    elif cmd[0] == "program":
-                        board = int(cmd[1])
-                        if board < 0:
-                            for b in self.boards:
-                                print(b, self.boards[b]["config"])
-                                if "program" in self.boards[b]["config"] and self.boards[b]["config"]["program"] == cmd[2]:
-                                    board = b
-                                    break
-                            else:
-                                print("ERROR: unable to find board ID for {}".format(cmd[2]))
-                                continue
-                        self.program(board, cmd[2])
-                
-        finally:
-            sock.shutdown(socket.SHUT_RDWR)
-            sock.close()
+            with open(os.path.join(self.inst.config_dir, PAGE_HASHES)) as f:
+                for key, hashes in json.load(f).items():
+                    board, bank = key.split(":")
+                    self.page_hashes[(int(board), int(bank))] = {int(a): h for a, h in hashes.items()}
+        except FileNotFoundError: pass
+        except (ValueError, AttributeError) as e:
+            print("Ignoring {}: {}".format(PAGE_HASHES, e))
+            self.page_hashes = {}
 
-    def run_server(self):
-        # create an INET, STREAMing socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
-        # bind the socket to a public host, and a well-known port
-        self.server_socket.bind(("0.0.0.0", 4445))
-        # become a server socket
-        self.server_socket.listen(5)
+        # Called with every event dict, see emit
+        self.listeners = []
+        self.server = CommandServer(self) if command_server else None
 
-        clients = []
-
-        try:
-            while True:
-                sock, addr = self.server_socket.accept()
-                if self.event.is_set(): 
-                    sock.shutdown(socket.SHUT_RDWR)
-                    break
-                thr = threading.Thread(target=self.receive_from_client, args=(sock,))
-                thr.start()
-                clients.append((sock, thr))
-                
-        finally:
-            print("Closing telnet server")
-            self.server_socket.close()
-            for c, t in clients:
-                try:
-                    c.shutdown(socket.SHUT_RDWR)
-                    t.join()
-                except OSError: pass
+    def emit(self, event, board=None, **fields):
+        """Pass an event (started, progress, done, error, batch_done) to the listeners"""
+        fields["event"] = event
+        if board is not None: fields["board"] = board
+        for listener in self.listeners: listener(fields)
 
     def txctl(self, enabled):
         print("txctl", enabled)
-        self.inst.transmit({"bus": 5, "data": b"\x01" if enabled else b"\x00", "id": 0, "fd": False})
-        self.timeouts["txctl"] = (time.time() + 0.5, lambda *args: self.txctl(enabled))
+        self.inst.transmit(command(frames.CANFrame(5, 0, b"\x01" if enabled else b"\x00")))
+        self.timers.schedule("txctl", 0.5, lambda *args: self.txctl(enabled))
 
     def c70ctl(self, enabled):
         if enabled:
-            self.inst.transmit({"bus": 2, "data": b"\x00"*8, "id": 1793, "fd": False})
+            self.inst.transmit(frames.CANFrame(2, 1793, b"\x00"*8))
         else:
-            self.inst.transmit({"bus": 2, "data": b"\xff"*8, "id": 1793, "fd": False})
+            self.inst.transmit(frames.CANFrame(2, 1793, b"\xff"*8))
 
     def simulate_state(self):
-        self.onrecv({'bus': 2, 'id': 1108475904, 'data': b'\x00\x01\x00\x00\xC0\xef\xcd\xab', 'ts': 63604, 'fd': 1})
+        self.onrecv(frames.CANFrame(2, 1108475904, b'\x00\x01\x00\x00\xC0\xef\xcd\xab', 63604, 1))
 
     def send_command(self, bus, id, data):
-        self.inst.transmit({"bus": bus, "data": data, "id": (id<<18) | (1<<30), "fd": True})
+        self.inst.transmit(command(frames.CANFrame(bus, (id<<18) | (1<<30), data, fd=True)))
 
     def make_command(self, bus, id, data):
-        return {"bus": bus, "data": data, "id": (id<<18) | (1<<30), "fd": True}
+        return command(frames.CANFrame(bus, (id<<18) | (1<<30), data, fd=True))
 
     def make_read(self, bus, id, address, length, bankmode):
-        return {"bus": bus, "data": struct.pack("<BB", length, bankmode), "id": (1<<30) | (id<<18) | address | (1<<17) | (1<<16), "fd": True}
+        return command(frames.CANFrame(bus, (1<<30) | (id<<18) | address | (1<<17) | (1<<16), struct.pack("<BB", length, bankmode), fd=True))
     
     def make_write(self, bus, id, address, data):
-        return {"bus": bus, "data": data, "id": (1<<30) | (id<<18) | address | (1<<17), "fd": True}
+        return frames.CANFrame(bus, (1<<30) | (id<<18) | address | (1<<17), data, fd=True)
 
     def start_operation(self, board, gen):
-        self.boards[board]["op_generator"] = gen
-        self.inst.transmit(next(gen))
+        with self.lock:
+            self.boards[board].update(waiting=None, draining=None)
+            self.boards[board]["op_generator"] = gen
+            self.boards[board]["status"] = "running"
+            self.emit("started", board, operation=gen.__name__[:-4])
+            self.step_operation(board)
+
+    def step_operation(self, board):
+        """Run an operation up to the frames it sends next
+
+        Operations yield a frame, a list of frames or None to wait for the next
+        response. A single frame that is not answered within OP_TIMEOUT is
+        sent again, lists are the windowed writes and reads that time out in
+        retransmit_writes. Responses are matched to the frame in operation_response.
+        """
+        b = self.boards[board]
+        self.timers.cancel(("op", board))
+        try:
+            v = next(b["op_generator"])
+        except StopIteration:
+            self.finish_operation(board)
+            return
+        except BootloaderError as e:
+            self.finish_operation(board, e)
+            return
+        if isinstance(v, list):
+            # Windowed writes and reads match the responses by address themselves
+            b["waiting"] = None
+            for packet in v: self.inst.transmit(packet)
+            return
+        if v is not None: self.inst.transmit(v)
+        b["waiting"] = [v, 0, time.monotonic()]
+        self.timers.schedule(("op", board), OP_TIMEOUT, lambda *args: self.operation_timeout(board))
+
+    def operation_timeout(self, board):
+        with self.lock:
+            b = self.boards[board]
+            if b["op_generator"] is None or b["waiting"] is None: return
+            packet, tries, sent = b["waiting"]
+            if tries >= OP_RETRIES or (packet is not None and not retransmittable(packet)):
+                self.finish_operation(board, BootloaderError("No response from board {}".format(board)))
+                return
+            b["waiting"][1] += 1
+            if packet is not None:
+                print("Sending again to board {}".format(board))
+                self.inst.transmit(packet)
+                b["waiting"][2] = time.monotonic()
+            self.timers.schedule(("op", board), OP_TIMEOUT, lambda *args: self.operation_timeout(board))
+
+    def operation_response(self, board, packet):
+        """Pass a response to the running operation if it answers the frame the operation waits for
+
+        A frame that was sent again can be answered more than once. Once such a
+        frame is answered, the operation waits for the other answers until
+        LATE_TIMEOUT after the last copy was sent before it sends its next
+        frame, so they are not taken as the answer to that frame. Responses
+        that answer neither are discarded.
+        """
+        b = self.boards[board]
+        draining = b["draining"]
+        if draining is not None:
+            if answers(packet, draining[0]): draining[1] -= 1
+            if draining[1] <= 0: self.drained(board)
+            return
+        waiting = b["waiting"]
+        if waiting is not None and not answers(packet, waiting[0]):
+            print("Discarding stale response from board {}".format(board))
+            return
+        b["last_packet"] = packet
+        if waiting is not None and waiting[0] is not None and waiting[1]:
+            b["draining"] = list(waiting)
+            self.timers.schedule(("op", board), max(0, waiting[2] + LATE_TIMEOUT - time.monotonic()), lambda *args: self.drained(board))
+            return
+        self.step_operation(board)
+
+    def drained(self, board):
+        with self.lock:
+            b = self.boards[board]
+            if b["op_generator"] is None or b["draining"] is None: return
+            b["draining"] = None
+            self.step_operation(board)
+
+    def finish_operation(self, board, error=None):
+        with self.lock:
+            b = self.boards[board]
+            b["op_generator"] = None
+            self.timers.cancel(("op", board))
+            if error is None:
+                print("Operation done")
+                b["status"] = "done"
+                self.emit("done", board)
+            else:
+                b["status"] = "error"
+                self.on_error(error)
+                print("Operation terminated due to error:", error)
+                self.emit("error", board, error=str(error))
+            self.on_board_state_change(board)
+            if self.batch is not None and board in self.batch["boards"]: self.check_batch()
 
     #######################################################
     # Generator functions for operations
@@ -200,7 +363,7 @@ class BootManager:
 
     def read_bank_identifiers_gen(self, board):
         bus = self.boards[board]["bus"]
-        yield self.make_read(bus, board, 0x3ffe0>>3, 32, (self.boards[board]["bankstatus"]&1))
+        yield self.make_read(bus, board, BANK_IDENTIFIER>>3, 32, (self.boards[board]["bankstatus"]&1))
         name = self.boards[board]["last_packet"]["data"].strip(b"\x00")
         try:
             name = name.decode()
@@ -209,7 +372,7 @@ class BootManager:
         print("First bank", name)
         self.boards[board]["bank1"] = name
         self.on_board_state_change(board)
-        yield self.make_read(bus, board, 0x3ffe0>>3, 32, (self.boards[board]["bankstatus"]&1)^1)
+        yield self.make_read(bus, board, BANK_IDENTIFIER>>3, 32, (self.boards[board]["bankstatus"]&1)^1)
         name = self.boards[board]["last_packet"]["data"].strip(b"\x00")
         try:
             name = name.decode()
@@ -248,67 +411,195 @@ class BootManager:
         yield self.make_command(bus, board, b"\x00")
         print("Reset completed")
 
-    def write_and_verify_gen(self, board, address, data):
-        l = len(data)
-        if l >= 32 and l&8:
-            data += b"\xff"*8
-            address |= (1<<15)
-        packet = self.make_write(self.boards[board]["bus"], board, address, data)
-        yield packet
-        packet = self.boards[board]["last_packet"]
-        if packet["type"] != "data":
-            raise BootloaderError("Failed to verify write: no data packet received")
-        recv = packet["data"]
-        if recv[:l] != data[:l]:
-            print("ERROR")
-            print("    "+"".join(hex(x)[2:].rjust(2, "0") for x in data[:l]))
-            print("    "+"".join(hex(x)[2:].rjust(2, "0") for x in recv[:l]))
-            raise BootloaderError("Failed to verify write: incorrect data")
-
-
-    def write_and_verify_from_file_gen(self, board, fname):
-        """Generate FDCAN frames from an IHEX file"""
-        base_address = 0
-        dwords = {}
-        buf = bytearray([])
-        with open(fname) as f:
-            nrec = 0
-            for record in f:
-                nrec += 1
-                length = int(record[1:3], 16)
-                if record[7:9] == "02":
-                    base_address = 16*int(record[9:13], 16)
-                elif record[7:9] == "04":
-                    base_address = int(record[9:13], 16)<<16
-                elif record[7:9] == "00":
-                    address = base_address + int(record[3:7], 16)
-                    for i in range(length):
-                        if (address & 0xfffffff8) not in dwords:
-                            dwords[(address & 0xfffffff8)] = bytearray([255]*8)
-                        dwords[(address & 0xfffffff8)][address & 0x07] = int(record[9+2*i:11+2*i], 16)
-                        address += 1
-            dword_addresses = [x for x in sorted(dwords.keys())]
-            base_address = 0
-            start_address = 0
-            for i, a in enumerate(dword_addresses):
-                if len(buf) == 0:
-                    start_address = a
-                    buf = dwords[a]
-                elif a + 8 - start_address <= 64:
-                    buf += bytearray([255]*(a - start_address - len(buf)))
-                    buf += dwords[a]
-                else:
-                    yield from self.write_and_verify_gen(board, (start_address - 0x08000000)>>3, buf)
-                    start_address = a
-                    buf = dwords[a]
-
-                if len(buf) == 64:
-                    yield from self.write_and_verify_gen(board, (start_address - 0x08000000)>>3, buf)
-                    buf = bytearray([])
-                print("\rWritten {}/{} doublewords".format(i+1, len(dword_addresses)), end="")
-            if buf:
-                yield from self.write_and_verify_gen(board, (start_address - 0x08000000)>>3, buf)
-        print()
+    def write_chunks_gen(self, board, chunks, window=WRITE_WINDOW):
+        """Write and verify (address, data) chunks with up to window writes in flight
+
+        The bootloader acknowledges a write by reading it back with the address
+        in the identifier. Writes whose read-back does not match are sent again,
+        writes that are not acknowledged within WRITE_TIMEOUT are sent again by
+        retransmit_writes. Boards running on the same bus share BUS_WINDOW,
+        see write_limit.
+        """
+        bus = self.boards[board]["bus"]
+        inflight = self.boards[board]["inflight"] = {}
+        pending = collections.deque(chunks)
+        total = sum(len(data) for address, data in chunks)
+        written = 0
+        self.boards[board]["progress"] = (written, total)
+        t0 = time.time()
+        reported = 0
+
+        def write(address, data, tries=0):
+            l = len(data)
+            flags = 0
+            if l >= 32 and l&8:
+                data += b"\xff"*8
+                flags = 1<<15
+            packet = self.make_write(bus, board, address | flags, data)
+            inflight[address] = [packet, data[:l], time.time(), tries]
+            return packet
+
+        def refill():
+            limit = self.write_limit(board, window)
+            return [write(*pending.popleft()) for i in range(min(limit - len(inflight), len(pending)))]
+
+        try:
+            out = refill()
+            self.timers.schedule(("write", board), WRITE_TIMEOUT, lambda *args: self.retransmit_writes(board))
+            while inflight:
+                yield out
+                out = []
+                packet = self.boards[board]["last_packet"]
+                if packet["type"] != "data":
+                    raise BootloaderError("Failed to verify write: status {} received".format(packet["status"]))
+                address = packet["id"] & 0x7fff
+                w = inflight.get(address)
+                # Read-back of a write that was already acknowledged
+                if w is None: continue
+                if packet["data"][:len(w[1])] != w[1]:
+                    if w[3] >= WRITE_RETRIES:
+                        print("ERROR")
+                        print("    "+w[1].hex())
+                        print("    "+packet["data"][:len(w[1])].hex())
+                        raise BootloaderError("Failed to verify write: incorrect data")
+                    out.append(write(address, w[1], w[3] + 1))
+                    continue
+                del inflight[address]
+                written += len(w[1])
+                self.boards[board]["progress"] = (written, total)
+                out += refill()
+                if time.time() - reported >= PROGRESS_INTERVAL or written == total:
+                    reported = time.time()
+                    self.emit("progress", board, written=written, total=total)
+                if self.batch is None: print("\rWritten {}/{} bytes".format(written, total), end="")
+                else: self.print_batch_progress()
+        finally:
+            inflight.clear()
+            self.timers.cancel(("write", board))
+        dt = time.time() - t0
+        self.boards[board]["write_rate"] = written/dt if dt > 0 else 0
+        self.emit("written", board, bytes=written, rate=self.boards[board]["write_rate"])
+        if self.batch is None: print("\nWritten {} bytes in {:.2f} s, {:.0f} B/s".format(written, dt, self.boards[board]["write_rate"]))
+        self.on_board_state_change(board)
+
+    def read_chunks_gen(self, board, chunks, window=WRITE_WINDOW):
+        """Read back the other bank at the addresses of (address, data) chunks, returns the contents by address"""
+        bus = self.boards[board]["bus"]
+        inflight = self.boards[board]["inflight"] = {}
+        pending = collections.deque(chunks)
+        contents = {}
+
+        def read(address, data):
+            packet = self.make_read(bus, board, address, len(data), 1)
+            # Bulk reads do not need to get ahead of other traffic
+            packet["priority"] = sources.TX_PRIORITY_NORMAL
+            inflight[address] = [packet, None, time.time(), 0]
+            return packet
+
+        def refill():
+            limit = self.write_limit(board, window)
+            return [read(*pending.popleft()) for i in range(min(limit - len(inflight), len(pending)))]
+
+        try:
+            out = refill()
+            self.timers.schedule(("write", board), WRITE_TIMEOUT, lambda *args: self.retransmit_writes(board))
+            while inflight:
+                yield out
+                packet = self.boards[board]["last_packet"]
+                if packet["type"] != "data":
+                    raise BootloaderError("Failed to read back: status {} received".format(packet["status"]))
+                address = packet["id"] & 0x7fff
+                if inflight.pop(address, None) is not None: contents[address] = bytes(packet["data"])
+                out = refill()
+        finally:
+            inflight.clear()
+            self.timers.cancel(("write", board))
+        return contents
+
+    def write_limit(self, board, window):
+        """Number of writes or reads board can have in flight
+
+        Each board with an operation running on a bus gets an equal share of
+        BUS_WINDOW, so a board that starts writing first does not take the
+        whole window from the boards that are still booting. A board that
+        started on a busy bus sends only what the others leave free, and at
+        least one frame once its own are all answered.
+        """
+        bus = self.boards[board]["bus"]
+        others = [b for n, b in self.boards.items() if n != board and b["bus"] == bus and b["op_generator"] is not None]
+        free = BUS_WINDOW - sum(len(b.get("inflight") or ()) for b in others)
+        return max(1, min(window, BUS_WINDOW//(len(others) + 1), free))
+
+    def other_bank(self, board):
+        """Physical bank that is written, the one that is not running"""
+        packet = self.boards[board].get("last_packet")
+        bankstatus = packet["bankstatus"] if packet is not None and packet.get("type") == "status" else self.boards[board]["bankstatus"]
+        return (bankstatus & 1) ^ 1
+
+    def save_page_hashes(self):
+        with open(os.path.join(self.inst.config_dir, PAGE_HASHES), "w") as f:
+            json.dump({"{}:{}".format(*key): hashes for key, hashes in self.page_hashes.items()}, f)
+
+    def retransmit_writes(self, board):
+        """Send the writes and reads of an operation again that were not acknowledged within WRITE_TIMEOUT"""
+        with self.lock:
+            b = self.boards[board]
+            if b["op_generator"] is None or not b.get("inflight"): return
+            t = time.time()
+            for address, w in list(b["inflight"].items()):
+                if t - w[2] < WRITE_TIMEOUT: continue
+                if w[3] >= WRITE_RETRIES:
+                    self.finish_operation(board, BootloaderError("Failed to verify write: no data packet received"))
+                    return
+                w[2] = t
+                w[3] += 1
+                self.inst.transmit(w[0])
+            # Next when the oldest write in flight times out
+            oldest = min((w[2] for w in b["inflight"].values()), default=t)
+            self.timers.schedule(("write", board), max(oldest + WRITE_TIMEOUT - t, 0.001), lambda *args: self.retransmit_writes(board))
+
+    def write_and_verify_from_file_gen(self, board, fname, window=None, delta=None):
+        """Generate FDCAN frames from a firmware file (IHEX, ELF or binary)
+
+        With delta (the board's "delta" setting by default) only the chunks
+        that differ from the bank's contents are written. The contents are
+        known from the hashes of earlier writes to the bank, which are checked
+        by reading back DELTA_SAMPLES of the chunks they say are unchanged.
+        All chunks are written if the bank has no hashes or they are stale,
+        for example after the bank was programmed from another computer.
+        """
+        config = self.boards[board]["config"]
+        if window is None: window = config.get("write_window", WRITE_WINDOW)
+        if delta is None: delta = config.get("delta", False)
+        try:
+            chunks = firmware.load_image(fname).chunks
+        except (OSError, ValueError) as e:
+            raise BootloaderError("Unable to load {}: {}".format(fname, e))
+        key = (board, self.other_bank(board))
+        hashes = self.page_hashes.pop(key, None)
+        if delta and hashes is None:
+            print("No page hashes for board {}, writing all chunks".format(board))
+        elif delta:
+            # The chunk with the bank identifier and chunks spread over the image
+            unchanged = [c for c in chunks if hashes.get(c[0]) == chunk_hash(c[1])]
+            samples = [c for c in unchanged if c[0]*8 <= BANK_IDENTIFIER < c[0]*8 + len(c[1])]
+            samples += [c for c in unchanged[::max(1, len(unchanged)//DELTA_SAMPLES)][:DELTA_SAMPLES] if c not in samples]
+            contents = yield from self.read_chunks_gen(board, samples, window)
+            if any(contents.get(address) != bytes(data) for address, data in samples):
+                print("Page hashes of board {} are stale, writing all chunks".format(board))
+                hashes = None
+        if delta and hashes is not None:
+            changed = [c for c in chunks if hashes.get(c[0]) != chunk_hash(c[1])]
+            print("Writing {} of {} chunks".format(len(changed), len(chunks)))
+        else:
+            changed = chunks
+        # The bank's hashes are unknown until the write succeeded
+        self.save_page_hashes()
+        yield from self.write_chunks_gen(board, changed, window)
+        if hashes is None: hashes = {}
+        hashes.update((address, chunk_hash(data)) for address, data in chunks)
+        self.page_hashes[key] = hashes
+        self.save_page_hashes()
     
     def program_gen(self, board, fname=None):
         if fname is None: 
@@ -328,14 +619,13 @@ class BootManager:
 
     def boot_all(self):
         self.send_command(1, 0x7ff, b"\x55"*8)
-        self.timeouts["boot_all"] = (time.time() + 0.5, lambda *args: self.read_bank_identifiers())
+        self.timers.schedule("boot_all", 0.5, lambda *args: self.read_bank_identifiers())
 
     def read_bank_identifiers(self):
         for board in self.boards:
             if self.boards[board]["bus"] == 0 or self.boards[board]["bootstate"] == 0: continue
             print("Reading bank identifiers", board)
             self.start_operation(board, self.read_bank_identifiers_gen(board))
-            time.sleep(0.1)
 
     def soft_bank_swap(self, board):
         print("Soft bank swap", board)
@@ -353,10 +643,56 @@ class BootManager:
         print("Resetting all boards")
         self.send_command(1, 0x7ff, b"\x00")
 
+    def preload(self, fname):
+        # Parse the image here rather than on the receive path once programming started
+        try:
+            firmware.load_image(fname)
+        except (OSError, ValueError) as e:
+            print("Unable to load {}: {}".format(fname, e))
+
     def program(self, board, fname=None):
         print("Programming", board)
+        if fname or self.boards[board]["config"].get("program"): self.preload(fname or self.boards[board]["config"]["program"])
         self.start_operation(board, self.program_gen(board, fname))
 
+    def program_all(self):
+        """Program every board with a program in boards.json at once
+
+        Boards on different busses are programmed in parallel, boards on the
+        same bus share its window of writes in flight (BUS_WINDOW).
+        """
+        boards = [b for b in self.boards if self.boards[b]["config"].get("program")]
+        if not boards:
+            print("No boards with a program")
+            return
+        print("Programming boards", ", ".join(str(b) for b in boards))
+        # Boards with the same program share its image
+        for fname in set(self.boards[b]["config"]["program"] for b in boards): self.preload(fname)
+        with self.lock:
+            self.batch = {"boards": boards, "start": time.time()}
+            for board in boards:
+                self.boards[board]["progress"] = (0, 0)
+                self.start_operation(board, self.program_gen(board))
+
+    def print_batch_progress(self):
+        written = sum(self.boards[b].get("progress", (0, 0))[0] for b in self.batch["boards"])
+        total = sum(self.boards[b].get("progress", (0, 0))[1] for b in self.batch["boards"])
+        per_board = ", ".join("{}: {}".format(b, self.boards[b]["status"] if self.boards[b]["status"] != "running" else
+                              "{:.0f}%".format(100*self.boards[b]["progress"][0]/max(self.boards[b]["progress"][1], 1))) for b in self.batch["boards"])
+        print("\rWritten {}/{} bytes ({})".format(written, total, per_board), end="")
+
+    def check_batch(self):
+        boards = self.batch["boards"]
+        if any(self.boards[b]["status"] == "running" for b in boards): return
+        dt = time.time() - self.batch["start"]
+        self.batch["time"] = dt
+        print("\nProgrammed {}/{} boards in {:.1f} s".format(sum(self.boards[b]["status"] == "done" for b in boards), len(boards), dt))
+        for b in boards:
+            print("    Board {} (bus {}): {}, {:.0f} B/s".format(b, self.boards[b]["bus"], self.boards[b]["status"], self.boards[b].get("write_rate", 0)))
+        self.emit("batch_done", boards=[{"board": b, "status": self.boards[b]["status"], "rate": self.boards[b].get("write_rate", 0)} for b in boards], time=dt)
+        self.last_batch = self.batch
+        self.batch = None
+
 
     #######################################################
     # Internal functions
@@ -376,9 +712,8 @@ class BootManager:
                 if print_response: print("    Status {:02x}, bank status {:02x}, FLASH status {:04x}, boot state {:08x}".format(*stat))
 
     def onrecv(self, packet):
-        if packet["bus"] == 5 and packet["id"] == 0 and "txctl" in self.timeouts:
+        if packet["bus"] == 5 and packet["id"] == 0 and self.timers.cancel("txctl"):
             print("cancelling txctl")
-            del self.timeouts["txctl"]
             return
         elif packet["bus"] > 3:
             return
@@ -387,56 +722,273 @@ class BootManager:
             self.parse_response(packet, True)
         except:
             return
-        try:
-            board = packet["board"]
-            if board not in self.boards:
-                row = len(self.boards)+1
-                self.boards[board] = {
-                    "index": len(self.boards),
-                    "bus": packet["bus"],
-                    "bankstatus": packet["bankstatus"],
-                    "bootstate": packet["bootstate"],
-                    "offset": 0,
-                    "lastwrite": b"",
-                    "booted": True,
-                    "op_generator": None,
-                    "config": {"program": ""}
-                }
-                self.on_board_added(board)
-            self.boards[board]["last_packet"] = packet
-            if self.boards[board]["bus"] == 0: self.boards[board]["bus"] = packet["bus"]
-            if self.boards[board]["op_generator"] is not None:
-                try:
-                    v = next(self.boards[board]["op_generator"])
-                    if v is not None: self.inst.transmit(v)
-                except StopIteration:
-                    print("Operation done")
-                    self.boards[board]["op_generator"] = None
-                except BootloaderError as e:
-                    self.boards[board]["op_generator"] = None
-                    self.on_error(e)
-                    print("Operation terminated due to error:", e)
-
-            elif packet["type"] == "status":
-                self.boards[board]["booted"] = True
-                self.boards[board]["bootstate"] = packet["bootstate"]
-                self.boards[board]["bankstatus"] = packet["bankstatus"]
-                self.on_board_state_change(board)
-        except Exception as e:
-            print("Error in bootloader RX", e)
+        with self.lock:
+            try:
+                board = packet["board"]
+                if board not in self.boards:
+                    row = len(self.boards)+1
+                    self.boards[board] = {
+                        "index": len(self.boards),
+                        "bus": packet["bus"],
+                        "bankstatus": packet["bankstatus"],
+                        "bootstate": packet["bootstate"],
+                        "offset": 0,
+                        "lastwrite": b"",
+                        "booted": True,
+                        "op_generator": None,
+                        "config": {"program": ""}
+                    }
+                    self.on_board_added(board)
+                if self.boards[board]["bus"] == 0: self.boards[board]["bus"] = packet["bus"]
+                if self.boards[board]["op_generator"] is not None:
+                    self.operation_response(board, packet)
+                    return
+                self.boards[board]["last_packet"] = packet
+                if packet["type"] == "status":
+                    self.boards[board]["booted"] = True
+                    self.boards[board]["bootstate"] = packet["bootstate"]
+                    self.boards[board]["bankstatus"] = packet["bankstatus"]
+                    self.on_board_state_change(board)
+            except Exception as e:
+                print("Error in bootloader RX", e)
+
+    def board_status(self, board):
+        b = self.boards[board]
+        written, total = b.get("progress", (0, 0))
+        return {"board": board, "bus": b["bus"], "status": b.get("status", "idle"), "bootstate": b["bootstate"], "bankstatus": b["bankstatus"],
+                "bank1": b.get("bank1", ""), "bank2": b.get("bank2", ""), "program": b["config"].get("program", ""), "written": written, "total": total}
 
     def close(self):
-        self.event.set()
-        if self.server_socket is not None:
-            self.server_socket.close()
+        if self.server is not None: self.server.close()
         cboards = []
         for b in self.boards:
             self.boards[b]["config"].update(id=b, bus=self.boards[b]["bus"])
             cboards.append(self.boards[b]["config"])
-        print(cboards)
         with open(os.path.join(self.inst.config_dir, "boards.json"), "w") as f:
             f.write(json.dumps(cboards))
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(("localhost", 4445))
-        self.server_thread.join()
-        self.timeout_thread.join()
+        self.timers.close()
+
+
+
+class ServerClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        # Bytes of inbuf already searched for a newline
+        self.scanned = 0
+        self.outbuf = bytearray()
+        self.boards = set()
+        self.closing = False
+
+
+class CommandServer:
+    """Command server of a BootManager, serves all clients on one thread
+
+    Clients send a command per line:
+        program <board> [file]   (board -1 looks the board up by its program)
+        program_all
+        boot <board>
+        reset <board>
+        swap <board>
+        status [board]
+        quit
+    and receive newline-delimited JSON events: accepted, queued or an error
+    for each command and the events of the BootManager (started, progress,
+    written, done, error) for the boards they sent commands for. A command
+    for a board with a running operation is queued until it is done.
+    """
+    def __init__(self, manager, port=SERVER_PORT):
+        self.manager = manager
+        # Port 0 listens on a free port, port is the one listened on then
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind(("0.0.0.0", port))
+            self.sock.listen(16)
+            port = self.sock.getsockname()[1]
+        except OSError as e:
+            print("Unable to start the bootloader server: {}".format(e))
+            self.sock.close()
+            self.sock = None
+        self.port = port
+        self.clients = {}
+        self.queues = collections.defaultdict(collections.deque)
+        # Events of the manager from other threads, handed over through the wakeup socket
+        self.events = collections.deque()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_w.setblocking(False)
+        self.selector = None
+        self.running = True
+        manager.listeners.append(self.on_event)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def on_event(self, event):
+        self.events.append(event)
+        # Events of commands run by the server go out in order with its replies
+        if threading.current_thread() is self.thread:
+            self.dispatch()
+            return
+        try:
+            self.wakeup_w.send(b"\x00")
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        server = self.sock
+        if server is None: return
+        self.selector = selectors.DefaultSelector()
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, "wakeup")
+        try:
+            while self.running:
+                for key, mask in self.selector.select():
+                    if key.data is None:
+                        self.accept(server)
+                    elif key.data == "wakeup":
+                        self.wakeup_r.recv(4096)
+                        self.dispatch()
+                    else:
+                        if mask & selectors.EVENT_READ: self.read(key.data)
+                        if mask & selectors.EVENT_WRITE: self.flush(key.data)
+        finally:
+            print("Closing telnet server")
+            for client in list(self.clients.values()): self.drop(client)
+            self.selector.close()
+            server.close()
+
+    def accept(self, server):
+        try:
+            sock, addr = server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = ServerClient(sock)
+        self.clients[sock] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def drop(self, client):
+        if self.clients.pop(client.sock, None) is None: return
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(client)
+            return
+        client.inbuf += data
+        while client.sock in self.clients:
+            i = client.inbuf.find(b"\n", client.scanned)
+            if i < 0:
+                client.scanned = len(client.inbuf)
+                if client.scanned > SERVER_MAX_LINE:
+                    self.send(client, {"event": "error", "error": "Line too long"})
+                    self.drop(client)
+                return
+            line = bytes(client.inbuf[:i])
+            del client.inbuf[:i+1]
+            client.scanned = 0
+            self.command(client, line.decode(errors="replace").split())
+
+    def send(self, client, event):
+        client.outbuf += (json.dumps(event) + "\n").encode()
+        self.flush(client)
+
+    def flush(self, client):
+        if client.sock not in self.clients: return
+        try:
+            n = client.sock.send(client.outbuf)
+            del client.outbuf[:n]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(client)
+            return
+        if not client.outbuf and client.closing:
+            self.drop(client)
+            return
+        # Wait until the client can take more if not everything was sent
+        self.selector.modify(client.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0), client)
+
+    def command(self, client, args):
+        if not args: return
+        cmd = args[0]
+        m = self.manager
+        if cmd == "quit":
+            client.closing = True
+            self.flush(client)
+        elif cmd == "status":
+            try:
+                boards = [int(args[1])] if len(args) > 1 else list(m.boards)
+                self.send(client, {"event": "status", "boards": [m.board_status(b) for b in boards]})
+            except (ValueError, KeyError):
+                self.send(client, {"event": "error", "command": cmd, "error": "Unknown board"})
+        elif cmd == "program_all":
+            client.boards.update(b for b in m.boards if m.boards[b]["config"].get("program"))
+            self.send(client, {"event": "accepted", "command": cmd, "boards": sorted(client.boards)})
+            m.program_all()
+        elif cmd in ("program", "boot", "reset", "swap"):
+            try:
+                board = int(args[1])
+            except (IndexError, ValueError):
+                self.send(client, {"event": "error", "command": cmd, "error": "Missing board"})
+                return
+            if cmd == "program" and board < 0 and len(args) > 2:
+                board = next((b for b in m.boards if m.boards[b]["config"].get("program") == args[2]), board)
+            if board not in m.boards:
+                self.send(client, {"event": "error", "command": cmd, "board": board, "error": "Unknown board"})
+                return
+            client.boards.add(board)
+            queue = self.queues[board]
+            with m.lock:
+                if queue or m.boards[board]["op_generator"] is not None:
+                    queue.append((client, args))
+                    self.send(client, {"event": "queued", "command": cmd, "board": board, "position": len(queue)})
+                else:
+                    self.start(client, board, args)
+        else:
+            self.send(client, {"event": "error", "command": cmd, "error": "Unknown command"})
+
+    def start(self, client, board, args):
+        m = self.manager
+        self.send(client, {"event": "accepted", "command": args[0], "board": board})
+        with m.lock:
+            if args[0] == "program":
+                m.program(board, args[2] if len(args) > 2 else None)
+            elif args[0] == "boot":
+                m.boot(board)
+            elif args[0] == "reset":
+                m.reset(board)
+            elif args[0] == "swap":
+                m.hard_bank_swap(board)
+
+    def dispatch(self):
+        while self.events:
+            event = self.events.popleft()
+            board = event.get("board")
+            for client in list(self.clients.values()):
+                if board in client.boards or (board is None and client.boards.intersection(b["board"] for b in event.get("boards", []))):
+                    self.send(client, event)
+            # Start the next queued command of a board that is done
+            if event["event"] not in ("done", "error"): continue
+            with self.manager.lock:
+                if self.manager.boards[board]["op_generator"] is not None: continue
+                queue = self.queues[board]
+                while queue:
+                    client, args = queue.popleft()
+                    if client.sock in self.clients:
+                        self.start(client, board, args)
+                        break
+
+    def close(self):
+        self.running = False
+        self.on_event({"event": "closing"})
+        self.thread.join()
 
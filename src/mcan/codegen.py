@@ -0,0 +1,283 @@
+import struct
+import random
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _float32(raw):
+    return struct.unpack("<f", raw.to_bytes(4, "little"))[0]
+
+def _float64(raw):
+    return struct.unpack("<d", raw.to_bytes(8, "little"))[0]
+
+
+class MessageCompiler:
+    """Generates the source of a decode function for a single message
+
+    The generated function extracts every signal from one integer built from
+    the payload with fixed shifts and masks, applies the scale and offset as
+    constants and selects multiplexed branches through a lookup table. Any
+    case it does not handle (wrong payload length, scaling disabled, unknown
+    multiplexer values, extra decode options) is passed on to cantools.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.lines = []
+        self.functions = []
+        self.gl = {"message": message, "_float32": _float32, "_float64": _float64}
+        self.nfunc = 0
+        self.need_le = False
+        self.need_be = False
+
+    def extract(self, signal, indent):
+        n = self.message.length
+        mask = (1 << signal.length) - 1
+        if signal.byte_order == "little_endian":
+            self.need_le = True
+            self.emit(indent, "r = (v >> {}) & {:#x}".format(signal.start, mask))
+        else:
+            self.need_be = True
+            msb = (n - 1 - signal.start//8)*8 + signal.start%8
+            if msb - signal.length + 1 < 0: raise Unsupported("signal {} outside of message".format(signal.name))
+            self.emit(indent, "r = (b >> {}) & {:#x}".format(msb - signal.length + 1, mask))
+        if signal.is_float:
+            if signal.length not in (32, 64): raise Unsupported("float signal {} with {} bits".format(signal.name, signal.length))
+            self.emit(indent, "r = _float{}(r)".format(signal.length))
+        elif signal.is_signed:
+            self.emit(indent, "if r & {:#x}: r -= {:#x}".format(1 << (signal.length - 1), 1 << signal.length))
+
+    def scaled(self, signal):
+        conv = signal.conversion
+        if conv.scale == 1 and conv.offset == 0: return "r"
+        return "r * {!r} + {!r}".format(conv.scale, conv.offset)
+
+    def emit(self, indent, line):
+        self.lines.append("    "*indent + line)
+
+    def signal(self, name, indent):
+        signal = self.message.get_signal_by_name(name)
+        self.extract(signal, indent)
+        choices = signal.conversion.choices
+        if choices:
+            # cantools truncates float values to look up their choices and fails on NaN
+            if signal.is_float: raise Unsupported("float signal {} with choices".format(name))
+            self.gl["CHOICES_" + name] = choices
+            self.emit(indent, "c = CHOICES_{}.get(r) if decode_choices else None".format(name))
+            self.emit(indent, "d[{!r}] = c if c is not None else {}".format(name, self.scaled(signal)))
+        else:
+            self.emit(indent, "d[{!r}] = {}".format(name, self.scaled(signal)))
+        return signal
+
+    def node(self, tree, indent, fail):
+        for item in tree:
+            if isinstance(item, str):
+                self.signal(item, indent)
+                continue
+            for name, branches in item.items():
+                signal = self.signal(name, indent)
+                # The multiplexer value is the raw value as long as it is not scaled
+                if signal.conversion.scale != 1 or signal.conversion.offset != 0 or signal.is_float:
+                    raise Unsupported("scaled multiplexer {}".format(name))
+                if signal.conversion.choices and len(set(map(str, signal.conversion.choices.values()))) != len(signal.conversion.choices):
+                    raise Unsupported("multiplexer {} with ambiguous choices".format(name))
+                table = {}
+                for value, subtree in branches.items():
+                    table[value] = self.function(subtree)
+                self.gl["MUX_" + name] = table
+                self.emit(indent, "f = MUX_{}.get(r)".format(name))
+                self.emit(indent, "if f is None or f(v, b, decode_choices, d): {}".format(fail))
+
+    def function(self, tree):
+        """Generate a branch function that adds the signals of tree to d, returns True if cantools is needed"""
+        name = "_branch{}".format(self.nfunc)
+        self.nfunc += 1
+        outer = self.lines
+        self.lines = []
+        self.emit(0, "def {}(v, b, decode_choices, d):".format(name))
+        self.node(tree, 1, "return True")
+        self.emit(1, "return False")
+        self.functions += self.lines
+        self.lines = outer
+        return name
+
+    def compile(self):
+        if self.message.is_container: raise Unsupported("container message")
+        fallback = "return message.decode(data, decode_choices, scaling, **kwargs)"
+        self.node(self.message.signal_tree, 1, fallback)
+        node_lines = self.lines
+        self.lines = self.functions
+        self.emit(0, "def decode(data, decode_choices=True, scaling=True, **kwargs):")
+        self.emit(1, "if len(data) != {} or not scaling or kwargs:".format(self.message.length))
+        self.emit(2, fallback)
+        self.emit(1, "v = int.from_bytes(data, 'little')" if self.need_le else "v = None")
+        self.emit(1, "b = int.from_bytes(data, 'big')" if self.need_be else "b = None")
+        self.emit(1, "d = {}")
+        self.lines += node_lines
+        self.emit(1, "return d")
+        source = "\n".join(self.lines)
+        gl = dict(self.gl)
+        # Branch functions are referenced by name in the MUX tables
+        exec(source, gl)
+        for k, v in self.gl.items():
+            if k.startswith("MUX_"):
+                gl[k] = {value: gl[f] for value, f in v.items()}
+        gl["decode"]._mcan_source = source
+        return gl["decode"]
+
+
+def compile_message(message):
+    """Return a specialized decode function for message, or None if it cannot be compiled"""
+    try:
+        return MessageCompiler(message).compile()
+    except Unsupported:
+        return None
+
+
+def _field(message, signal):
+    """Return (little endian, shift, mask) to read the raw value of signal from the payload as an integer"""
+    mask = (1 << signal.length) - 1
+    if signal.byte_order == "little_endian":
+        return True, signal.start, mask
+    msb = (message.length - 1 - signal.start//8)*8 + signal.start%8
+    return False, max(msb - signal.length + 1, 0), mask
+
+
+def mux_reader(message):
+    """Return a function that reads the raw values of the top level multiplexers from a payload
+
+    None if message is not multiplexed. The function returns None for
+    payloads that do not have the length of the message.
+    """
+    n = message.length
+    fields = []
+    for item in message.signal_tree:
+        if isinstance(item, str): continue
+        fields.append(_field(message, message.get_signal_by_name(next(iter(item)))))
+    if not fields: return None
+    def read(data):
+        if len(data) != n: return None
+        le, be = int.from_bytes(data, "little"), int.from_bytes(data, "big")
+        return tuple(((le if little else be) >> shift) & mask for little, shift, mask in fields)
+    return read
+
+
+def frame_checker(message):
+    """Return a function that tells whether message.decode accepts a payload
+
+    Payloads shorter than the message, multiplexer values without a branch
+    and NaN or infinite float signals with choices are rejected, so callers
+    can skip them without catching decode errors.
+    """
+    n = message.length
+    def build(tree):
+        checks = []
+        for item in tree:
+            if isinstance(item, str):
+                signal = message.get_signal_by_name(item)
+                if signal.is_float and signal.conversion.choices and signal.length in (32, 64):
+                    # Rejected if the exponent bits are all set (NaN or infinite)
+                    checks.append((_field(message, signal), 0x7f800000 if signal.length == 32 else 0x7ff << 52, None))
+                continue
+            for name, branches in item.items():
+                signal = message.get_signal_by_name(name)
+                sign = 1 << (signal.length - 1) if signal.is_signed else 0
+                checks.append((_field(message, signal), sign, {value: build(subtree) for value, subtree in branches.items()}))
+        return checks
+    checks = build(message.signal_tree)
+    def walk(checks, le, be):
+        for (little, shift, mask), sign, branches in checks:
+            r = ((le if little else be) >> shift) & mask
+            if branches is None:
+                if r & sign == sign: return False
+                continue
+            if r & sign: r -= sign << 1
+            subtree = branches.get(r)
+            if subtree is None or not walk(subtree, le, be): return False
+        return True
+    def check(data):
+        if len(data) < n: return False
+        if not checks: return True
+        data = data[:n]
+        return walk(checks, int.from_bytes(data, "little"), int.from_bytes(data, "big"))
+    return check
+
+
+def choice_mapper(message):
+    """Return a function that applies the choices of message to signals decoded with decode_choices=False
+
+    None if message has no signals with choices. Values that are already
+    choices are kept, as are float values that are not integers.
+    """
+    signals = [(s.name, s.conversion, s.is_float) for s in message.signals if s.conversion.choices]
+    if not signals: return None
+    def apply(decoded):
+        decoded = dict(decoded)
+        for name, conv, is_float in signals:
+            v = decoded.get(name)
+            if not isinstance(v, (int, float)): continue
+            r = v if conv.scale == 1 and conv.offset == 0 else conv.numeric_scaled_to_raw(v)
+            if is_float and not float(r).is_integer(): continue
+            c = conv.choices.get(int(r) if is_float else r)
+            if c is not None: decoded[name] = c
+        return decoded
+    return apply
+
+
+def database_id(message):
+    """ID of a message as get_message_by_frame_id takes it, extended IDs have bit 31 set
+
+    Standard and extended frames can share a frame_id, so it can't be the key on its own.
+    """
+    return message.frame_id | (0x80000000 if message.is_extended_frame else 0)
+
+
+def compile_database(db):
+    """Return a dict that maps the database IDs (see database_id) of db to compiled decode functions"""
+    decoders = {}
+    for message in db.messages:
+        func = compile_message(message)
+        if func is not None: decoders[database_id(message)] = func
+    return decoders
+
+
+def verify_database(db, decoders, samples=100, seed=0):
+    """Compare the compiled decoders against cantools on random payloads
+
+    Payloads that cantools rejects (e.g. unknown multiplexer values) are
+    checked as well but do not count towards the samples per message.
+    Returns a list of (message name, payload, expected, result) mismatches.
+    """
+    rng = random.Random(seed)
+    errors = []
+    for message in db.messages:
+        func = decoders.get(database_id(message))
+        if func is None: continue
+        valid = 0
+        for i in range(samples*100):
+            data = rng.randbytes(message.length)
+            for decode_choices in (True, False):
+                try:
+                    expected = message.decode(data, decode_choices)
+                except Exception as e:
+                    expected = type(e)
+                try:
+                    result = func(data, decode_choices)
+                except Exception as e:
+                    result = type(e)
+                if not _same(expected, result):
+                    errors.append((message.name, data, expected, result))
+            if not isinstance(expected, type): valid += 1
+            if valid >= samples: break
+    return errors
+
+
+def _same(expected, result):
+    if isinstance(expected, type) or isinstance(result, type) or expected.keys() != result.keys():
+        return expected == result
+    for k in expected:
+        a, b = expected[k], result[k]
+        if type(a) != type(b) or (a != b and not (a != a and b != b)):
+            return False
+    return True
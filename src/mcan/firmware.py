@@ -0,0 +1,156 @@
+import os.path
+import struct
+import hashlib
+import threading
+
+FLASH_BASE = 0x08000000
+# Size of one bank, images are written to the bank that is not running
+FLASH_SIZE = 0x40000
+# Bytes per write frame
+CHUNK_SIZE = 64
+
+ELF_MAGIC = b"\x7fELF"
+ELF_PT_LOAD = 1
+
+
+class FirmwareImage:
+    """FLASH contents of a firmware file
+
+    data spans the lowest to the highest address set by the file, gaps are
+    0xff. present has a byte per doubleword that is 1 where the file sets
+    any byte of it. chunks are (address, data) writes of up to CHUNK_SIZE
+    bytes in aligned blocks, addresses are doubleword offsets from
+    FLASH_BASE.
+    """
+    def __init__(self, start, data, present, digest=""):
+        self.start = start
+        self.data = data
+        self.present = present
+        self.digest = digest
+        self.chunks = make_chunks(start, data, present)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def make_chunks(start, data, present):
+    chunks = []
+    dwords = CHUNK_SIZE//8
+    # Blocks are aligned to CHUNK_SIZE in FLASH, not in data
+    first = (start - FLASH_BASE)//8
+    i = -(first % dwords)
+    while i < len(present):
+        block = present[max(i, 0):i+dwords]
+        if any(block):
+            lo = max(i, 0) + block.index(1)
+            hi = max(i, 0) + len(block) - block[::-1].index(1)
+            chunks.append((first + lo, bytes(data[lo*8:hi*8])))
+        i += dwords
+    return chunks
+
+
+def parse_ihex(text):
+    """Return (address, data) segments of an IHEX file"""
+    segments = []
+    base_address = 0
+    for n, record in enumerate(text.splitlines()):
+        record = record.strip()
+        if not record: continue
+        if record[0] != ":": raise ValueError("Invalid IHEX record in line {}".format(n + 1))
+        length = int(record[1:3], 16)
+        type = record[7:9]
+        if type == "00":
+            segments.append((base_address + int(record[3:7], 16), bytes.fromhex(record[9:9+2*length])))
+        elif type == "02":
+            base_address = 16*int(record[9:13], 16)
+        elif type == "04":
+            base_address = int(record[9:13], 16)<<16
+        elif type == "01":
+            break
+    return segments
+
+
+def parse_elf(raw):
+    """Return the (physical address, data) segments of an ELF file that are loaded"""
+    if raw[:4] != ELF_MAGIC: raise ValueError("Not an ELF file")
+    bits, endian = raw[4], raw[5]
+    e = "<" if endian == 1 else ">"
+    if bits == 1:
+        phoff, = struct.unpack_from(e + "I", raw, 28)
+        phentsize, phnum = struct.unpack_from(e + "HH", raw, 42)
+        header = e + "IIIIIIII"
+    elif bits == 2:
+        phoff, = struct.unpack_from(e + "Q", raw, 32)
+        phentsize, phnum = struct.unpack_from(e + "HH", raw, 54)
+        header = e + "IIQQQQQQ"
+    else:
+        raise ValueError("Unknown ELF class {}".format(bits))
+    segments = []
+    for i in range(phnum):
+        fields = struct.unpack_from(header, raw, phoff + i*phentsize)
+        if bits == 1:
+            type, offset, vaddr, paddr, filesz = fields[:5]
+        else:
+            type, flags, offset, vaddr, paddr, filesz = fields[:6]
+        # Initialised data is loaded from FLASH, at its physical address
+        if type == ELF_PT_LOAD and filesz: segments.append((paddr, raw[offset:offset+filesz]))
+    return segments
+
+
+def build_image(segments, digest=""):
+    """Lay out segments in a FirmwareImage, segments outside of the FLASH bank are an error"""
+    segments = [(a, d) for a, d in segments if d]
+    for a, d in segments:
+        if a < FLASH_BASE or a + len(d) > FLASH_BASE + FLASH_SIZE:
+            raise ValueError("Segment at {:08x}-{:08x} is outside of FLASH ({:08x}-{:08x})".format(a, a + len(d), FLASH_BASE, FLASH_BASE + FLASH_SIZE))
+    if not segments: raise ValueError("No data in FLASH")
+    start = min(a for a, d in segments) & ~7
+    end = (max(a + len(d) for a, d in segments) + 7) & ~7
+    data = bytearray(b"\xff"*(end - start))
+    present = bytearray((end - start)//8)
+    for a, d in segments:
+        o = a - start
+        data[o:o+len(d)] = d
+        present[o//8:(o + len(d) + 7)//8] = b"\x01"*((o + len(d) + 7)//8 - o//8)
+    return FirmwareImage(start, data, present, digest)
+
+
+def parse_image(raw, fname="", digest=""):
+    """Parse the contents of an IHEX, ELF or binary file, binaries are placed at FLASH_BASE"""
+    ext = os.path.splitext(fname)[1].lower()
+    if raw[:4] == ELF_MAGIC:
+        segments = parse_elf(raw)
+    elif ext in (".hex", ".ihex", ".ihx") or raw[:1] == b":":
+        segments = parse_ihex(raw.decode("ascii"))
+    elif ext == ".bin":
+        segments = [(FLASH_BASE, raw)]
+    else:
+        raise ValueError("Unknown firmware format: {}".format(fname))
+    return build_image(segments, digest)
+
+
+# Images by path with the size and mtime they were loaded at, and by digest so files with the same contents share one
+images = {}
+images_by_digest = {}
+images_lock = threading.Lock()
+
+def load_image(fname):
+    """Load a firmware file, parsed images are kept until the file changes"""
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    with images_lock:
+        cached = images.get(path)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns: return cached[2]
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    with images_lock:
+        image = images_by_digest.get(digest)
+    if image is None: image = parse_image(raw, path, digest)
+    with images_lock:
+        images[path] = (st.st_size, st.st_mtime_ns, image)
+        # Forget images no file refers to anymore
+        used = {c[2].digest for c in images.values()}
+        for d in [d for d in images_by_digest if d not in used]: del images_by_digest[d]
+        images_by_digest[digest] = image
+    return image
@@ -0,0 +1,404 @@
+import struct
+import zlib
+
+import numpy as np
+
+# Header of a frame in the MCAN wire format (ZCF files and logger datagrams)
+CF_HEADER = np.dtype([("bus", "u1"), ("length", "u1"), ("ts", "<u2"), ("id", "<u4")])
+CF_STRUCT = struct.Struct("<BBHI")
+CF_HEADER_SIZE = 8
+CF_TIMESTAMP_BUS = 4
+# Frame size by length byte
+CF_STEPS = bytes((x & 0x7f) + CF_HEADER_SIZE for x in range(256))
+ZCF_CHUNK_SIZE = 1 << 16
+# Batches of fewer frames are cheaper to build and dispatch as lists of CANFrames than as FrameBatch columns
+SMALL_BATCH = 48
+
+
+class TimestampState:
+    """Tracks the timestamp MSBs sent by the logger on bus 4"""
+    def __init__(self):
+        self.msb = 0
+        self.offset = 0
+        self.msb_loaded = False
+
+    def base(self):
+        return self.msb - self.offset
+
+    def update(self, newmsb):
+        if newmsb < self.msb:
+            print("Warning: backwards jump in timestamp packet ({} to {})".format(self.msb>>16, newmsb>>16))
+            self.offset = newmsb - (self.msb - self.offset)
+        elif not self.msb_loaded:
+            self.msb_loaded = True
+            self.offset = newmsb
+        self.msb = newmsb
+        return self.base()
+
+
+class CANFrame:
+    """A received or transmitted CAN frame
+
+    Frames support the mapping access of the packet dicts they replace
+    (packet["bus"], "decoded" in packet, packet.get(...)), keys other than the
+    frame fields, message and decoded are kept in a dict created on first use.
+    """
+    __slots__ = ("bus", "id", "data", "ts", "fd", "message", "decoded", "extra")
+
+    def __init__(self, bus, id, data, ts=0, fd=0):
+        self.bus = bus
+        self.id = id
+        self.data = data
+        self.ts = ts
+        self.fd = fd
+        self.extra = None
+
+    def __getitem__(self, key):
+        if key in CAN_FRAME_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in CAN_FRAME_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None: self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in CAN_FRAME_FIELDS: return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in CAN_FRAME_FIELDS_ORDER if hasattr(self, k)]
+        if self.extra is not None: keys.extend(self.extra)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __eq__(self, other):
+        if not isinstance(other, (CANFrame, dict)): return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "CANFrame({})".format(", ".join("{}={!r}".format(k, v) for k, v in self.items()))
+
+
+CAN_FRAME_FIELDS_ORDER = ("bus", "id", "data", "ts", "fd", "message", "decoded")
+CAN_FRAME_FIELDS = frozenset(CAN_FRAME_FIELDS_ORDER)
+
+
+def as_frame(packet):
+    """Return packet as a CANFrame, packet dicts are copied into a new frame"""
+    if type(packet) is not dict: return packet
+    frame = CANFrame(packet["bus"], packet["id"], packet["data"], packet.get("ts", 0), packet.get("fd", 0))
+    for key, value in packet.items():
+        if key not in ("bus", "id", "data", "ts", "fd"): frame[key] = value
+    return frame
+
+
+def as_frames(packets):
+    """Return a list of packets as CANFrames, the list itself if there are no packet dicts in it"""
+    if any(type(p) is dict for p in packets): return [as_frame(p) for p in packets]
+    return packets
+
+
+class FrameBatch:
+    """Columnar batch of CAN frames
+
+    The columns are NumPy arrays, the payloads stay in a single buffer and are
+    located through data_offsets. decoded optionally holds the decoded
+    signals of every frame (or None for frames that could not be decoded).
+    """
+    def __init__(self, buf, bus, id, length, fd, ts, data_offsets, decoded=None):
+        self.buf = buf
+        self.bus = bus
+        self.id = id
+        self.length = length
+        self.fd = fd
+        self.ts = ts
+        self.data_offsets = data_offsets
+        self.decoded = decoded
+
+    def __len__(self):
+        return len(self.bus)
+
+    def data(self, i):
+        o = self.data_offsets[i]
+        return self.buf[o:o+self.length[i]]
+
+    def packet(self, i):
+        packet = CANFrame(int(self.bus[i]), int(self.id[i]), self.data(i), int(self.ts[i]), int(self.fd[i]))
+        if self.decoded is not None and self.decoded[i] is not None: packet.decoded = self.decoded[i]
+        return packet
+
+    def __iter__(self):
+        buf = self.buf
+        for i, (bus, id, o, l, ts, fd) in enumerate(zip(self.bus.tolist(), self.id.tolist(), self.data_offsets.tolist(),
+                                                        self.length.tolist(), self.ts.tolist(), self.fd.tolist())):
+            packet = CANFrame(bus, id, buf[o:o+l], ts, fd)
+            if self.decoded is not None and self.decoded[i] is not None: packet.decoded = self.decoded[i]
+            yield packet
+
+    def packets(self):
+        return list(self)
+
+    def select(self, mask):
+        """Return the frames selected by a boolean mask, an index array or a slice"""
+        decoded = None
+        if self.decoded is not None:
+            decoded = [self.decoded[i] for i in np.arange(len(self))[mask].tolist()]
+        return FrameBatch(self.buf, self.bus[mask], self.id[mask], self.length[mask], self.fd[mask], self.ts[mask], self.data_offsets[mask], decoded)
+
+
+def empty_batch(buf=b""):
+    return FrameBatch(buf, np.zeros(0, np.uint8), np.zeros(0, np.uint32), np.zeros(0, np.uint8),
+                      np.zeros(0, np.uint8), np.zeros(0, np.int64), np.zeros(0, np.intp))
+
+
+def from_packets(packets):
+    """Build a FrameBatch from a list of CANFrames or packet dicts"""
+    data = [p["data"] for p in packets]
+    length = np.fromiter(map(len, data), dtype=np.uint8, count=len(data))
+    data_offsets = np.zeros(len(data), dtype=np.intp)
+    if len(data): np.cumsum(length[:-1], out=data_offsets[1:])
+    return FrameBatch(b"".join(data), np.fromiter((p["bus"] or 0 for p in packets), dtype=np.uint8, count=len(data)),
+                      np.fromiter((p["id"] for p in packets), dtype=np.uint32, count=len(data)), length,
+                      np.fromiter((p["fd"] for p in packets), dtype=np.uint8, count=len(data)),
+                      np.fromiter((p["ts"] for p in packets), dtype=np.int64, count=len(data)), data_offsets)
+
+
+def concat_batches(batches):
+    """Join FrameBatches (a list or a generator) into one that holds only their payloads
+
+    Each batch is compacted as it comes, so the buffers of a generator's
+    batches do not have to be kept around until the end.
+    """
+    parts = []
+    size = 0
+    for batch in batches:
+        if not len(batch): continue
+        length = batch.length.astype(np.intp)
+        starts = np.cumsum(length) - length
+        payloads = np.frombuffer(batch.buf, dtype=np.uint8)[np.repeat(batch.data_offsets - starts, length) + np.arange(int(starts[-1] + length[-1]))]
+        parts.append((batch, payloads, starts + size))
+        size += len(payloads)
+    if not parts: return empty_batch()
+    return FrameBatch(np.concatenate([p[1] for p in parts]).tobytes(), np.concatenate([p[0].bus for p in parts]), np.concatenate([p[0].id for p in parts]),
+                      np.concatenate([p[0].length for p in parts]), np.concatenate([p[0].fd for p in parts]), np.concatenate([p[0].ts for p in parts]),
+                      np.concatenate([p[2] for p in parts]))
+
+
+def scan_cf(data, i=0):
+    """Return the offsets of all complete frames in data and the end of the last one"""
+    n = len(data)
+    # steps[j] is the size of the frame starting at j, the walk stops with an IndexError at the last header byte
+    steps = bytes(data[1:]).translate(CF_STEPS)
+    offsets = []
+    append = offsets.append
+    try:
+        while True:
+            append(i)
+            i += steps[i]
+    except IndexError:
+        pass
+    # The last offset has no complete header, the frame before it may end past the data
+    i = offsets.pop()
+    if offsets and i > n: i = offsets.pop()
+    return offsets, i
+
+
+def parse_cf(data, state=None, start=0, small=0):
+    """Parse all complete frames in data into a FrameBatch
+
+    Returns the batch and the number of bytes consumed, trailing partial frames
+    are left for the caller to complete. Timestamp frames on bus 4 update state
+    and are not included in the batch. Fewer than small frames are returned as
+    a list of CANFrames instead.
+
+    data that is not bytes (e.g. a memoryview of a receive buffer) is parsed
+    in place, the batch keeps a copy of the complete frames only.
+    """
+    if state is None: state = TimestampState()
+    offsets, end = scan_cf(data, start)
+    if not offsets:
+        return empty_batch(), end
+    if len(offsets) < small:
+        return parse_cf_frames(data, offsets, state), end
+    idx = np.array(offsets, dtype=np.intp)
+    # Gather the headers in one go instead of slicing them out one by one
+    head = np.frombuffer(data, dtype=np.uint8)[idx[:, None] + np.arange(CF_HEADER_SIZE)].view(CF_HEADER).ravel()
+    data_offsets = idx + CF_HEADER_SIZE
+    ts = head["ts"].astype(np.int64)
+    if len(offsets) < SMALL_BATCH:
+        ts_frames = [n for n, o in enumerate(offsets) if data[o] == CF_TIMESTAMP_BUS]
+    else:
+        ts_frames = np.flatnonzero(head["bus"] == CF_TIMESTAMP_BUS).tolist()
+    if not ts_frames:
+        ts += state.base()
+    else:
+        # Every frame uses the MSBs of the latest timestamp frame before it
+        bases = [state.base()]
+        segments = np.zeros(len(offsets), dtype=np.intp)
+        for n in ts_frames:
+            o = offsets[n] + CF_HEADER_SIZE
+            bases.append(state.update(int.from_bytes(data[o:o+4], "little") << 16))
+            segments[n] = 1
+        ts += np.array(bases, dtype=np.int64)[np.cumsum(segments)]
+        keep = np.ones(len(offsets), dtype=bool)
+        keep[ts_frames] = False
+        head, ts, data_offsets = head[keep], ts[keep], data_offsets[keep]
+    length = head["length"]
+    if not isinstance(data, bytes):
+        # One copy of the frames is cheaper than gathering the payloads
+        data = bytes(data[offsets[0]:end])
+        data_offsets -= offsets[0]
+    return FrameBatch(data, head["bus"], head["id"], length & 0x7f, length >> 7, ts, data_offsets), end
+
+
+def parse_cf_frames(data, offsets, state):
+    packets = []
+    base = state.base()
+    for i in offsets:
+        bus, length, ts, id = CF_STRUCT.unpack_from(data, i)
+        if bus == CF_TIMESTAMP_BUS:
+            base = state.update(int.from_bytes(data[i+8:i+12], "little") << 16)
+        else:
+            packets.append(CANFrame(bus, id, bytes(data[i+8:i+8+(length & 0x7f)]), ts + base, length >> 7))
+    return packets
+
+
+class ZCFReader:
+    """Incremental ZCF decompressor
+
+    At most chunk_size bytes are read or decompressed at a time. Frames that
+    straddle a chunk boundary are kept until the next chunk completes them.
+    The reader can be snapshotted and restored to jump back to a position in
+    the decompressed stream without starting over.
+    """
+    def __init__(self, f, chunk_size=ZCF_CHUNK_SIZE, state=None):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.state = TimestampState() if state is None else state
+        self.obj = zlib.decompressobj()
+        self.pending = b""
+        # Offset of pending in the decompressed stream
+        self.pos = 0
+        self.eof = False
+
+    def read_chunk(self):
+        while not self.eof:
+            if self.obj.unconsumed_tail:
+                data = self.obj.decompress(self.obj.unconsumed_tail, self.chunk_size)
+            else:
+                comp = self.f.read(self.chunk_size)
+                if comp:
+                    data = self.obj.decompress(comp, self.chunk_size)
+                else:
+                    data = self.obj.flush()
+                    self.eof = True
+            if data: return data
+        return b""
+
+    def read_batch(self):
+        """Return the next FrameBatch, or None at the end of the file"""
+        while True:
+            data = self.read_chunk()
+            if not data: return None
+            self.pending += data
+            batch, n = parse_cf(self.pending, self.state)
+            self.pending = self.pending[n:]
+            self.pos += n
+            if len(batch): return batch
+
+    def skip_to(self, offset):
+        """Discard the decompressed stream up to offset, which has to be a frame boundary"""
+        end = self.pos + len(self.pending)
+        while end < offset:
+            data = self.read_chunk()
+            if not data: break
+            self.pending = data
+            self.pos = end
+            end += len(data)
+        self.pending = self.pending[max(offset - self.pos, 0):]
+        self.pos = max(offset, self.pos)
+
+    def restart(self, tell, pos):
+        """Continue at a full flush, tell is its file offset and pos its offset in the decompressed stream"""
+        self.f.seek(tell)
+        # The stream continues without the zlib header
+        self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.pending = b""
+        self.pos = pos
+        self.eof = False
+
+    def snapshot(self):
+        return (self.f.tell(), self.obj.copy(), self.pending, self.pos, self.eof)
+
+    def restore(self, snapshot):
+        tell, obj, self.pending, self.pos, self.eof = snapshot
+        self.f.seek(tell)
+        self.obj = obj.copy()
+
+
+def iter_zcf(f, chunk_size=ZCF_CHUNK_SIZE, state=None):
+    """Decompress a ZCF file incrementally and yield a FrameBatch per chunk"""
+    reader = ZCFReader(f, chunk_size, state)
+    while True:
+        batch = reader.read_batch()
+        if batch is None: break
+        yield batch
+
+
+PCAP_HEADER_SIZE = 24
+PCAP_RECORD_HEADER = np.dtype([("sec", "<u4"), ("usec", "<u4"), ("incl_len", "<u4"), ("orig_len", "<u4"), ("id", ">u4"), ("length", "u1"), ("flags", "u1"), ("pad", "<u2")])
+PCAP_RECORD_HEADER_SIZE = 24
+
+
+def scan_pcap(data, i=PCAP_HEADER_SIZE):
+    """Return the offsets of all complete pcap records in data and the end of the last one"""
+    offsets = []
+    n = len(data)
+    while i + 16 <= n:
+        end = i + 16 + int.from_bytes(data[i+8:i+12], "little")
+        if end > n: break
+        offsets.append(i)
+        i = end
+    return offsets, i
+
+
+def parse_pcap(data, bus, start=PCAP_HEADER_SIZE):
+    """Parse the CAN records of a pcap file (as written by CANDashboard) into a FrameBatch
+
+    pcap files do not store the bus, it is set to bus (a number) for all frames.
+    Returns the batch and the number of bytes consumed. Like parse_cf, data
+    that is not bytes is parsed in place.
+    """
+    offsets, end = scan_pcap(data, start)
+    if not offsets:
+        return empty_batch(), end
+    raw = np.frombuffer(data, dtype=np.uint8)
+    idx = np.array(offsets, dtype=np.intp)
+    head = raw[idx[:, None] + np.arange(PCAP_RECORD_HEADER_SIZE)].view(PCAP_RECORD_HEADER).ravel()
+    ts = head["sec"].astype(np.int64)*1000000 + head["usec"]
+    length = (head["incl_len"] - 8).astype(np.uint8)
+    data_offsets = idx + PCAP_RECORD_HEADER_SIZE
+    if not isinstance(data, bytes):
+        data = bytes(data[offsets[0]:end])
+        data_offsets -= offsets[0]
+    return FrameBatch(data, np.full(len(idx), bus, dtype=np.uint8), head["id"].astype(np.uint32),
+                      length, (head["flags"] > 0).astype(np.uint8), ts, data_offsets), end
@@ -0,0 +1,281 @@
+import sys
+import time
+import struct
+import marshal
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import cantools
+
+from mcan import frames, sources, codegen
+
+RING_SIZE = 1 << 24
+# head (written by the worker), tail (written by the reader) and size of the ring
+RING_HEADER = struct.Struct("<QQQ")
+RING_HEADER_SIZE = 64
+RING_WRAP = 0xffffffff
+# Frames per record and seconds between flushes of a worker
+BATCH_SIZE = 1024
+FLUSH_INTERVAL = 0.005
+# Record header: number of frames, payload bytes and decoded bytes
+RECORD = struct.Struct("<IIII")
+INGEST_ROW = np.dtype([("id", "<u4"), ("bus", "u1"), ("length", "u1"), ("fd", "u1"), ("pad", "u1"), ("ts", "<i8"), ("offset", "<i8")])
+
+
+class SharedRing:
+    """Single producer, single consumer ring of byte records in shared memory
+
+    Records are padded to 8 bytes and never wrap, a record that does not fit
+    at the end of the ring is written at its start after a wrap marker.
+    """
+    def __init__(self, name=None, size=RING_SIZE):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + size)
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, 0, size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        # head and tail are accessed as native words, struct would read and write them byte by byte
+        self.index = self.buf[:RING_HEADER.size].cast("Q")
+        self.size = self.index[2]
+
+    def head(self):
+        return self.index[0]
+
+    def tail(self):
+        return self.index[1]
+
+    def used(self):
+        return self.head() - self.tail()
+
+    def write(self, parts, abort=None):
+        """Write a record made of parts, waits while the ring is full. Returns False if aborted"""
+        n = (4 + sum(len(p) for p in parts) + 7) & ~7
+        if n > self.size//2: raise ValueError("Record of {} B does not fit into the ring".format(n))
+        head = self.head()
+        pos = head % self.size
+        waste = self.size - pos if pos + n > self.size else 0
+        while self.size - (head - self.tail()) < n + waste:
+            if abort is not None and abort(): return False
+            time.sleep(0.0005)
+        if waste:
+            struct.pack_into("<I", self.buf, RING_HEADER_SIZE + pos, RING_WRAP)
+            head += waste
+            pos = 0
+        o = RING_HEADER_SIZE + pos + 4
+        for p in parts:
+            self.buf[o:o+len(p)] = p
+            o += len(p)
+        struct.pack_into("<I", self.buf, RING_HEADER_SIZE + pos, n)
+        # Publish the record only after it is complete
+        self.index[0] = head + n
+        return True
+
+    def read(self):
+        """Return the next record as bytes, or None if the ring is empty"""
+        head, tail = self.head(), self.tail()
+        while tail != head:
+            pos = tail % self.size
+            n = struct.unpack_from("<I", self.buf, RING_HEADER_SIZE + pos)[0]
+            if n == RING_WRAP:
+                tail += self.size - pos
+                self.index[1] = tail
+                continue
+            data = bytes(self.buf[RING_HEADER_SIZE+pos+4:RING_HEADER_SIZE+pos+n])
+            self.index[1] = tail + n
+            return data
+        return None
+
+    def close(self):
+        self.index.release()
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def encode_batch(batch):
+    rows = np.zeros(len(batch), dtype=INGEST_ROW)
+    rows["id"] = batch.id
+    rows["bus"] = batch.bus
+    rows["length"] = batch.length
+    rows["fd"] = batch.fd
+    rows["ts"] = batch.ts
+    rows["offset"] = batch.data_offsets
+    decoded = marshal.dumps(batch.decoded) if batch.decoded is not None else b""
+    return [RECORD.pack(len(batch), len(batch.buf), len(decoded), 0), rows.tobytes(), batch.buf, decoded]
+
+
+def decode_batch(data):
+    n, size, decoded_size, _ = RECORD.unpack_from(data)
+    rows = np.frombuffer(data, dtype=INGEST_ROW, count=n, offset=RECORD.size)
+    o = RECORD.size + n*INGEST_ROW.itemsize
+    decoded = marshal.loads(data[o+size:o+size+decoded_size]) if decoded_size else None
+    # The payloads are used in place, their offsets are moved past the rows
+    return frames.FrameBatch(data, rows["bus"], rows["id"], rows["length"], rows["fd"], rows["ts"], rows["offset"] + o, decoded)
+
+
+class WorkerSink:
+    """Stands in for MCan in an ingest worker, frames are decoded if DBCs are given and written to the ring"""
+    def __init__(self, ring, dbcs, abort):
+        self.ring = ring
+        self.abort = abort
+        self.lock = threading.Lock()
+        self.packets = []
+        self.dbs = {bus: cantools.database.load_file(fname) for bus, fname in dbcs.items()}
+        self.decoders = {bus: codegen.compile_database(db) for bus, db in self.dbs.items()}
+        self.plans = {}
+
+    def plan(self, bus, id):
+        """Like MCan.decode_plan with remap, the MCAN extended ID flag (bit 30) is moved to bit 31"""
+        if bus not in self.dbs: return None
+        try:
+            msg = self.dbs[bus].get_message_by_frame_id((id&0x1fffffff) | ((id&0x40000000)<<1))
+        except KeyError:
+            return None
+        return self.decoders[bus].get(codegen.database_id(msg), msg.decode)
+
+    def decode(self, batch):
+        decoded = []
+        for packet in batch:
+            key = (packet["bus"], packet["id"])
+            func = self.plans.get(key, False)
+            if func is False: func = self.plans[key] = self.plan(*key)
+            try:
+                decoded.append(None if func is None else func(packet["data"], False))
+            except Exception:
+                decoded.append(None)
+        return decoded
+
+    def write(self, batch):
+        if self.ring is None: return
+        if self.dbs: batch.decoded = self.decode(batch)
+        self.ring.write(encode_batch(batch), self.abort)
+
+    def flush(self):
+        with self.lock:
+            if self.packets:
+                self.write(frames.from_packets(self.packets))
+                self.packets = []
+
+    def onrecv(self, packet):
+        with self.lock:
+            self.packets.append(packet)
+            if len(self.packets) < BATCH_SIZE: return
+            self.write(frames.from_packets(self.packets))
+            self.packets = []
+
+    def onrecv_batch(self, batch):
+        if not isinstance(batch, frames.FrameBatch):
+            for packet in batch: self.onrecv(packet)
+            return
+        self.flush()
+        with self.lock:
+            self.write(batch)
+
+
+def run_worker(setup, ring_name, dbcs, stop):
+    ring = SharedRing(ring_name)
+    sink = WorkerSink(ring, dbcs, stop.is_set)
+    source = sources.construct(sink, **setup)
+    source.start()
+    try:
+        while not stop.wait(FLUSH_INTERVAL):
+            sink.flush()
+    finally:
+        source.stop()
+        # The source's thread may still be running
+        with sink.lock:
+            sink.ring = None
+        ring.close()
+
+
+class ProcessIngest:
+    """Runs sources in worker processes
+
+    Each worker parses (and with decode, DBC-decodes without choices) the
+    frames of one source and hands them to this process as columnar batches
+    through a SharedRing, a reader thread passes them on to MCan. MCan and
+    the dashboard use the decoded signals and apply the choices themselves. Only sources that
+    can be rebuilt from their dump() are supported, i.e. Replay and UDP
+    MCAN_Ethernet. The replay controls have no effect on a replay in a
+    worker. The sources that were taken over still transmit until stop,
+    which stops them as well.
+    """
+    def __init__(self, inst, decode=False, ring_size=RING_SIZE):
+        self.inst = inst
+        self.decode = decode
+        self.ring_size = ring_size
+        # Forking a process with running threads can deadlock the child, scripts need a __main__ guard
+        self.context = multiprocessing.get_context("forkserver" if sys.platform == "linux" else "spawn")
+        self.stop_event = self.context.Event()
+        self.setups = []
+        self.sources = []
+        self.workers = []
+        self.rings = []
+        self.thread = None
+        self.running = False
+
+    def add(self, source):
+        """Take over a source, returns False if it cannot run in a worker"""
+        if not hasattr(source, "dump"): return False
+        setup = source.dump()
+        if setup["type"] not in ("replay", "ip") or setup.get("tcp"): return False
+        self.setups.append(setup)
+        self.sources.append(source)
+        return True
+
+    def start(self):
+        dbcs = {int(b): f for b, f in self.inst.setup["dbc"].items()} if self.decode else {}
+        self.stop_event.clear()
+        for setup in self.setups:
+            ring = SharedRing(size=self.ring_size)
+            worker = self.context.Process(target=run_worker, args=(setup, ring.name, dbcs, self.stop_event), daemon=True)
+            worker.start()
+            self.rings.append(ring)
+            self.workers.append(worker)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def deliver(self, batch):
+        if self.inst.runtime is not None:
+            self.inst.runtime.put_threadsafe(batch)
+        else:
+            self.inst.onrecv_batch(batch)
+
+    def run(self):
+        while self.running:
+            idle = True
+            # One record per ring and round so every source gets its turn
+            for ring in self.rings:
+                data = ring.read()
+                if data is None: continue
+                self.deliver(decode_batch(data))
+                idle = False
+            if idle: time.sleep(0.0005)
+
+    def stop(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive(): worker.terminate()
+        self.running = False
+        if self.thread is not None: self.thread.join()
+        for ring in self.rings:
+            ring.close()
+            ring.unlink()
+        # Their transmit queue thread and socket
+        for source in self.sources: source.stop()
+        self.sources = []
+        self.setups = []
+        self.workers = []
+        self.rings = []
+        self.thread = None
+
+    def dump_stats(self):
+        return {"ingest_backlog": sum(ring.used() for ring in self.rings)}
@@ -0,0 +1,455 @@
+import os.path
+import csv
+import json
+import bisect
+import threading
+import collections
+
+import numpy as np
+import cantools
+
+from mcan import frames
+
+
+class SignalSeries:
+    """Time series of a single decoded signal"""
+    def __init__(self, bus, message, name, ts, values, unit=None):
+        self.bus = bus
+        self.message = message
+        self.name = name
+        self.ts = ts
+        self.values = values
+        self.unit = unit
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __repr__(self):
+        return "SignalSeries({}, {}.{}, {} samples)".format(self.bus, self.message, self.name, len(self))
+
+
+class Log:
+    """Signals decoded from a log file, indexed by (bus, message name, signal name)"""
+    def __init__(self, batch):
+        self.batch = batch
+        self.series = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            # Look up a signal by name, or by "message.signal"
+            for k, s in self.series.items():
+                if key == k[2] or key == k[1] + "." + k[2]:
+                    return s
+            raise KeyError(key)
+        return self.series[key]
+
+    def __iter__(self):
+        return iter(self.series.values())
+
+    def save(self, fname):
+        """Save all signals to a NumPy .npz file"""
+        arrays = {}
+        for (bus, message, name), s in self.series.items():
+            arrays["{}.{}.{}.ts".format(bus, message, name)] = s.ts
+            arrays["{}.{}.{}.values".format(bus, message, name)] = s.values
+        np.savez_compressed(fname, **arrays)
+
+    def to_csv(self, fname):
+        """Write all samples to a CSV file with one row per sample, ordered by time"""
+        ts = np.concatenate([s.ts for s in self]) if self.series else np.zeros(0, np.int64)
+        order = np.argsort(ts, kind="stable")
+        rows = []
+        for s in self:
+            rows.extend(zip(s.ts.tolist(), [s.bus]*len(s), [s.message]*len(s), [s.name]*len(s), s.values.tolist()))
+        with open(fname, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["ts", "bus", "message", "signal", "value"])
+            for i in order.tolist():
+                w.writerow(rows[i])
+
+
+def read_log(fname, bus=0):
+    """Read all frames of a .pcap or .zcf file into a FrameBatch, without any pacing
+
+    pcap files do not store the bus, their frames are put on bus. zcf files
+    are decompressed a chunk at a time, the batch only holds the payloads.
+    """
+    ext = os.path.splitext(fname)[1][1:]
+    if ext == "pcap":
+        with open(fname, "rb") as f:
+            return frames.parse_pcap(f.read(), bus)[0]
+    elif ext == "zcf":
+        with open(fname, "rb") as f:
+            return frames.concat_batches(frames.iter_zcf(f))
+    raise ValueError("Unknown log format: {}".format(fname))
+
+
+INDEX_VERSION = 2
+INDEX_INTERVAL = 1.0
+PCAP_READ_SIZE = 1 << 20
+# Decompressed bytes between in-memory restart points of a ZCF file, and how many are kept (about 100 kB each)
+ZCF_SNAPSHOT_INTERVAL = 64*frames.ZCF_CHUNK_SIZE
+ZCF_MAX_SNAPSHOTS = 64
+
+
+class LogIndex:
+    """Seek index of a .pcap or .zcf log, stored next to the log as <log>.idx
+
+    Every point is [ts, offset, msb, msb offset, msb loaded, restart] with the
+    timestamp of the first frame at offset and the timestamp state of the
+    logger before it. pcap offsets are file offsets, zcf offsets are positions
+    in the decompressed stream. zlib can only resume inflating at a full flush,
+    restart is the file offset of the one the Recorder wrote before the point
+    (None otherwise). zcf points without one are reached by decompressing from
+    the nearest restart point, in-memory snapshot or the start of the file
+    without parsing, which is linear in the distance.
+
+    Snapshots are taken every ZCF_SNAPSHOT_INTERVAL decompressed bytes, the
+    ZCF_MAX_SNAPSHOTS most recently used are kept. A log written without
+    restart points (e.g. by an older Recorder) is therefore only seekable in
+    constant time within the reach of the kept snapshots, seeking anywhere
+    else decompresses from the nearest one before it or from the start.
+    """
+    def __init__(self, format, points, start=0, end=0, size=0, mtime=0):
+        self.format = format
+        self.points = points
+        self.ts = [p[0] for p in points]
+        # (decompressed offset, file offset) of the full flushes
+        self.restarts = [(p[1], p[5]) for p in points if p[5] is not None]
+        self.start = start
+        self.end = end
+        self.size = size
+        self.mtime = mtime
+        # ZCFReader snapshots by decompressed offset in the order they were used, not saved to the sidecar
+        self.snapshots = collections.OrderedDict()
+        self.snapshot_offsets = []
+
+    def find(self, ts):
+        """Return the index of the last point at or before ts"""
+        return max(bisect.bisect_right(self.ts, ts) - 1, 0)
+
+    def add_snapshot(self, pos, reader):
+        """Snapshot reader at pos unless a snapshot is kept less than ZCF_SNAPSHOT_INTERVAL before it"""
+        i = bisect.bisect_right(self.snapshot_offsets, pos)
+        if i and pos < self.snapshot_offsets[i - 1] + ZCF_SNAPSHOT_INTERVAL: return
+        self.snapshot_offsets.insert(i, pos)
+        self.snapshots[pos] = reader.snapshot()
+        if len(self.snapshots) > ZCF_MAX_SNAPSHOTS:
+            old, _ = self.snapshots.popitem(last=False)
+            del self.snapshot_offsets[bisect.bisect_left(self.snapshot_offsets, old)]
+
+    def find_snapshot(self, offset):
+        """Return (decompressed offset, snapshot) of the last snapshot at or before offset, or None"""
+        i = bisect.bisect_right(self.snapshot_offsets, offset) - 1
+        if i < 0: return None
+        pos = self.snapshot_offsets[i]
+        self.snapshots.move_to_end(pos)
+        return pos, self.snapshots[pos]
+
+    def find_restart(self, offset):
+        i = bisect.bisect_right(self.restarts, (offset, float("inf"))) - 1
+        return self.restarts[i] if i >= 0 else None
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            json.dump({"version": INDEX_VERSION, "format": self.format, "start": self.start, "end": self.end,
+                       "size": self.size, "mtime": self.mtime, "points": self.points}, f)
+
+    @staticmethod
+    def load(fname):
+        with open(fname) as f:
+            d = json.load(f)
+        if d.get("version") != INDEX_VERSION: return None
+        return LogIndex(d["format"], d["points"], d["start"], d["end"], d["size"], d["mtime"])
+
+
+def build_index(fname, interval=INDEX_INTERVAL):
+    """Scan a log once and return its LogIndex with a point about every interval seconds"""
+    ext = os.path.splitext(fname)[1][1:]
+    points = []
+    start = end = None
+    step = int(interval*1000000)
+    st = os.stat(fname)
+    index = LogIndex(ext, points, size=st.st_size, mtime=st.st_mtime)
+    with open(fname, "rb") as f:
+        if ext == "pcap":
+            f.seek(frames.PCAP_HEADER_SIZE)
+            base = frames.PCAP_HEADER_SIZE
+            pending = b""
+            while True:
+                data = f.read(PCAP_READ_SIZE)
+                if not data: break
+                pending += data
+                batch, n = frames.parse_pcap(pending, 0, 0)
+                if len(batch):
+                    ts = batch.ts
+                    if start is None: start = int(ts[0])
+                    i = 0
+                    while True:
+                        later = ts[i:] >= (points[-1][0] + step if points else start)
+                        if not later.any(): break
+                        i += int(np.argmax(later))
+                        points.append([int(ts[i]), base + int(batch.data_offsets[i]) - frames.PCAP_RECORD_HEADER_SIZE, 0, 0, False, None])
+                    end = int(ts.max()) if end is None else max(end, int(ts.max()))
+                pending = pending[n:]
+                base += n
+        elif ext == "zcf":
+            reader = frames.ZCFReader(f)
+            while True:
+                pos, state = reader.pos, reader.state
+                point = [pos, state.msb, state.offset, state.msb_loaded, None]
+                index.add_snapshot(pos, reader)
+                batch = reader.read_batch()
+                if batch is None: break
+                ts = int(batch.ts[0])
+                if start is None: start = ts
+                if not points or ts >= points[-1][0] + step:
+                    points.append([ts] + point)
+                end = int(batch.ts.max()) if end is None else max(end, int(batch.ts.max()))
+        else:
+            raise ValueError("Unknown log format: {}".format(fname))
+    index.ts = [p[0] for p in points]
+    index.start = start or 0
+    index.end = end or 0
+    return index
+
+
+def find_index(fname):
+    """Load the index sidecar of a log, None if it is missing or out of date"""
+    idx = fname + ".idx"
+    st = os.stat(fname)
+    index = None
+    if os.path.exists(idx):
+        try:
+            index = LogIndex.load(idx)
+        except (ValueError, KeyError) as e:
+            print("Ignoring invalid index {}: {}".format(idx, e))
+    if index is None or index.size != st.st_size or index.mtime != st.st_mtime: return None
+    return index
+
+
+def load_index(fname, interval=INDEX_INTERVAL):
+    """Load the index sidecar of a log, (re)building it if it is missing or out of date"""
+    index = find_index(fname)
+    if index is None:
+        index = build_index(fname, interval)
+        try:
+            index.save(fname + ".idx")
+        except OSError as e:
+            print("Could not save index {}: {}".format(fname + ".idx", e))
+    return index
+
+
+def first_timestamp(fname):
+    """Return the timestamp of the first frame of a log, 0 for an empty log"""
+    with open(fname, "rb") as f:
+        if fname.endswith(".pcap"):
+            f.seek(frames.PCAP_HEADER_SIZE)
+            batch = frames.parse_pcap(f.read(frames.PCAP_RECORD_HEADER_SIZE + 64), 0, 0)[0]
+        else:
+            batch = frames.ZCFReader(f).read_batch()
+    return int(batch.ts[0]) if batch is not None and len(batch) else 0
+
+
+class LogReader:
+    """Reads the frames of a log from any timestamp, using its LogIndex to seek
+
+    A log without an up to date sidecar is indexed on a background thread,
+    until the index is ready the reader starts at the beginning of the log and
+    seeks by reading through it.
+    """
+    def __init__(self, fname, bus=None, index=None):
+        self.fname = fname
+        self.bus = bus
+        self.index = find_index(fname) if index is None else index
+        self.builder = None
+        if self.index is None:
+            self.index = LogIndex(os.path.splitext(fname)[1][1:], [], start=first_timestamp(fname))
+            self.builder = threading.Thread(target=self.build, daemon=True)
+            self.builder.start()
+        self.f = open(fname, "rb")
+        self.reader = None
+
+    def build(self):
+        try:
+            self.index = load_index(self.fname)
+        except (OSError, ValueError) as e:
+            print("Could not index {}: {}".format(self.fname, e))
+
+    def close(self):
+        self.f.close()
+
+    def read_pcap(self, point):
+        self.f.seek(frames.PCAP_HEADER_SIZE if point is None else point[1])
+        pending = b""
+        while True:
+            data = self.f.read(PCAP_READ_SIZE)
+            if not data: return
+            pending += data
+            # The bus column holds numbers, packets() puts the frames back on a bus of None
+            batch, n = frames.parse_pcap(pending, 0 if self.bus is None else self.bus, 0)
+            pending = pending[n:]
+            if len(batch): yield batch
+
+    def read_zcf(self, point):
+        offset = 0 if point is None else point[1]
+        reader = self.reader
+        index = self.index
+        snapshot = index.find_snapshot(offset)
+        restart = index.find_restart(offset)
+        nearest = max(snapshot[0] if snapshot is not None else 0, restart[0] if restart is not None else 0)
+        if reader is None or reader.pos > offset or nearest > reader.pos:
+            reader = self.reader = frames.ZCFReader(self.f)
+            if restart is not None and restart[0] == nearest:
+                reader.restart(restart[1], restart[0])
+            elif snapshot is not None:
+                reader.restore(snapshot[1])
+            else:
+                self.f.seek(0)
+        reader.skip_to(offset)
+        reader.state = frames.TimestampState()
+        if point is not None:
+            reader.state.msb, reader.state.offset, reader.state.msb_loaded = point[2:5]
+        while True:
+            index.add_snapshot(reader.pos, reader)
+            batch = reader.read_batch()
+            if batch is None: return
+            yield batch
+
+    def batches(self, start=None):
+        """Yield FrameBatches starting with the first frame at or after start (in us)"""
+        point = None
+        if start is not None and self.index.points:
+            point = self.index.points[self.index.find(start)]
+        if self.index.format == "pcap":
+            gen = self.read_pcap(point)
+        else:
+            gen = self.read_zcf(point)
+        for batch in gen:
+            if start is not None:
+                later = batch.ts >= start
+                if not later.any(): continue
+                batch = batch.select(slice(int(np.argmax(later)), None))
+                start = None
+            yield batch
+
+    def packets(self, start=None):
+        pcap = self.index.format == "pcap"
+        for batch in self.batches(start):
+            for packet in batch:
+                # pcap files do not store the bus
+                if pcap: packet["bus"] = self.bus
+                yield packet
+
+
+def extract_raw(payloads, signal, length):
+    """Extract the raw values of signal from an (n, length) array of payloads"""
+    if signal.byte_order == "little_endian":
+        first = signal.start//8
+        last = (signal.start + signal.length - 1)//8
+        shift = signal.start % 8
+        big = False
+    else:
+        msb = (length - 1 - signal.start//8)*8 + signal.start%8
+        lsb = msb - signal.length + 1
+        first = length - 1 - msb//8
+        last = length - 1 - lsb//8
+        shift = lsb % 8
+        big = True
+    nbytes = last - first + 1
+    if nbytes <= 8:
+        acc = np.zeros(len(payloads), dtype=np.uint64)
+        for k in range(nbytes):
+            acc |= payloads[:, first+k].astype(np.uint64) << np.uint64(8*(nbytes - 1 - k) if big else 8*k)
+        raw = acc >> np.uint64(shift)
+    else:
+        # Unaligned 64 bit signals span 9 bytes, use Python integers for these
+        order = "big" if big else "little"
+        raw = np.array([int.from_bytes(p[first:last+1].tobytes(), order) >> shift for p in payloads], dtype=object)
+        raw = (raw & ((1 << signal.length) - 1)).astype(np.uint64)
+    if signal.length < 64:
+        raw &= np.uint64((1 << signal.length) - 1)
+    if signal.is_float:
+        if signal.length == 32:
+            with np.errstate(invalid="ignore"):
+                return raw.astype(np.uint32).view(np.float32).astype(np.float64)
+        return raw.view(np.float64)
+    if signal.is_signed:
+        raw = raw.view(np.int64)
+        if signal.length < 64:
+            raw = np.where(raw & (1 << (signal.length - 1)), raw - (1 << signal.length), raw)
+        return raw
+    if signal.length < 64:
+        return raw.astype(np.int64)
+    return raw
+
+
+def decode_message(log, bus, message, ts, payloads):
+    """Add the series of all signals of message to log
+
+    A signal can be in several branches of a multiplexer (extended
+    multiplexing), its samples from all of them make up one series. Like
+    cantools, frames with a multiplexer value without a branch are skipped.
+    """
+    found = {}
+    invalid = np.zeros(len(payloads), dtype=bool)
+    decode_tree(message, payloads, message.signal_tree, np.ones(len(payloads), dtype=bool), found, invalid)
+    for name, (mask, values, signal) in found.items():
+        mask = mask & ~invalid
+        log.series[(bus, message.name, name)] = SignalSeries(bus, message.name, name, ts[mask], values[mask], signal.unit)
+
+
+def decode_tree(message, payloads, tree, mask, found, invalid):
+    """Decode the signals in tree where mask is set into found, marks frames with unknown multiplexer values in invalid"""
+    for item in tree:
+        if isinstance(item, str):
+            name, branches = item, None
+        else:
+            (name, branches), = item.items()
+        signal = message.get_signal_by_name(name)
+        raw = extract_raw(payloads, signal, message.length)
+        conv = signal.conversion
+        values = raw if conv.scale == 1 and conv.offset == 0 else raw*conv.scale + conv.offset
+        # The values are the same in every branch a signal is in, only the mask differs
+        found[name] = (found[name][0] | mask if name in found else mask, values, signal)
+        if branches is not None:
+            # cantools selects the branch by the integer part of the decoded multiplexer value
+            selector = raw if conv.scale == 1 and conv.offset == 0 else values.astype(np.int64)
+            invalid |= mask & ~np.isin(selector, list(branches))
+            for mux, subtree in branches.items():
+                decode_tree(message, payloads, subtree, mask & (selector == mux), found, invalid)
+
+
+def load_log(fname, dbcs, bus=0):
+    """Decode all signals in a .pcap or .zcf log file
+
+    dbcs maps busses to cantools databases or DBC file names. pcap files do not
+    store the bus, all frames in them are decoded with the DBC of bus. Frames
+    are grouped by (bus, id) and every signal is extracted from all payloads
+    of a message at once. Returns a Log of NumPy time series.
+    """
+    dbcs = {b: cantools.database.load_file(db) if isinstance(db, str) else db for b, db in dbcs.items()}
+    batch = read_log(fname, bus)
+    log = Log(batch)
+    if not len(batch): return log
+    raw = np.frombuffer(batch.buf, dtype=np.uint8)
+    keys = (batch.bus.astype(np.int64) << 32) | batch.id
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        b, id = int(keys[s]) >> 32, int(keys[s]) & 0xffffffff
+        if b not in dbcs: continue
+        try:
+            message = dbcs[b].get_message_by_frame_id((id&0x1fffffff) | ((id&0x40000000)<<1))
+        except KeyError:
+            continue
+        if message.is_container: continue
+        rows = order[s:e]
+        # Payloads that are too short cannot be decoded, longer ones are truncated like cantools does
+        rows = rows[batch.length[rows] >= message.length]
+        if not len(rows): continue
+        payloads = raw[batch.data_offsets[rows][:, None] + np.arange(message.length)]
+        decode_message(log, b, message, batch.ts[rows], payloads)
+    return log
@@ -26,6 +26,7 @@ class BootloaderMenu(tkinter.Toplevel):
         self.menubar.add_cascade(label="Commands", menu=self.cmdmenu)
         self.cmdmenu.add_command(label="Boot all", command=self.boot_manager.boot_all)
         self.cmdmenu.add_command(label="Reset all", command=self.boot_manager.reset_all)
+        self.cmdmenu.add_command(label="Program all", command=self.boot_manager.program_all)
         self.cmdmenu.add_command(label="Disable non-boot messages", command=lambda: self.boot_manager.txctl(0))
         self.cmdmenu.add_command(label="Enable non-boot messages", command=lambda: self.boot_manager.txctl(1))
         self.cmdmenu.add_command(label="Disable C70", command=lambda: self.boot_manager.c70ctl(0))
@@ -151,7 +152,7 @@ class BootloaderMenu(tkinter.Toplevel):
 
     def set_filename(self, board=None):
         if board is None: board = self.context_target
-        fname = filedialog.askopenfilename(filetypes=[("HEX file", "*.ihex")])
+        fname = filedialog.askopenfilename(filetypes=[("Firmware", "*.ihex *.hex *.elf *.bin"), ("HEX file", "*.ihex *.hex"), ("ELF file", "*.elf"), ("Binary", "*.bin")])
         if fname:
             self.boot_manager.boards[board]["config"]["program"] = fname
             self.update_board_item(board)
@@ -1,14 +1,69 @@
 import tkinter
 from tkinter import ttk
-import struct
+import threading
+import bisect
 from cantools.database.namedsignalvalue import NamedSignalValue
 
 
+class FrameStore:
+    """Latest frames.CANFrame per (target, bus, id) since the last drain
+
+    Every entry is [packet, count, cycle, pages] with the number of frames
+    received and the time between the last two of them (None if there was
+    only one). page returns the multiplexer page of a packet (or None), the
+    pages of an id are kept the same way in pages ({page: [packet, count,
+    cycle]}, None if the id has no pages) so every page is shown with exact
+    counts. Draining is O(distinct ids and pages), no matter how many frames
+    were received.
+    """
+    def __init__(self, page=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.page = page
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, packet, target):
+        key = (target, packet.bus, packet.id)
+        page = self.page(packet) if self.page is not None else None
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                e = self.entries[key] = [packet, 1, None, None]
+            else:
+                e[2] = packet.ts - e[0].ts
+                e[0] = packet
+                e[1] += 1
+            if page is None: return
+            if e[3] is None: e[3] = {}
+            p = e[3].get(page)
+            if p is None:
+                e[3][page] = [packet, 1, None]
+            else:
+                p[2] = packet.ts - p[0].ts
+                p[0] = packet
+                p[1] += 1
+
+    def drain(self):
+        with self.lock:
+            entries, self.entries = self.entries, {}
+        return entries
+
+
 class CANDashboard(tkinter.Frame):
-    def __init__(self, master, name, can_db, *args, **kwargs):
+    """Table of the latest frames and decoded signals of a dash target
+
+    In virtual mode only a pool of Treeview rows as large as the visible
+    window exists. The rows are filled from a flattened list of the expanded
+    elements, so refreshing and scrolling do not depend on the size of the
+    DBC.
+    """
+    def __init__(self, master, name, can_db, virtual=False, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
 
         self.name = name
+        self.virtual = virtual
 
         self.dash = ttk.Treeview(self)
         self.dash["columns"] = ["bus", "id", "signame", "data", "cycle", "count"]
@@ -29,22 +84,34 @@ class CANDashboard(tkinter.Frame):
         self.rowconfigure(0, weight=1)
         self.columnconfigure(0, weight=1)
         
-        vsb = ttk.Scrollbar(self, orient="vertical", command=self.dash.yview)
-        vsb.grid(row=0, column=1, sticky="news")
-        self.dash.config(yscrollcommand=vsb.set)
+        self.vsb = ttk.Scrollbar(self, orient="vertical", command=self.scroll if virtual else self.dash.yview)
+        self.vsb.grid(row=0, column=1, sticky="news")
+        if virtual:
+            self.dash.bind("<Configure>", self.on_configure)
+            self.dash.bind("<Button-1>", self.on_click)
+            self.dash.bind("<MouseWheel>", lambda e: self.scroll("scroll", -e.delta//120, "units"))
+            self.dash.bind("<Button-4>", lambda e: self.scroll("scroll", -3, "units"))
+            self.dash.bind("<Button-5>", lambda e: self.scroll("scroll", 3, "units"))
+        else:
+            self.dash.config(yscrollcommand=self.vsb.set)
 
         self.dash_elements = []
+        # Sorted (bus, id) of dash_elements, elements by (bus, id) and the elements changed since the last refresh
+        self.dash_ids = []
+        self.dash_index = {}
+        self.dirty = {}
+        self.rows_updated = 0
+        # Virtual mode: expanded elements, flattened (element, depth) rows, first visible row and the rows shown in the pool
+        self.expanded = set()
+        self.flat = None
+        self.top = 0
+        self.visible_rows = 1
+        self.pool = []
         self.dash_data = {}
         self.dash_changes = {}
         self.can_decode = can_db
-        
-        try:
-            self.pcapfile = open("/tmp/log{}.pcap".format(name), "wb")
-            self.pcapfile.write(b"\xd4\xc3\xb2\xa1\x02\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff\x00\x00\xe3\x00\x00\x00")
-        except:
-            self.pcapfile = None
 
-    def apply_packet(self, packet, dec, tree, el):
+    def apply_packet(self, packet, dec, tree, el, count=1, cycle=None):
         if not el["signals"]:
             for sig in tree:
                 mux = not isinstance(sig, str)
@@ -57,6 +124,8 @@ class CANDashboard(tkinter.Frame):
                 el["signals"].append(l)
                 if mux: l["value"] = {}
                 else: l["value"] = dec[l["name"]]
+                self.flat = None
+                if self.virtual: continue
                 self.dash.insert(parent=el["iid"], index="end", text="", values=("", "", l["name"], l["value"], "", ""), iid=l["iid"])
         for t, l in zip(tree, el["signals"]):
             v = dec[l["name"]]
@@ -82,77 +151,151 @@ class CANDashboard(tkinter.Frame):
                         "cycle": 0,
                         "last_ts": packet["ts"]
                     }
-                    self.dash.insert(parent=l["iid"], index=index, iid=l["iid"]+(v,), text="", 
+                    self.flat = None
+                    if not self.virtual: self.dash.insert(parent=l["iid"], index=index, iid=l["iid"]+(v,), text="", 
                         values=("", "", l["value"][v]["name"], v , "", 0))
-                l["value"][v]["count"] += 1
-                l["value"][v]["cycle"] = packet["ts"] - l["value"][v]["last_ts"]
+                l["value"][v]["count"] += count
+                l["value"][v]["cycle"] = packet["ts"] - l["value"][v]["last_ts"] if cycle is None else cycle
                 l["value"][v]["last_ts"] = packet["ts"]
-                self.apply_packet(packet, dec, t[l["name"]][v], l["value"][v])
+                self.apply_packet(packet, dec, t[l["name"]][v], l["value"][v], count, cycle)
             else:
                 l["value"] = dec[l["name"]]
 
 
-    def dash_update(self, packet):
-        if self.pcapfile is not None:
-            length = len(packet["data"]) + 8
-            can_head = struct.pack(">I", packet["id"])
-            can_head += struct.pack("<4B", len(packet["data"]), 0x04 if packet["fd"] else 0x00, 0, 0)
-            self.pcapfile.write(struct.pack("<4I", int(packet["ts"]//1000000), int(packet["ts"]%1000000), length, length)+can_head+packet["data"])
+    def apply_pages(self, packet, msg, dec, el, pages):
+        """Apply the latest packet of every multiplexer page with its count and cycle"""
+        if pages is None:
+            self.apply_packet(packet, dec, msg.signal_tree, el)
+            return
+        # The latest packet goes last, it sets the signals outside of the pages
+        for p, count, cycle in sorted(pages.values(), key=lambda page: page[0] is packet):
+            d = dec if p is packet else self.can_decode(p)[1]
+            if d: self.apply_packet(p, d, msg.signal_tree, el, count, cycle)
 
-        index = 0
+    def dash_update(self, packet, count=1, cycle=None, pages=None):
         iid = (packet["bus"], packet["id"])
         msg, dec = self.can_decode(packet)
-        # Determine where the new packet should be inserted so the IDs are in order
-        for i in range(len(self.dash_elements)):
-            if iid > self.dash_elements[i]["iid"]:
-                index += 1
-            if self.dash_elements[i]["iid"] == iid:
-                index = i
-                break
-        else:
+        el = self.dash_index.get(iid)
+        if el is None:
+            # Insert the new element so the IDs are in order
+            index = bisect.bisect_left(self.dash_ids, iid)
             el = {
                 "iid": iid,
                 "name": msg.name if msg is not None else "",
                 "raw": packet["data"],
                 "signals": [],
-                "count": 0,
-                "cycle": 0,
+                "count": count - 1,
+                "cycle": cycle or 0,
                 "last_ts": packet["ts"]
             }
+            self.dash_ids.insert(index, iid)
             self.dash_elements.insert(index, el)
-            self.dash.insert(parent="", index=(index if index >= 0 else "end"), iid=iid, text="", 
+            self.dash_index[iid] = el
+            self.dirty[iid] = el
+            self.flat = None
+            if not self.virtual: self.dash.insert(parent="", index=index, iid=iid, text="", 
                 values=(packet["bus"], packet["id"], el["name"], " ".join(hex(x)[2:].rjust(2, "0") for x in packet["data"]), "", 0))
             if msg is not None:
-                self.apply_packet(packet, dec, msg.signal_tree, el)
-            #print("inserting", iid, index, self.dash_elements[index])
+                self.apply_pages(packet, msg, dec, el, pages)
             return
         
-        el = self.dash_elements[index]
-        el["count"] += 1
-        el["cycle"] = packet["ts"] - el["last_ts"]
+        self.dirty[iid] = el
+        el["count"] += count
+        el["cycle"] = packet["ts"] - el["last_ts"] if cycle is None else cycle
         el["last_ts"] = packet["ts"]
         el["raw"] = packet["data"]
         if msg is not None:
-            self.apply_packet(packet, dec, msg.signal_tree, el)
+            self.apply_pages(packet, msg, dec, el, pages)
     
-    def update_element(self, el):
+    def set_values(self, el, values):
+        # Only touch the Treeview if the row actually changed
+        if el.get("shown") != values:
+            el["shown"] = values
+            self.dash.item(el["iid"], values=values)
+            self.rows_updated += 1
+
+    def row_values(self, el):
         if "signals" in el:
-            self.dash.item(el["iid"], values=(el["iid"][0], el["iid"][1], el["name"], " ".join(hex(x)[2:].rjust(2, "0") for x in el["raw"]), el["cycle"], el["count"]))
-            for l in el["signals"]:
-                self.update_element(l)
-        else:
-            if el["mux"]:
-                self.dash.item(el["iid"], values=("", "", el["name"], "", "", ""))
-                for m in el["value"]:
-                    self.update_element(el["value"][m])
-            else:
-                self.dash.item(el["iid"], values=("", "", el["name"], el["value"], "", ""))
+            return (el["iid"][0], el["iid"][1], el["name"], " ".join(hex(x)[2:].rjust(2, "0") for x in el["raw"]), el["cycle"], el["count"])
+        if el["mux"]:
+            return ("", "", el["name"], "", "", "")
+        return ("", "", el["name"], el["value"], "", "")
+
+    def children(self, el):
+        if "signals" in el: return el["signals"]
+        if el["mux"]: return [el["value"][m] for m in sorted(el["value"])]
+        return []
+
+    def update_element(self, el):
+        self.set_values(el, self.row_values(el))
+        for l in self.children(el):
+            self.update_element(l)
 
     def update_elements(self):
-        for el in self.dash_elements:
+        dirty, self.dirty = self.dirty, {}
+        if self.virtual:
+            self.render()
+            return
+        for el in dirty.values():
             self.update_element(el)
 
-    def close(self):
-        if self.pcapfile is not None:
-            self.pcapfile.close()
-            self.pcapfile = None
+    def flatten(self, elements, depth, rows):
+        for el in elements:
+            rows.append((el, depth))
+            if el["iid"] in self.expanded: self.flatten(self.children(el), depth + 1, rows)
+        return rows
+
+    def render(self):
+        """Fill the row pool with the visible part of the flattened elements"""
+        if self.flat is None: self.flat = self.flatten(self.dash_elements, 0, [])
+        n = min(self.visible_rows, len(self.flat))
+        self.top = max(0, min(self.top, len(self.flat) - n))
+        while len(self.pool) < n:
+            self.dash.insert(parent="", index="end", iid="row{}".format(len(self.pool)), text="", values=())
+            self.pool.append(None)
+        while len(self.pool) > n:
+            self.pool.pop()
+            self.dash.delete("row{}".format(len(self.pool)))
+        for k in range(n):
+            el, depth = self.flat[self.top + k]
+            text = ("-" if el["iid"] in self.expanded else "+") if self.children(el) else ""
+            values = self.row_values(el)
+            values = values[:2] + ("    "*depth + str(values[2]),) + values[3:]
+            if self.pool[k] != (text, values):
+                self.pool[k] = (text, values)
+                self.dash.item("row{}".format(k), text=text, values=values)
+                self.rows_updated += 1
+        if self.flat:
+            self.vsb.set(self.top/len(self.flat), (self.top + n)/len(self.flat))
+        else:
+            self.vsb.set(0, 1)
+
+    def scroll(self, *args):
+        if self.flat is None: self.flat = self.flatten(self.dash_elements, 0, [])
+        if args[0] == "moveto":
+            self.top = int(float(args[1])*len(self.flat))
+        elif args[0] == "scroll":
+            self.top += int(args[1])*(self.visible_rows if args[2] == "pages" else 1)
+        self.render()
+
+    def toggle(self, row):
+        if self.top + row >= len(self.flat): return
+        el = self.flat[self.top + row][0]
+        if not self.children(el): return
+        if el["iid"] in self.expanded:
+            self.expanded.remove(el["iid"])
+        else:
+            self.expanded.add(el["iid"])
+        self.flat = None
+        self.render()
+
+    def on_click(self, event):
+        iid = self.dash.identify_row(event.y)
+        if iid and self.dash.identify_column(event.x) == "#0":
+            self.toggle(int(iid[3:]))
+
+    def on_configure(self, event):
+        rowheight = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        # One row is taken by the headings
+        self.visible_rows = max(1, event.height//rowheight - 1)
+        self.render()
@@ -2,7 +2,6 @@ import sys
 import threading
 import os
 import cantools
-import queue
 import time
 import os.path
 import json
@@ -13,23 +12,70 @@ from tkinter import ttk
 import tkinter.font
 import tkinter.filedialog
 
-from mcan import mcan_dash, sources, bootloader, mcan_bootloader, __version__
+import numpy as np
 
+from mcan import mcan_dash, sources, bootloader, mcan_bootloader, frames, codegen, recorder, runtime, ingest, __version__
+
+# (bus, id) pairs a CANStream remembers before its tables are started over,
+# bootloader IDs carry addresses so their number is not bounded
+DISPATCH_SIZE = 4096
 
 
 class CANStream:
-    def __init__(self):
+    """Tree of filters and sinks that packets are passed through
+
+    Filters that only look at the bus and ID of a packet (filter_range and
+    filter_id) are resolved once per (bus, id) pair. Each stream keeps a
+    dispatch table that maps a (bus, id) pair to the functions that need to be
+    called for it, so a packet that matches nothing costs a single lookup. The
+    table is rebuilt lazily whenever a branch is added or toggled, and
+    started over once it holds DISPATCH_SIZE pairs.
+
+    Batches of packets (a frames.FrameBatch or a list of packets) are passed
+    through with apply_batch. Filters on the bus and ID are applied as a mask
+    over the whole batch, sinks added with exec_batch receive the batch in one
+    call and all other functions are called once per packet. Lists and
+    batches of fewer than frames.SMALL_BATCH frames go through the dispatch
+    table frame by frame instead, which is faster unless there are batch sinks.
+
+    Packets are frames.CANFrames, packet dicts are converted when they enter
+    a stream.
+    """
+    def __init__(self, parent=None):
         self.branches = []
+        self.parent = parent
+        self.dispatch = {}
+        self.key_cache = {}
+        self.batch_sinks = None
 
-    def filter(self, func, enabled=True):
-        br = CANStream()
-        self.branches.append([enabled, lambda x: x if func(x) else None, br])
+    def add_branch(self, func, enabled=True):
+        br = CANStream(self)
+        self.branches.append([enabled, func, br])
+        self.invalidate()
         return br
 
+    def filter(self, func, enabled=True):
+        return self.add_branch(lambda x: x if func(x) else None, enabled)
+
+    def filter_id(self, func, enabled=True, vectorized=False):
+        """Filter on func(bus, id), the result is cached for every (bus, id) pair
+
+        If vectorized is set, func also accepts NumPy arrays of busses and IDs
+        and is applied to batches as a whole.
+        """
+        f = lambda x: x if func(x["bus"], x["id"]) else None
+        f._mcan_key = True
+        if vectorized: f._mcan_mask = func
+        return self.add_branch(f, enabled)
+
     def exec(self, func, enabled=True):
-        br = CANStream()
-        self.branches.append([enabled, func, br])
-        return br
+        return self.add_branch(func, enabled)
+
+    def exec_batch(self, func, enabled=True):
+        """Add a function that receives and returns batches instead of single packets"""
+        f = lambda batch: func(batch)
+        f._mcan_batch = True
+        return self.add_branch(f, enabled)
 
     def filter_range(self, min_id=0, max_id=0x7ff, busses=None):
         if busses is not None:
@@ -39,30 +85,140 @@ class CANStream:
         gl = {}
         exec(source, gl)
         gl["filter_range"]._mcan_source = source
-        br = CANStream()
+        gl["filter_range"]._mcan_key = True
+        if busses is not None:
+            # Lookup table for the bus column of a FrameBatch
+            bus_table = np.zeros(256, dtype=bool)
+            bus_table[[b for b in busses if 0 <= b < 256]] = True
+        else:
+            bus_table = None
+        gl["filter_range"]._mcan_range = (min_id, max_id, bus_table)
         return self.exec(gl["filter_range"])
 
+    def set_enabled(self, index, enabled):
+        self.branches[index][0] = enabled
+        self.invalidate()
+
+    def invalidate(self):
+        # Parents inline the key filters of their children, so their tables are stale as well
+        s = self
+        while s is not None:
+            s.dispatch = {}
+            s.key_cache = {}
+            s.batch_sinks = None
+            s = s.parent
+
+    def resolve(self, key):
+        """Return the functions a packet with the given (bus, id) pair has to be passed to"""
+        steps = []
+        for enabled, func, br in self.branches:
+            if not enabled: continue
+            if getattr(func, "_mcan_key", False):
+                if func({"bus": key[0], "id": key[1]}) is not None:
+                    steps.extend(br.resolve(key))
+            elif br.branches or getattr(func, "_mcan_batch", False):
+                steps.append(self.make_step(func, br))
+            else:
+                steps.append(func)
+        return tuple(steps)
+
+    @staticmethod
+    def make_step(func, br):
+        if getattr(func, "_mcan_batch", False):
+            def step(element):
+                part = func([element])
+                if part is not None: br.apply_batch(part)
+        else:
+            def step(element):
+                part = func(element)
+                if part is not None: br.apply(part)
+        return step
+
     def apply(self, element):
-        for b in self.branches:
-            if b[0]:
-                part = b[1](element)
-                if part is not None: b[2].apply(part)
+        if type(element) is dict: element = frames.as_frame(element)
+        key = (element.bus, element.id)
+        dispatch = self.dispatch
+        steps = dispatch.get(key)
+        if steps is None:
+            if len(dispatch) >= DISPATCH_SIZE: dispatch.clear()
+            steps = dispatch[key] = self.resolve(key)
+        for f in steps:
+            f(element)
+
+    def key_mask(self, n, func, batch):
+        """Evaluate the key filter of branch n on every frame in a FrameBatch"""
+        r = getattr(func, "_mcan_range", None)
+        if r is not None:
+            mask = (batch.id >= r[0]) & (batch.id <= r[1])
+            if r[2] is not None: mask &= r[2][batch.bus]
+            return mask
+        if hasattr(func, "_mcan_mask"):
+            return np.asarray(func._mcan_mask(batch.bus, batch.id), dtype=bool)
+        cache = self.key_cache
+        result = []
+        for key in zip(batch.bus.tolist(), batch.id.tolist()):
+            accepted = cache.get((n, key))
+            if accepted is None:
+                if len(cache) >= DISPATCH_SIZE: cache.clear()
+                accepted = cache[(n, key)] = func({"bus": key[0], "id": key[1]}) is not None
+            result.append(accepted)
+        return np.array(result, dtype=bool)
+
+    def has_batch_sinks(self):
+        if self.batch_sinks is None:
+            self.batch_sinks = any(enabled and (getattr(func, "_mcan_batch", False) or br.has_batch_sinks()) for enabled, func, br in self.branches)
+        return self.batch_sinks
+
+    def apply_batch(self, batch):
+        if not len(batch): return
+        if (not isinstance(batch, frames.FrameBatch) or len(batch) < frames.SMALL_BATCH) and not self.has_batch_sinks():
+            for x in batch: self.apply(x)
+            return
+        if not isinstance(batch, frames.FrameBatch): batch = frames.as_frames(batch)
+        packets = None
+        for n, (enabled, func, br) in enumerate(self.branches):
+            if not enabled: continue
+            if getattr(func, "_mcan_key", False):
+                if not br.branches: continue
+                if isinstance(batch, frames.FrameBatch):
+                    part = batch.select(self.key_mask(n, func, batch))
+                else:
+                    part = [x for x in batch if func(x) is not None]
+            elif getattr(func, "_mcan_batch", False):
+                part = func(batch)
+            elif br.branches:
+                # Adapter for functions that only accept single packets
+                part = [x for x in map(func, batch) if x is not None]
+            else:
+                # Sinks share the frames, like they do when packets are applied one by one
+                if packets is None: packets = batch.packets() if isinstance(batch, frames.FrameBatch) else batch
+                for x in packets: func(x)
+                continue
+            if part is not None and len(part): br.apply_batch(part)
 
 class MCan:
-    def __init__(self):
+    def __init__(self, config_dir=None, command_server=True):
         self.rxrootstream = CANStream()
         self.txrootstream = CANStream()
         self.main_window = None
 
-        self.config_dir = os.path.join(os.path.expanduser("~"), ".mcan")
+        self.config_dir = config_dir if config_dir is not None else os.path.join(os.path.expanduser("~"), ".mcan")
         self.setup = {}
         if "sources" not in self.setup: self.setup["sources"] = []
         if "dbc" not in self.setup: self.setup["dbc"] = {}
         if "options" not in self.setup: self.setup["options"] = {}
         if "poll_errors" not in self.setup["options"]: self.setup["options"]["poll_errors"] = False
+        if "compile_decoders" not in self.setup["options"]: self.setup["options"]["compile_decoders"] = True
+        if "async_sources" not in self.setup["options"]: self.setup["options"]["async_sources"] = False
+        if "ingest_processes" not in self.setup["options"]: self.setup["options"]["ingest_processes"] = False
+        if "ingest_decode" not in self.setup["options"]: self.setup["options"]["ingest_decode"] = False
+        if "virtual_dashboard" not in self.setup["options"]: self.setup["options"]["virtual_dashboard"] = False
+        if "log_format" not in self.setup["options"]: self.setup["options"]["log_format"] = "pcap"
+        if "log_rotate_size" not in self.setup["options"]: self.setup["options"]["log_rotate_size"] = None
+        if "log_rotate_time" not in self.setup["options"]: self.setup["options"]["log_rotate_time"] = None
         
-        self.boot_manager = bootloader.BootManager(self)
-        self.rxrootstream.filter(lambda packet: (packet["id"]&(1<<30) and packet["fd"]) or packet["bus"] == 5).exec(self.boot_manager.onrecv)
+        self.boot_manager = bootloader.BootManager(self, command_server)
+        self.rxrootstream.filter_id(lambda bus, id: ((id&(1<<30)) != 0) | (bus == 5), vectorized=True).filter(lambda packet: packet["fd"] or packet["bus"] == 5).exec(self.boot_manager.onrecv)
 
         self.total_packets = 0
         self.last_packets = 0
@@ -73,11 +229,57 @@ class MCan:
         self.can_errors = None
 
         self.source_list = []
+        self.local_sources = []
+        self.runtime = None
+        self.ingest = None
         self.can_db = {}
+        self.decoders = {}
+        # Decode plans per (bus, id), indexed by whether extended IDs are remapped
+        self.decode_plans = ({}, {})
+        self.mux_readers = {}
+        self.decode_hits = 0
+        self.decode_misses = 0
 
     def load_file(self, bus, fname):
         self.can_db[bus] = cantools.database.load_file(fname)
         self.setup["dbc"][str(bus)] = os.path.abspath(fname)
+        if self.setup["options"]["compile_decoders"]:
+            self.decoders[bus] = codegen.compile_database(self.can_db[bus])
+        else:
+            self.decoders[bus] = {}
+        self.decode_plans = ({}, {})
+        self.mux_readers = {}
+
+    def decode_plan(self, bus, id, remap=False):
+        """Return the message, frame ID, decode function, choice mapper and frame checker for a packet, or None if it is not in the DBC
+
+        If remap is set, the MCAN extended ID flag (bit 30) is moved to bit 31.
+        Plans are cached until a DBC is loaded.
+        """
+        plans = self.decode_plans[remap]
+        plan = plans.get((bus, id), False)
+        if plan is not False:
+            self.decode_hits += 1
+            return plan
+        self.decode_misses += 1
+        plan = None
+        if bus in self.can_db:
+            frame_id = (id&0x1fffffff) | ((id&0x40000000)<<1) if remap else id
+            try:
+                msg = self.can_db[bus].get_message_by_frame_id(frame_id)
+                plan = (msg, frame_id, self.decoders[bus].get(codegen.database_id(msg), msg.decode), codegen.choice_mapper(msg), codegen.frame_checker(msg))
+            except KeyError:
+                pass
+        plans[(bus, id)] = plan
+        return plan
+
+    def mux_page(self, bus, id, data):
+        """Return the raw values of the multiplexers of a dashboard packet, None if its message has none"""
+        reader = self.mux_readers.get((bus, id), False)
+        if reader is False:
+            plan = self.decode_plan(bus, id, True)
+            reader = self.mux_readers[(bus, id)] = codegen.mux_reader(plan[0]) if plan is not None else None
+        return reader(data) if reader is not None else None
 
     def dump_stream_setup(self):
         def dump_stream_setup_rec(s):
@@ -92,17 +294,18 @@ class MCan:
         for k in gl:
             if k != "self" and k != "__builtins__":
                 gl[k]._mcan_source = string
+                if k == "filter_range": gl[k]._mcan_key = True
                 return gl[k]
 
     def load_setup(self, fname):
         with open(fname) as f:
             setup = json.load(f)
+        self.setup["options"].update(setup["options"])
         for b in setup["dbc"]:
             self.load_file(int(b), setup["dbc"][b])
         for s in setup["sources"]:
             obj = sources.construct(self, **s)
             if obj is not None: self.source(obj)
-        self.setup["options"].update(setup["options"])
         
         def load_stream_rec(target, setup):
             for u in setup:
@@ -122,31 +325,72 @@ class MCan:
         self.setup["sources"].append(s.dump())
 
     def start_sources(self):
-        for s in self.source_list: 
-            s.start()
+        self.local_sources = self.source_list
+        if self.setup["options"]["ingest_processes"]:
+            self.ingest = ingest.ProcessIngest(self, self.setup["options"]["ingest_decode"])
+            self.local_sources = [s for s in self.source_list if not self.ingest.add(s)]
+        if self.setup["options"]["async_sources"]:
+            self.runtime = runtime.SourceRuntime(self)
+            self.runtime.start()
+            for s in self.local_sources:
+                self.runtime.add(s)
+        else:
+            for s in self.local_sources: 
+                s.start()
+        if self.ingest is not None: self.ingest.start()
 
     def stop_sources(self):
-        for s in self.source_list:
+        for s in self.local_sources:
             s.stop()
+        if self.ingest is not None:
+            self.ingest.stop()
+            self.ingest = None
+        if self.runtime is not None:
+            self.runtime.stop()
+            self.runtime = None
 
     def transmit(self, packet):
         self.txrootstream.apply(packet)
     
     def onrecv(self, packet):
+        if type(packet) is dict: packet = frames.as_frame(packet)
         self.total_packets += 1
-        self.total_bytes += len(packet["data"])
-        if packet["bus"] == 5 and packet["id"] == 1:
-            self.can_errors = struct.unpack("<4H", packet["data"][24:32])
+        self.total_bytes += len(packet.data)
+        if packet.bus == 5 and packet.id == 1:
+            self.can_errors = struct.unpack("<4H", packet.data[24:32])
         self.rxrootstream.apply(packet)
+
+    def onrecv_batch(self, batch):
+        """Receive a frames.FrameBatch or a list of packets"""
+        if isinstance(batch, frames.FrameBatch) and len(batch) < frames.SMALL_BATCH:
+            # Counting a few frames in Python is cheaper than the numpy reductions
+            batch = batch.packets()
+        if isinstance(batch, frames.FrameBatch):
+            self.total_packets += len(batch)
+            self.total_bytes += int(batch.length.sum())
+            errors = np.flatnonzero((batch.bus == 5) & (batch.id == 1))
+            if len(errors):
+                self.can_errors = struct.unpack("<4H", batch.data(errors[-1])[24:32])
+        else:
+            batch = frames.as_frames(batch)
+            for packet in batch:
+                self.total_packets += 1
+                self.total_bytes += len(packet.data)
+                if packet.bus == 5 and packet.id == 1:
+                    self.can_errors = struct.unpack("<4H", packet.data[24:32])
+        self.rxrootstream.apply_batch(batch)
     
     def can_decode(self, packet, **kwargs):
-        if packet["bus"] not in self.can_db: return
-        db = self.can_db[packet["bus"]]
-        if packet["id"] not in db._frame_id_to_message: return
+        plan = self.decode_plan(packet["bus"], packet["id"])
+        if plan is None: return
+        packet["message"] = plan[0]
+        if packet.get("decoded") is not None and set(kwargs) <= {"decode_choices"}:
+            # Already decoded by an ingest worker, without choices
+            if kwargs.get("decode_choices", True) and plan[3] is not None: packet["decoded"] = plan[3](packet["decoded"])
+            return
         try:
-            packet["message"] = db.get_message_by_frame_id(packet["id"])
-            packet["decoded"] = db.decode_message(packet["id"], packet["data"], **kwargs)
-        except:
+            packet["decoded"] = plan[2](packet["data"], **kwargs)
+        except Exception:
             pass
 
     def dump_stats(self):
@@ -158,7 +402,10 @@ class MCan:
             "packet_rate": (self.total_packets - self.last_packets)/diff,
             "byte_rate": (self.total_bytes - self.last_bytes)/diff,
             "total_time": t - self.start_time,
-            "can_errors": self.can_errors
+            "can_errors": self.can_errors,
+            "decode_hits": self.decode_hits,
+            "decode_misses": self.decode_misses,
+            "source_backlog": self.runtime.qsize() if self.runtime is not None else None
         }
         self.last_time = t
         self.last_packets = self.total_packets
@@ -166,8 +413,9 @@ class MCan:
         for s in self.source_list:
             if hasattr(s, "dump_stats"):
                 stats.update(**s.dump_stats())
+        if self.ingest is not None: stats.update(**self.ingest.dump_stats())
         if self.setup["options"]["poll_errors"]: 
-            self.transmit({"bus": 5, "id": 1, "fd": False, "data": b""})
+            self.transmit(frames.CANFrame(5, 1, b""))
         return stats
 
 class MainWindow(tkinter.Tk):
@@ -201,8 +449,14 @@ class MainWindow(tkinter.Tk):
         self.stats_layout = [
             [["total_packets", "Total packets", "{} packets"], ["packet_rate", "Packet rate", "{:.4f} packets/s"]],
             [["total_bytes", "Total bytes", "{} B"], ["byte_rate", "Byte rate", "{:.4f} B/s"]],
-            [["total_time", "Total time", "{:.4f} s"], ["dash_backlog", "Backlog", "{} packets"]],
-            [["replay_backlog", "Replay backlog", "{:.4f}"], ["can_errors", "Total CAN errors", "{0[0]} arb, {0[1]} data, {0[2]} off, {0[3]} tx"]]
+            [["total_time", "Total time", "{:.4f} s"], ["dash_backlog", "Backlog", "{} IDs"]],
+            [["replay_backlog", "Replay backlog", "{:.4f}"], ["can_errors", "Total CAN errors", "{0[0]} arb, {0[1]} data, {0[2]} off, {0[3]} tx"]],
+            [["decode_hits", "Decode cache hits", "{}"], ["decode_misses", "Decode cache misses", "{}"]],
+            [["replay_position", "Replay position", "{:.2f} s"], ["log_dropped", "Dropped log packets", "{}"]],
+            [["dash_tick", "Dashboard refresh", "{:.2f} ms"], ["dash_rows", "Rows per refresh", "{:.1f}"]],
+            [["source_backlog", "Source backlog", "{} items"], ["tx_queue", "Transmit queue", "{} frames"]],
+            [["telemetry_lost", "Lost telemetry packets", "{}"], ["telemetry_dropped", "Dropped telemetry frames", "{}"]],
+            [["telemetry_rssi", "LoRa RSSI", "{} dBm"], ["telemetry_snr", "LoRa SNR", "{} dB"]],
         ]
         self.stats_elements = []
         self.stats_table.grid_columnconfigure(1, weight=1, minsize=100)
@@ -213,7 +467,10 @@ class MainWindow(tkinter.Tk):
         self.boot = None
 
         self.dash_targets = {}
-        self.dash_queue = queue.Queue()
+        self.dash_store = mcan_dash.FrameStore(lambda packet: self.inst.mux_page(packet.bus, packet.id, packet.data))
+        self.recorders = {}
+        self.tick_time = 0
+        self.ticks = 0
         
         self.ts = time.time()
 
@@ -228,58 +485,76 @@ class MainWindow(tkinter.Tk):
 
     def close(self):
         self.inst.close()
-        for d in self.dash_targets:
-            self.dash_targets[d].close()
+        for r in self.recorders.values():
+            if r is not None: r.close()
 
     def can_decode(self, packet, **kwargs):
-        if packet["bus"] not in self.inst.can_db: return None, {}
-        db = self.inst.can_db[packet["bus"]]
-        #if packet["id"]&0x1fffffff not in db._frame_id_to_message: return None, {}
-        i = (packet["id"]&0x1fffffff) | ((packet["id"]&0x40000000)<<1)
+        plan = self.inst.decode_plan(packet["bus"], packet["id"], True)
+        if plan is None: return None, {}
+        decoded = packet.get("decoded")
+        if decoded is not None and not kwargs:
+            # Decoded by an ingest worker, without choices
+            return plan[0], plan[3](decoded) if plan[3] is not None else decoded
+        if not plan[4](packet["data"]): return None, {}
+        return plan[0], plan[2](packet["data"], **kwargs)
+
+    def make_recorder(self, target):
+        options = self.inst.setup["options"]
         try:
-            return db.get_message_by_frame_id(i), db.decode_message(i, packet["data"], **kwargs)
-        except:
-            return None, {}
-            print("Error decoding", packet)
-            print(" ".join(hex(x)[2:].rjust(2, "0") for x in packet["data"]))
-            raise
+            return recorder.Recorder("/tmp/log{}.{}".format(target, options["log_format"]), options["log_format"],
+                                     rotate_size=options["log_rotate_size"], rotate_time=options["log_rotate_time"])
+        except (OSError, ValueError) as e:
+            print("Not logging {}: {}".format(target, e))
+            return None
 
     def open_bootloader(self):
         self.boot = mcan_bootloader.BootloaderMenu(self.inst.boot_manager)
 
     def dash_update(self, packet, target):
-        self.dash_queue.put((packet, target))
+        if target not in self.recorders:
+            with self.dash_store.lock:
+                if target not in self.recorders: self.recorders[target] = self.make_recorder(target)
+        r = self.recorders[target]
+        if r is not None: r.record(packet)
+        self.dash_store.put(packet, target)
 
     def dash_func(self, target_or_rule):
         if isinstance(target_or_rule, str):
             source = f"""def send_to_dash(packet):\n    self.main_window.dash_update(packet, "{target_or_rule}")"""
         else:
-            source = f"""def send_to_dash(packet):\n    self.main_window.dash_update(packet, {target_or_rule}[packet["bus"]])"""
+            source = f"""def send_to_dash(packet):\n    self.main_window.dash_update(packet, {target_or_rule}[packet.bus])"""
         gl = {"self": self.inst}
         exec(source, gl)
         gl["send_to_dash"]._mcan_source = source
         return gl["send_to_dash"]
 
     def update_elements(self):
-        t0 = time.time()
-        modified = False
-        try:
-            while True:
-                packet, target = self.dash_queue.get_nowait()
-                if target not in self.dash_targets:
-                    self.dash_targets[target] = mcan_dash.CANDashboard(self, target, self.can_decode)
-                    self.notebook.add(self.dash_targets[target], text=target)
-                self.dash_targets[target].dash_update(packet)
-                modified = True
-        except queue.Empty: pass
-        if modified:
+        t0 = time.perf_counter()
+        entries = self.dash_store.drain()
+        for (target, bus, id), (packet, count, cycle, pages) in entries.items():
+            if target not in self.dash_targets:
+                self.dash_targets[target] = mcan_dash.CANDashboard(self, target, self.can_decode, self.inst.setup["options"]["virtual_dashboard"])
+                self.notebook.add(self.dash_targets[target], text=target)
+            self.dash_targets[target].dash_update(packet, count, cycle, pages)
+        if entries:
             for d in self.dash_targets:
                 self.dash_targets[d].update_elements()
+        self.tick_time += time.perf_counter() - t0
+        self.ticks += 1
         self.after(30, self.update_elements)
 
     def update_stats(self):
         stat = self.inst.dump_stats()
-        stat["dash_backlog"] = self.dash_queue.qsize()
+        stat["dash_backlog"] = len(self.dash_store)
+        stat["log_dropped"] = sum(r.dropped for r in self.recorders.values() if r is not None)
+        # Average cost of a dashboard refresh and rows rewritten per refresh since the last update
+        rows = sum(d.rows_updated for d in self.dash_targets.values())
+        for d in self.dash_targets.values(): d.rows_updated = 0
+        if self.ticks:
+            stat["dash_tick"] = 1000*self.tick_time/self.ticks
+            stat["dash_rows"] = rows/self.ticks
+        self.tick_time = 0
+        self.ticks = 0
         self.after(500, self.update_stats)
         if self.stats_elements == []:
             for rn, r in enumerate(self.stats_layout):
@@ -0,0 +1,201 @@
+import os
+import time
+import struct
+import threading
+import zlib
+
+from mcan import frames, logs
+
+PCAP_FILE_HEADER = b"\xd4\xc3\xb2\xa1\x02\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff\x00\x00\xe3\x00\x00\x00"
+PCAP_RECORD = struct.Struct("<4I")
+PCAP_CAN_HEAD = struct.Struct(">IBBxx")
+CF_RECORD = struct.Struct("<BBHI")
+CF_TIMESTAMP = struct.Struct("<BBHII")
+RING_SIZE = 1 << 22
+
+
+class Recorder:
+    """Writes received frames.CANFrames to a .pcap or .zcf log on a background thread
+
+    record() only copies the packet into a preallocated ring buffer, the
+    writer thread empties the ring every flush_interval seconds (or when it
+    is half full) with a few large writes. Packets that do not fit into the
+    ring are dropped and counted. record() can be called from several
+    threads. With rotate_size (bytes) or rotate_time
+    (seconds) the log is split into numbered files. zcf logs are compressed
+    on the writer thread, their timestamps start at the MSBs of the first
+    packet like the logger's. About every index_interval seconds of log time
+    the compressor is fully flushed so reading can restart there, the restart
+    points are saved in the index sidecar (see logs.LogIndex) when the file is
+    closed.
+    """
+    def __init__(self, fname, format="pcap", ring_size=RING_SIZE, rotate_size=None, rotate_time=None, flush_interval=0.5,
+                 index_interval=logs.INDEX_INTERVAL):
+        self.fname = fname
+        self.format = format
+        if format not in ("pcap", "zcf"): raise ValueError("Unknown log format: {}".format(format))
+        self.ring = bytearray(ring_size)
+        self.view = memoryview(self.ring)
+        # Total bytes written into and taken out of the ring
+        self.head = 0
+        self.tail = 0
+        self.msb = None
+        # (head, timestamp MSBs at head), written at once so the writer sees a consistent pair
+        self.mark = (0, None)
+        self.tail_msb = None
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.flush_interval = flush_interval
+        self.index_interval = int(index_interval*1000000)
+        self.dropped = 0
+        self.file_count = 0
+        self.file = None
+        self.compressor = None
+        self.open()
+        self.running = True
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.record_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self):
+        if self.rotate_size is None and self.rotate_time is None: return self.fname
+        base, ext = os.path.splitext(self.fname)
+        return "{}-{:04d}{}".format(base, self.file_count, ext)
+
+    def open(self, msb=None):
+        self.file = open(self.path(), "wb")
+        self.file_count += 1
+        self.file_size = 0
+        self.file_time = time.time()
+        if self.format == "pcap":
+            self.file.write(PCAP_FILE_HEADER)
+            self.file_size = len(PCAP_FILE_HEADER)
+        else:
+            self.compressor = zlib.compressobj()
+            # What a reader of the file sees: its timestamp state, decompressed size and index points
+            self.file_state = frames.TimestampState()
+            self.raw_size = 0
+            self.points = []
+            self.end_ts = 0
+            # Every file starts with a timestamp frame so it can be read on its own
+            if msb is not None:
+                self.write_zcf(CF_TIMESTAMP.pack(frames.CF_TIMESTAMP_BUS, 4, 0, 0, msb))
+
+    def finish(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.close()
+        if self.format == "zcf" and self.points:
+            st = os.stat(self.file.name)
+            index = logs.LogIndex("zcf", self.points, self.points[0][0], self.end_ts, st.st_size, st.st_mtime)
+            try:
+                index.save(self.file.name + ".idx")
+            except OSError as e:
+                print("Could not save index {}: {}".format(self.file.name + ".idx", e))
+        self.file = None
+
+    def put(self, record, n):
+        """Copy a record into the ring, returns False if it was dropped"""
+        size = len(self.ring)
+        if size - (self.head - self.tail) < n:
+            self.dropped += 1
+            self.wakeup.set()
+            return False
+        pos = self.head % size
+        if pos + n <= size:
+            self.ring[pos:pos+n] = record
+        else:
+            k = size - pos
+            self.ring[pos:] = record[:k]
+            self.ring[:n-k] = record[k:]
+        self.head += n
+        if self.head - self.tail > size//2: self.wakeup.set()
+        return True
+
+    def record(self, packet):
+        with self.record_lock:
+            self.pack(packet)
+
+    def pack(self, packet):
+        data = packet.data
+        ts = int(packet.ts)
+        if self.format == "pcap":
+            length = len(data) + 8
+            self.put(PCAP_RECORD.pack(ts//1000000, ts%1000000, length, length) + PCAP_CAN_HEAD.pack(packet.id, len(data), 0x04 if packet.fd else 0x00) + data, length + 16)
+            self.mark = (self.head, None)
+        else:
+            msb = (ts >> 16) & 0xffffffff
+            head = CF_RECORD.pack(packet.bus or 0, len(data) | (0x80 if packet.fd else 0), ts & 0xffff, packet.id)
+            if msb != self.msb:
+                head = CF_TIMESTAMP.pack(frames.CF_TIMESTAMP_BUS, 4, 0, 0, msb) + head
+            # A dropped timestamp frame has to be sent again with the next packet
+            if not self.put(head + data, len(head) + len(data)): return
+            self.msb = msb
+            self.mark = (self.head, self.msb)
+
+    def write(self, data):
+        if self.compressor is not None: data = self.compressor.compress(data)
+        self.file.write(data)
+        self.file_size += len(data)
+
+    def write_zcf(self, data):
+        state = self.file_state
+        point = [state.msb, state.offset, state.msb_loaded]
+        batch = frames.parse_cf(data, state)[0]
+        if len(batch):
+            ts = int(batch.ts[0])
+            if not self.points or ts >= self.points[-1][0] + self.index_interval:
+                restart = None
+                if self.raw_size:
+                    flushed = self.compressor.flush(zlib.Z_FULL_FLUSH)
+                    self.file.write(flushed)
+                    self.file_size += len(flushed)
+                    restart = self.file_size
+                self.points.append([ts, self.raw_size] + point + [restart])
+            self.end_ts = max(self.end_ts, int(batch.ts.max()))
+        self.write(data)
+        self.raw_size += len(data)
+
+    def flush(self):
+        with self.lock:
+            head, msb = self.mark
+            if self.file is None or head == self.tail: return
+            if (self.rotate_size is not None and self.file_size >= self.rotate_size) or \
+               (self.rotate_time is not None and time.time() - self.file_time >= self.rotate_time):
+                self.finish()
+                self.open(self.tail_msb)
+            size = len(self.ring)
+            start, end = self.tail % size, head % size
+            if self.format == "zcf":
+                self.write_zcf(bytes(self.view[start:]) + bytes(self.view[:end]) if end <= start else self.view[start:end])
+            elif end <= start:
+                self.write(self.view[start:])
+                self.write(self.view[:end])
+            else:
+                self.write(self.view[start:end])
+            self.tail = head
+            self.tail_msb = msb
+            self.file.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print("Error writing log {}: {}".format(self.fname, e))
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            if self.file is not None: self.finish()
+
+    def dump_stats(self):
+        return {"log_dropped": self.dropped, "log_backlog": self.head - self.tail}
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import collections
+
+from mcan import frames
+
+
+class SyncAdapter:
+    """Stands in for MCan in sources that run on their own thread, their frames are queued to the runtime"""
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def onrecv(self, packet):
+        self.runtime.put_threadsafe(packet)
+
+    def onrecv_batch(self, batch):
+        self.runtime.put_threadsafe(batch)
+
+    def __getattr__(self, name):
+        return getattr(self.runtime.inst, name)
+
+
+class Event:
+    """asyncio.Event that can be set from any thread"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+
+class SourceRuntime:
+    """Runs the sources on a single asyncio event loop
+
+    Sources with a run_async coroutine run as tasks on the loop, all others
+    keep their own thread and reach the loop through a SyncAdapter. Every
+    frame goes through one queue that is drained by a single consumer
+    callback, so the stream graph is only used from the loop thread and
+    frames are delivered in the order they were received.
+    """
+    def __init__(self, inst):
+        self.inst = inst
+        self.loop = None
+        self.queue = collections.deque()
+        self.scheduled = False
+        self.stopped = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.tasks = []
+        # Thread sources and the instance they had before they were given an adapter
+        self.adapted = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        self.ready.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.stopped = self.loop.create_future()
+        self.ready.set()
+        try:
+            self.loop.run_until_complete(self.stopped)
+            for task in self.tasks: task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+        finally:
+            self.loop.close()
+
+    def consume(self):
+        # Deliver everything that is queued, new items schedule the next call
+        self.scheduled = False
+        queue = self.queue
+        while queue:
+            item = queue.popleft()
+            if item is None:
+                if not self.stopped.done(): self.stopped.set_result(None)
+                return
+            if isinstance(item, (frames.CANFrame, dict)):
+                self.inst.onrecv(item)
+            else:
+                self.inst.onrecv_batch(item)
+
+    def put(self, item):
+        """Queue a packet or a batch, only from the loop thread"""
+        self.queue.append(item)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.consume)
+
+    def put_threadsafe(self, item):
+        self.loop.call_soon_threadsafe(self.put, item)
+
+    def event(self):
+        return Event(self.loop)
+
+    def add(self, source):
+        if hasattr(source, "run_async"):
+            self.loop.call_soon_threadsafe(self.spawn, source)
+        else:
+            self.adapted.append((source, source.inst))
+            source.inst = SyncAdapter(self)
+            source.start()
+
+    def remove(self, source):
+        """Give a stopped thread source its own instance back"""
+        for i, (s, inst) in enumerate(self.adapted):
+            if s is source:
+                source.inst = inst
+                del self.adapted[i]
+                return
+
+    def spawn(self, source):
+        task = self.loop.create_task(source.run_async(self))
+        task.add_done_callback(self.done)
+        self.tasks.append(task)
+
+    def done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print("Source failed: {!r}".format(task.exception()))
+
+    def qsize(self):
+        return len(self.queue)
+
+    def stop(self):
+        if self.thread is None: return
+        self.put_threadsafe(None)
+        self.thread.join()
+        self.thread = None
+        for source, inst in self.adapted: source.inst = inst
+        self.adapted = []
@@ -1,8 +1,10 @@
 import cantools
+import asyncio
 import time
 import math
 import threading
 import random
+import collections
 import socket
 import struct
 import serial
@@ -11,6 +13,8 @@ import select
 import os
 import sys
 
+from mcan import frames, logs, telemetry
+
 def read_cf(data):
     msb = 0
     offset = 0
@@ -24,7 +28,7 @@ def read_cf(data):
                 msb_loaded = True
                 offset = msb
         else:
-            yield i + (length & 0x7f) + 8, {"bus": bus, "id": id, "data": data[i+8:i+8+(length&0x7f)], "ts": ts+msb-offset, "fd": length>>7}
+            yield i + (length & 0x7f) + 8, frames.CANFrame(bus, id, data[i+8:i+8+(length&0x7f)], ts+msb-offset, length>>7)
         i += (length & 0x7f)+8
 
 class RandomFrames:
@@ -56,15 +60,15 @@ class RandomFrames:
                         i += 1
                         if (i % 6) == 0:
                             packet["BMS_Voltages_mux"] = (i//6)-1
-                            self.inst.onrecv({"bus": 2, "id": 702, "data": self.db.encode_message(702, packet), "ts": time.time()*1000000, "fd": False})
+                            self.inst.onrecv(frames.CANFrame(2, 702, self.db.encode_message(702, packet), time.time()*1000000, False))
                             packet = {}
                 tb = t
             unpacked = {"TireTemp_FL_Max": tv, "TireTemp_FR_Max": tv, "TireTemp_RL_Max": tv, "TireTemp_RR_Max": tv}
             data = self.db.encode_message(1874, unpacked)
-            self.inst.onrecv({"bus": 2, "id": 1874, "data": data, "ts": time.time()*1000000, "fd": False})
+            self.inst.onrecv(frames.CANFrame(2, 1874, data, time.time()*1000000, False))
             time.sleep(0.02)
             data = self.db.encode_message(1875, {"RotorTemp_FL_Max": tv, "RotorTemp_FR_Max": tv, "RotorTemp_RL_Max": tv, "RotorTemp_RR_Max": tv})
-            self.inst.onrecv({"bus": 2, "id": 1875, "data": data, "ts": time.time()*1000000, "fd": False})
+            self.inst.onrecv(frames.CANFrame(2, 1875, data, time.time()*1000000, False))
             time.sleep(random.random()*0.03 + 0.085)
 
     def run_fast(self):
@@ -72,68 +76,104 @@ class RandomFrames:
         n = 0
         while self.running:
             t = time.time() - t0
-            self.inst.onrecv({"bus": 2, "id": 505, "data": self.db.encode_message(505, {
+            self.inst.onrecv(frames.CANFrame(2, 505, self.db.encode_message(505, {
                 "VectorNav_VelNedN": 100*math.cos(t),
                 "VectorNav_VelNedE": -100*math.sin(t),
-            }), "ts": time.time()*1000000, "fd": False})
+            }), time.time()*1000000, False))
             time.sleep(0.005)
 
 class LoRATelemetry:
-    def __init__(self, inst, port):
+    """Receives frames from the car through an RYLR radio
+
+    Packets of the telemetry codec are decoded with zdict (bytes or a file
+    name), which has to be the dictionary the sender uses. Packets in the
+    old format are still understood. The serial port is read in chunks and
+    parsed incrementally, a read can hold any number of packets.
+    """
+    def __init__(self, inst, port, zdict=None):
         self.port = port
         self.running = True
         self.inst = inst
+        self.decoder = telemetry.TelemetryDecoder(zdict)
+        self.parser = telemetry.ATParser()
+        self.thread = None
+        self.rssi = None
+        self.snr = None
 
     def start(self):
-        self.s = serial.Serial(self.port, 115200)
-        self.s.write(b"AT+BAND=915000000,M\r\n")
-        print(self.s.readline())
-        self.s.write(b"AT+PARAMETER=5,9,1,4\r\n")
-        self.s.write(b"AT+NETWORKID=18\r\n")
-        self.s.write(b"AT+ADDRESS=6\r\n")
+        self.s = serial.Serial(self.port, 115200, timeout=telemetry.READ_TIMEOUT)
+        self.s.write("AT+BAND={},M\r\n".format(telemetry.LORA_BAND).encode())
+        self.s.write("AT+PARAMETER={},{},{},{}\r\n".format(*telemetry.LORA_PARAMETERS).encode())
+        self.s.write("AT+NETWORKID={}\r\n".format(telemetry.LORA_NETWORK_ID).encode())
+        self.s.write("AT+ADDRESS={}\r\n".format(telemetry.LORA_RECEIVER_ADDRESS).encode())
         self.running = True
-        threading.Thread(target=self.run).start()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
 
     def stop(self):
         self.running = False
+        if self.thread is not None: self.thread.join()
+        self.thread = None
         self.s.close()
 
+    def receive(self, address, data):
+        if data[:1] == bytes([telemetry.TELEMETRY_MAGIC]):
+            batch = self.decoder.decode(data)
+        else:
+            if address == telemetry.LORA_SENDER_ADDRESS:
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error:
+                    data = b""
+            batch = telemetry.parse_lora(data)
+        if batch is not None and len(batch): self.inst.onrecv_batch(batch)
+
     def run(self):
         while self.running:
-            l = self.s.readline()
-            if l.startswith(b"+OK"):
-                continue
-            if l.startswith(b"+ERR"):
-                pass
-                print("Received error from LoRA", l.decode())
-            if l.startswith(b"+RCV"):
-                ch, length, data = l.split(b",", 2)
-                length = int(length)
-                # use <= here since the data may end in a \n, but the trailing info must still be read
-                while len(data) <= length:
-                    data += self.s.readline()
-                data = data.rsplit(b",", 2)[0]
-                if ch == b"+RCV=8":
-                    try:
-                        data = zlib.decompress(data)
-                    except zlib.error:
-                        data = b""
-                i = 0
-                while i < len(data):
-                    bus, length, tsl, id, tsh = struct.unpack("<BBHHH", data[i:i+8])
-                    packet = {"bus": bus, "id": id, "data": data[i+8:i+8+(length&0x7f)], "ts": tsl | (tsh << 16), "fd": length>>7}
-                    self.inst.onrecv(packet)
-                    i += (length & 0x7f)+8
+            # Waits up to READ_TIMEOUT for the first byte, then takes everything that has arrived
+            data = self.s.read(min(self.s.in_waiting, telemetry.READ_SIZE) or 1)
+            for event in self.parser.feed(data):
+                if event[0] == "data":
+                    if len(event[3]) == 2: self.rssi, self.snr = int(event[3][0]), int(event[3][1])
+                    self.receive(event[1], event[2])
+                elif event[1].startswith(b"+ERR"):
+                    print("Received error from LoRA", event[1].decode())
+                elif not event[1].startswith(b"+OK"):
+                    print(event[1])
+
+    def dump_stats(self):
+        stats = self.decoder.dump_stats()
+        stats.update(telemetry_rssi=self.rssi, telemetry_snr=self.snr)
+        return stats
+
+
+# Packets a replay hands to the runtime at once
+REPLAY_BATCH = 256
 
 
 class Replay:
-    def __init__(self, inst, fname, bus=None, scale=1):
+    """Replays a .pcap or .zcf log in real time (slowed down by scale)
+
+    start and end limit the replay to a window in seconds from the start of
+    the log, the window is looped. seek, pause, resume and set_scale can be
+    called from any thread while the replay is running.
+    """
+    def __init__(self, inst, fname, bus=None, scale=1, start=0, end=None):
         self.fname = fname
         self.bus = bus
         self.scale = scale
+        self.start_time = start
+        self.end_time = end
         self.inst = inst
         self.backlog = 0
+        self.position = None
         self.running = True
+        self.paused = False
+        self.seek_target = None
+        self.resync = True
+        self.wakeup = threading.Event()
+        self.t0 = 0
+        self.ts0 = 0
     
     def start(self):
         self.running = True
@@ -141,162 +181,463 @@ class Replay:
 
     def stop(self):
         self.running = False
+        self.wakeup.set()
+
+    def seek(self, t):
+        """Continue the replay at t seconds from the start of the log"""
+        self.seek_target = t
+        self.wakeup.set()
+
+    def pause(self):
+        self.paused = True
+        self.wakeup.set()
+
+    def resume(self):
+        self.paused = False
+        self.resync = True
+        self.wakeup.set()
+
+    def set_scale(self, scale):
+        self.scale = scale
+        self.resync = True
+        self.wakeup.set()
+
+    def set_window(self, start=0, end=None):
+        self.start_time = start
+        self.end_time = end
+        self.seek(start)
+
+    def due(self, ts):
+        """Yield the time to wait until the packet at ts is due (None while paused), returns False if it should not be sent anymore"""
+        while self.running and self.seek_target is None:
+            if self.paused:
+                yield None
+                continue
+            if self.resync:
+                self.resync = False
+                self.ts0 = ts
+                self.t0 = time.time()
+                return True
+            t = (time.time() - self.t0)/self.scale + self.ts0
+            self.backlog = t - ts
+            if t >= ts: return True
+            yield self.scale*(ts - t)
+        return False
+
+    def steps(self, reader):
+        """Yield the packets to send and the waits between them"""
+        start = reader.index.start/1000000.0
+        while self.running:
+            t, self.seek_target = self.seek_target, None
+            if t is None: t = self.start_time
+            self.resync = True
+            for packet in reader.packets(int((start + t)*1000000)):
+                ts = packet["ts"]/1000000.0
+                if self.end_time is not None and ts - start > self.end_time: break
+                if not (yield from self.due(ts)): break
+                self.position = ts - start
+                yield packet
+            if self.running and self.seek_target is None: print("rolling over")
 
     def run(self):
-        t0 = 0
-        ts0 = 0
-        offset_ready = False
-        msb = 0
-        ext = os.path.splitext(self.fname)[1][1:]
-        if ext == "pcap":
-            with open(self.fname, "rb") as f:
-                head = f.read(24)
-                while self.running:
-                    head = f.read(16)
-                    if len(head) == 0:
-                        offset_ready = False
-                        f.seek(0)
-                        f.read(24)
-                        print("rolling over")
-                        continue
-                    sec, usec, length = struct.unpack("<3I", head[:12])
-                    ts = sec + usec / 1000000.0
-                    data = f.read(length)
-                    if offset_ready:
-                        t = (time.time() - t0)/self.scale + ts0
-                        self.backlog = t - ts
-                        if t < ts: time.sleep(self.scale*(ts - t))
-                    else:
-                        ts0 = ts
-                        t0 = time.time()
-                        offset_ready = True
-                    packet = {
-                        "id": struct.unpack(">I", data[:4])[0],
-                        "fd": data[5] > 0,
-                        "ts": ts*1000000,
-                        "data": data[8:],
-                        "bus": self.bus
-                    }
-                    self.inst.onrecv(packet)
-        elif ext == "zcf":
-            print("Replaying ZCF")
-            with open(self.fname, "rb") as f:
-                obj = zlib.decompressobj()
-                cont = obj.decompress(f.read())
-                zcf_iter = read_cf(cont)
-                while self.running:
-                    try:
-                        n, packet = next(zcf_iter)
-                    except StopIteration:
-                        print("rollong over")
-                        offset_ready = False
-                        zcf_iter = read_cf(cont)
-                        continue
-                    ts = packet["ts"] / 1000000.0
-                    if offset_ready:
-                        t = (time.time() - t0)/self.scale + ts0
-                        self.backlog = t - ts
-                        if t < ts: time.sleep(self.scale*(ts - t))
-                    else:
-                        ts0 = ts
-                        t0 = time.time()
-                        offset_ready = True
-                    self.inst.onrecv(packet)
+        reader = logs.LogReader(self.fname, self.bus)
+        try:
+            if reader.index.format == "zcf": print("Replaying ZCF")
+            for step in self.steps(reader):
+                if isinstance(step, frames.CANFrame):
+                    self.inst.onrecv(step)
+                else:
+                    self.wakeup.wait(step)
+                    self.wakeup.clear()
+        finally:
+            reader.close()
 
+    def take(self, steps, n=REPLAY_BATCH):
+        """Advance steps by up to n packets or until the first wait"""
+        taken = []
+        for step in steps:
+            taken.append(step)
+            if not isinstance(step, frames.CANFrame) or len(taken) >= n: break
+        return taken
+
+    async def run_async(self, runtime):
+        self.running = True
+        self.wakeup = runtime.event()
+        loop = asyncio.get_running_loop()
+        # Opening, indexing, reading and decompressing the log stay off the loop thread
+        reader = await loop.run_in_executor(None, logs.LogReader, self.fname, self.bus)
+        try:
+            if reader.index.format == "zcf": print("Replaying ZCF")
+            steps = self.steps(reader)
+            while True:
+                taken = await loop.run_in_executor(None, self.take, steps)
+                if not taken: break
+                if isinstance(taken[-1], frames.CANFrame):
+                    runtime.put(taken)
+                    continue
+                if len(taken) > 1: runtime.put(taken[:-1])
+                await self.wakeup.wait(taken[-1])
+        finally:
+            reader.close()
     
     def dump_stats(self):
-        return {"replay_backlog": self.backlog}
+        return {"replay_backlog": self.backlog, "replay_position": self.position}
 
     def dump(self):
         return {
             "type": "replay",
             "fname": self.fname,
             "bus": self.bus,
-            "scale": self.scale
+            "scale": self.scale,
+            "start": self.start_time,
+            "end": self.end_time
         }
 
+# Receive buffer of a source, the largest datagram expected from the logger and the socket's receive buffer
+RECV_BUFFER_SIZE = 1 << 18
+RECV_DATAGRAM_SIZE = 1500
+RECV_SOCKET_BUFFER = 1 << 22
+
+
+class CFReceiver:
+    """Receives the MCAN wire format into a preallocated buffer
+
+    receive() reads with recv_into until the socket would block, so all
+    datagrams that are waiting are parsed in one batch. parse() reads the
+    headers in place and copies the complete frames out of the buffer once,
+    into the buffer of the FrameBatch that keeps the payloads until a sink
+    asks for them, or only their payloads into a list of CANFrames if there
+    are fewer than frames.SMALL_BATCH. A trailing partial frame is moved to
+    the start of the buffer.
+    """
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.end = 0
+        self.ts_state = frames.TimestampState()
+
+    def receive(self, sock, datagrams=False):
+        """Read what is available on a non-blocking socket, returns False if a stream socket was closed"""
+        # Datagrams that do not fit into the rest of the buffer would be truncated
+        reserve = RECV_DATAGRAM_SIZE if datagrams else 1
+        while len(self.buf) - self.end >= reserve:
+            try:
+                n = sock.recv_into(self.view[self.end:])
+            except (BlockingIOError, InterruptedError):
+                break
+            if n == 0 and not datagrams: return False
+            self.end += n
+        return True
+
+    def parse(self):
+        batch, i = frames.parse_cf(self.view[:self.end], self.ts_state, small=frames.SMALL_BATCH)
+        rest = self.end - i
+        if rest: self.buf[:rest] = self.buf[i:self.end]
+        self.end = rest
+        return batch
+
+
+class CFProtocol(asyncio.BufferedProtocol):
+    """Parses frames in the MCAN wire format received over TCP on the runtime's event loop"""
+    def __init__(self, runtime, closed):
+        self.runtime = runtime
+        self.closed = closed
+        self.receiver = CFReceiver()
+
+    def get_buffer(self, sizehint):
+        return self.receiver.view[self.receiver.end:]
+
+    def buffer_updated(self, nbytes):
+        self.receiver.end += nbytes
+        batch = self.receiver.parse()
+        if len(batch): self.runtime.put(batch)
+
+    def connection_lost(self, exc):
+        if not self.closed.done(): self.closed.set_result(exc)
+
+
+# Transmit priorities, lower values are sent first
+TX_PRIORITY_HIGH = 0
+TX_PRIORITY_NORMAL = 1
+# Shortest wait of a rate limited bus so its frames go out together, the largest datagram and the frames a rate limited bus may send at once
+TX_WINDOW = 0.001
+TX_DATAGRAM_SIZE = 1472
+TX_BURST = 16
+
+
+class TransmitQueue:
+    """Coalesces transmitted frames into datagrams on a background thread
+
+    Frames are queued per priority and bus and sent as soon as their bus
+    may send, the frames put while a datagram is sent or while a bus waits
+    for its rate go into one datagram. Every datagram is filled with the high
+    priority frames first. rate limits the frames per second of each bus (a
+    number for all busses or a dict by bus) with bursts of up to TX_BURST
+    frames, frames of a bus over its rate stay queued for at least window
+    seconds without holding up the other busses.
+
+    stop drops the queued frames, put raises RuntimeError until start.
+    """
+    def __init__(self, send, rate=None, window=TX_WINDOW, size=TX_DATAGRAM_SIZE, burst=TX_BURST):
+        self.send = send
+        self.rate = rate
+        self.window = window
+        self.size = size
+        self.burst = burst
+        # Per priority: frames by bus
+        self.lanes = [{} for p in range(TX_PRIORITY_NORMAL + 1)]
+        # Per bus: [tokens, time of the last refill]
+        self.tokens = {}
+        self.depth = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        with self.cond: self.running = True
+
+    def put(self, frame, bus, priority=TX_PRIORITY_NORMAL):
+        with self.cond:
+            if not self.running: raise RuntimeError("Transmit queue is stopped")
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            q = self.lanes[priority].get(bus)
+            if q is None: q = self.lanes[priority][bus] = collections.deque()
+            q.append(frame)
+            self.depth += 1
+            self.cond.notify()
+
+    def bus_rate(self, bus):
+        if isinstance(self.rate, dict): return self.rate.get(bus)
+        return self.rate
+
+    def available(self, bus, now):
+        rate = self.bus_rate(bus)
+        if rate is None: return math.inf
+        t = self.tokens.get(bus)
+        if t is None: t = self.tokens[bus] = [self.burst, now]
+        t[0] = min(self.burst, t[0] + (now - t[1])*rate)
+        t[1] = now
+        return t[0]
+
+    def collect(self, now):
+        """Take the frames of the next datagram, returns them and the time until a rate limited bus can send again"""
+        parts = []
+        size = 0
+        wait = None
+        for priority, lane in enumerate(self.lanes):
+            for bus, q in lane.items():
+                if not q: continue
+                tokens = self.available(bus, now)
+                n = 0
+                while q and n + 1 <= tokens and size + len(q[0]) <= self.size:
+                    parts.append(q.popleft())
+                    size += len(parts[-1])
+                    n += 1
+                if tokens == math.inf: continue
+                self.tokens[bus][0] -= n
+                if q and n + 1 > tokens:
+                    # Wait at least a window so the frames of a rate limited bus are coalesced
+                    w = max((1 - self.tokens[bus][0])/self.bus_rate(bus), self.window)
+                    wait = w if wait is None else min(wait, w)
+        self.depth -= len(parts)
+        return parts, wait
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running: return
+                    if self.depth == 0:
+                        self.cond.wait()
+                        continue
+                    parts, wait = self.collect(time.monotonic())
+                    if parts: break
+                    self.cond.wait(wait)
+            try:
+                self.send(b"".join(parts))
+            except OSError as e:
+                print("Error transmitting: {}".format(e))
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None: self.thread.join()
+        with self.cond:
+            self.lanes = [{} for p in range(TX_PRIORITY_NORMAL + 1)]
+            self.depth = 0
+            self.thread = None
+
+    def dump_stats(self):
+        return {"tx_queue": self.depth}
+
+
 class MCAN_Ethernet:
-    def __init__(self, inst, ip, port, tcp=False):
+    """Receives from and transmits to the logger over UDP or TCP
+
+    Transmitted frames go through a TransmitQueue, tx_rate limits the frames
+    per second sent to each bus (see TransmitQueue). The UDP socket is only
+    made in udp_socket.
+    """
+    def __init__(self, inst, ip, port, tcp=False, tx_rate=None, tx_window=TX_WINDOW):
         self.ip = ip
         self.port = port
         self.inst = inst
         self.socket = None
+        self.bound = False
+        self.socket_lock = threading.RLock()
         self.running = True
         self.abortpipe_r = None
         self.abortpipe_w = None
         self.tcp = tcp
+        self.loop = None
+        self.transport = None
+        self.closed = None
+        # Bus numbers are strings in a loaded setup
+        self.tx_rate = {int(b): r for b, r in tx_rate.items()} if isinstance(tx_rate, dict) else tx_rate
+        self.tx_window = tx_window
+        self.tx = TransmitQueue(self.send, self.tx_rate, tx_window)
     
     def start(self):
+        self.running = True
+        self.tx.start()
         if self.tcp:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.ip, self.port))
         else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.bind(('0.0.0.0', 40000))
+            self.udp_socket(receive=True)
         self.socket.setblocking(0)
         if sys.platform == "linux":
             self.abortpipe_r, self.abortpipe_w = os.pipe()
-        threading.Thread(target=self.run).start()
+        threading.Thread(target=self.run, args=(self.socket, self.abortpipe_r)).start()
+
+    def udp_socket(self, receive=False):
+        """Return the UDP socket, made on first use
+
+        Receiving needs it bound to port 40000. Transmits before the source is
+        started, or of a source that receives in an ingest worker, get an
+        unbound socket, which receiving replaces with a bound one.
+        """
+        with self.socket_lock:
+            if receive and self.socket is not None and not self.bound:
+                self.socket.close()
+                self.socket = None
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.bound = receive
+                if receive:
+                    # Room for bursts while the receiving thread is busy
+                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_SOCKET_BUFFER)
+                    self.socket.bind(('0.0.0.0', 40000))
+            return self.socket
+
+    def close_socket(self):
+        with self.socket_lock:
+            if self.socket is not None: self.socket.close()
+            self.socket = None
 
     def stop(self):
         self.running = False
+        self.tx.stop()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.close_async)
+            return
         if self.abortpipe_w is not None:
             os.write(self.abortpipe_w, b"x")
             os.close(self.abortpipe_w)
-        self.socket.close()
+            self.abortpipe_w = None
+        self.close_socket()
 
-    def run(self):
-        msb = 0
-        offset = 0
-        msb_loaded = False
-        frame = b""
+    def run(self, sock, abortpipe):
+        # The socket and pipe of this run, a restarted source has new ones
+        receiver = CFReceiver()
         while self.running:
-            if self.abortpipe_r is not None:
-                rlist, wlist, xlist = select.select([self.socket, self.abortpipe_r], [], [])
+            if abortpipe is not None:
+                rlist, wlist, xlist = select.select([sock, abortpipe], [], [])
             else:
-                rlist, wlist, xlist = select.select([self.socket], [], [])
-            if self.abortpipe_r in rlist: break
-            frame += self.socket.recv(1500)
-            if len(frame) == 0:
-                self.socket.shutdown(socket.SHUT_RDWR)
+                rlist, wlist, xlist = select.select([sock], [], [])
+            if abortpipe in rlist: break
+            if not receiver.receive(sock, not self.tcp):
+                sock.shutdown(socket.SHUT_RDWR)
                 print("Socket closed!")
                 return
-            i = 0
-            while i+1 < len(frame) and i+(frame[i+1]&0x7f)+8 <= len(frame):
-                bus, length, ts, id = struct.unpack("<BBHI", frame[i:i+8])
-                if bus == 4:
-                    newmsb = struct.unpack("<I", frame[i+8:i+12])[0]<<16
-                    if newmsb < msb:
-                        print("Warning: backwards jump in timestamp packet ({} to {})".format(msb>>16, newmsb>>16))
-                        offset = newmsb - (msb - offset)
-                    elif not msb_loaded:
-                        msb_loaded = True
-                        offset = newmsb
-                    msb = newmsb
-                else:
-                    packet = {"bus": bus, "id": id, "data": frame[i+8:i+8+(length&0x7f)], "ts": ts+msb-offset, "fd": length>>7}
-                    self.inst.onrecv(packet)
-                i += (length & 0x7f)+8
-            frame = frame[i:]
-        if self.abortpipe_r is not None: os.close(self.abortpipe_r)
+            batch = receiver.parse()
+            if len(batch): self.inst.onrecv_batch(batch)
+        if abortpipe is not None: os.close(abortpipe)
+
+    async def run_async(self, runtime):
+        self.running = True
+        self.tx.start()
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        if self.tcp:
+            self.transport, protocol = await loop.create_connection(lambda: CFProtocol(runtime, self.closed), self.ip, self.port)
+        else:
+            # Datagrams are read by our own reader so all waiting datagrams go into one batch
+            self.udp_socket(receive=True)
+            self.socket.setblocking(0)
+            receiver = CFReceiver()
+            loop.add_reader(self.socket, self.datagrams_ready, runtime, receiver)
+        self.loop = loop
+        try:
+            await self.closed
+        finally:
+            self.close_async()
+            self.loop = None
+        if self.running: print("Socket closed!")
+
+    def datagrams_ready(self, runtime, receiver):
+        try:
+            receiver.receive(self.socket, True)
+        except OSError as e:
+            print("Socket error: {}".format(e))
+        batch = receiver.parse()
+        if len(batch): runtime.put(batch)
+
+    def close_async(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        elif self.socket is not None:
+            self.loop.remove_reader(self.socket)
+            self.close_socket()
+        if not self.closed.done(): self.closed.set_result(None)
+
+    def send(self, frame):
+        if self.tcp:
+            if self.transport is not None:
+                self.loop.call_soon_threadsafe(self.transport.write, frame)
+            elif self.socket is not None:
+                self.socket.sendall(frame)
+            else:
+                raise OSError("Not connected to {}:{}".format(self.ip, self.port))
+            return
+        # Under the lock so receiving doesn't replace the socket while it sends
+        with self.socket_lock:
+            self.udp_socket().sendto(frame, (self.ip, self.port))
 
     def transmit(self, packet):
         #print("transmit", packet)
         frame = struct.pack("<BBHI", packet["bus"], (0x80 if packet["fd"] else 0) | (len(packet["data"])), 0, packet["id"])+packet["data"]
-        self.socket.sendto(frame, (self.ip, self.port))
+        self.tx.put(frame, packet["bus"], packet.get("priority", TX_PRIORITY_NORMAL))
 
     def transmit_multiple(self, packets):
-        frame = b""
         for packet in packets:
-            frame += struct.pack("<BBHI", packet["bus"], (0x80 if packet["fd"] else 0) | (len(packet["data"])), 0, packet["id"])+packet["data"]
-        self.socket.sendto(frame, (self.ip, self.port))
+            self.transmit(packet)
+
+    def dump_stats(self):
+        return self.tx.dump_stats()
 
     def dump(self):
         return {
             "type": "ip",
             "tcp": self.tcp,
             "ip": self.ip,
-            "port": self.port
+            "port": self.port,
+            "tx_rate": self.tx_rate,
+            "tx_window": self.tx_window
         }
 
 
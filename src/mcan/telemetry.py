@@ -0,0 +1,555 @@
+import os
+import math
+import time
+import select
+import zlib
+import struct
+import threading
+import collections
+
+import numpy as np
+import serial
+
+from mcan import frames
+
+# Radio setup shared by both ends: spreading factor, bandwidth (9 = 500 kHz), coding rate (1 = 4/5) and preamble
+LORA_BAND = 915000000
+LORA_PARAMETERS = (5, 9, 1, 4)
+LORA_BANDWIDTHS = {7: 125000, 8: 250000, 9: 500000}
+LORA_NETWORK_ID = 18
+LORA_RECEIVER_ADDRESS = 6
+LORA_SENDER_ADDRESS = 8
+# Largest payload of an AT+SEND
+LORA_MAX_PAYLOAD = 240
+
+# First byte of a codec packet, zlib streams start with at most 0x78 and frames with a small bus number
+TELEMETRY_MAGIC = 0xca
+# magic, sequence number, key epoch and id of the preset dictionary, followed by a raw deflate stream of the body
+PACKET_HEADER = struct.Struct("<BBBH")
+# Body: number of frames and the timestamp the per-frame offsets are relative to, then the columns bus, length,
+# delta flag, 32 bit timestamp offset, id and the payloads. The payloads are stored byte by byte, first byte 0 of
+# all frames, then byte 1 and so on, which compresses better
+BODY_HEADER = struct.Struct("<Hq")
+# Packets per key epoch, every id is sent whole once per epoch and as a delta to that for the rest of it
+KEY_INTERVAL = 16
+ZDICT_SIZE = 4096
+# Compressions tried to find the number of frames that fill a packet
+ADAPT_STEPS = 4
+MAX_DATA = 64
+
+# Seconds a serial read waits for data, and bytes read at most at once
+READ_TIMEOUT = 0.05
+READ_SIZE = 4096
+# Longest "address,length," after the prefix of a framed response
+AT_MAX_HEADER = 16
+AT_LINE = 0
+AT_PAYLOAD = 1
+AT_TRAILER = 2
+
+# Header of a frame in the old LoRa format, a CF header with a 16 bit id and the timestamp MSBs after it
+LORA_HEADER = np.dtype([("bus", "u1"), ("length", "u1"), ("tsl", "<u2"), ("id", "<u2"), ("tsh", "<u2")])
+LORA_HEADER_SIZE = 8
+
+
+def lora_airtime(nbytes, parameters=LORA_PARAMETERS):
+    """Seconds on air of a packet of nbytes"""
+    sf, bw, cr, preamble = parameters
+    tsym = (1 << sf)/LORA_BANDWIDTHS[bw]
+    de = 1 if tsym > 0.016 else 0
+    symbols = 8 + max(math.ceil((8*nbytes - 4*sf + 28 + 16)/(4*(sf - 2*de)))*(cr + 4), 0)
+    return (preamble + 4.25)*tsym + symbols*tsym
+
+
+def xor(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def byte_positions(lengths):
+    """Return the frame and the position within the frame of every payload byte"""
+    starts = np.zeros(len(lengths), np.intp)
+    if len(lengths): np.cumsum(lengths[:-1], out=starts[1:])
+    f = np.repeat(np.arange(len(lengths)), lengths)
+    return starts, f, np.arange(len(f)) - np.repeat(starts, lengths)
+
+
+def dict_id(zdict):
+    return zlib.crc32(zdict) & 0xffff
+
+
+def parse_lora(data):
+    """Parse the frames of an old format packet into a FrameBatch"""
+    offsets, end = frames.scan_cf(data)
+    if not offsets: return frames.empty_batch(data)
+    idx = np.array(offsets, dtype=np.intp)
+    head = np.frombuffer(data, dtype=np.uint8)[idx[:, None] + np.arange(LORA_HEADER_SIZE)].view(LORA_HEADER).ravel()
+    ts = head["tsl"].astype(np.int64) | (head["tsh"].astype(np.int64) << 16)
+    length = head["length"]
+    return frames.FrameBatch(data, head["bus"], head["id"].astype(np.uint32), length & 0x7f, length >> 7, ts, idx + LORA_HEADER_SIZE)
+
+
+def dbc_frames(db, bus):
+    """One frame per message of a cantools database with all signals at 0, as samples for build_zdict"""
+    packets = []
+    for message in db.messages:
+        try:
+            data = message.encode({s.name: 0 for s in message.signals}, scaling=False, strict=False)
+        except Exception:
+            data = bytes(message.length)
+        id = message.frame_id | (1<<30) if message.is_extended_frame else message.frame_id
+        packets.append(frames.CANFrame(bus, id, data, 0, 1 if message.length > 8 else 0))
+    return packets
+
+
+def build_zdict(samples, size=ZDICT_SIZE, batch=64, **kwargs):
+    """Build a preset dictionary from sample traffic (a log, or dbc_frames of the DBCs)
+
+    The samples are encoded like the sender would, kwargs are passed to the
+    TelemetryEncoder, and the last size bytes of the packet bodies are used.
+    Both ends need the same dictionary, build it once and save it to a file.
+    """
+    encoder = TelemetryEncoder(**kwargs)
+    bodies = []
+    for i, packet in enumerate(samples):
+        encoder.put(packet)
+        if i % batch == batch - 1:
+            while encoder.packet(): bodies.append(encoder.last_body)
+    while encoder.packet(): bodies.append(encoder.last_body)
+    return b"".join(bodies)[-size:]
+
+
+def load_zdict(zdict):
+    """Return a dictionary given as bytes or a file name"""
+    if zdict is None: return b""
+    if isinstance(zdict, str):
+        with open(zdict, "rb") as f:
+            return f.read()
+    return bytes(zdict)
+
+
+class TelemetryEncoder:
+    """Sender side of the telemetry codec
+
+    Frames are queued by priority (lower first) and only the newest frame of
+    an id is kept, so a busy link sends fresh values instead of a backlog.
+    decimate keeps every n-th frame of an id, priority None drops an id.
+    Both map (bus, id) or just id to a value. Packets are grouped into
+    epochs of key_interval packets, the first frame of an id in an epoch
+    (and one after a length change) is sent whole, the rest as the XOR with
+    it. A lost packet only costs the deltas of the ids keyed in it, until
+    the next epoch.
+    packet() fills a packet of at most max_size bytes with as many frames as
+    compress into it.
+    """
+    def __init__(self, zdict=b"", max_size=LORA_MAX_PAYLOAD, priority=None, decimate=None, key_interval=KEY_INTERVAL, level=9):
+        self.zdict = load_zdict(zdict)
+        self.dict_id = dict_id(self.zdict)
+        self.max_size = max_size
+        self.priority = priority or {}
+        self.decimate = decimate or {}
+        self.key_interval = key_interval
+        self.level = level
+        self.rules = {}
+        self.pending = {}
+        self.counts = collections.Counter()
+        self.key_frames = {}
+        self.number = 0
+        self.hint = 16
+        self.last_body = b""
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def rule(self, key):
+        rule = self.rules.get(key)
+        if rule is None:
+            prio = self.priority.get(key, self.priority.get(key[1], 0))
+            rule = self.rules[key] = (prio, self.decimate.get(key, self.decimate.get(key[1], 1)))
+        return rule
+
+    def put(self, packet):
+        key = (packet["bus"], packet["id"])
+        prio, n = self.rule(key)
+        if prio is None: return
+        with self.lock:
+            self.counts[key] += 1
+            if self.counts[key] % n:
+                self.stats["decimated"] += 1
+                return
+            queue = self.pending.get(prio)
+            if queue is None:
+                queue = self.pending[prio] = collections.OrderedDict()
+                self.pending = dict(sorted(self.pending.items()))
+            if key in queue: self.stats["replaced"] += 1
+            queue[key] = packet
+            self.stats["queued"] += 1
+
+    def put_batch(self, batch):
+        for packet in batch: self.put(packet)
+
+    def reference(self, key, data):
+        """Return the key frame data is sent as a delta to, None to send it whole"""
+        ref = self.key_frames.get(key)
+        if ref is None or len(ref[0]) != len(data) or ref[1] != self.number//self.key_interval: return None
+        return ref[0]
+
+    def body(self, packets):
+        ts = [p["ts"] for p in packets]
+        base = min(ts)
+        kinds = bytearray(len(packets))
+        payloads = []
+        for i, p in enumerate(packets):
+            key = (p["bus"], p["id"])
+            data = p["data"]
+            ref = self.reference(key, data)
+            if ref is not None:
+                kinds[i] = 1
+                data = xor(data, ref)
+            payloads.append(data)
+        n = len(packets)
+        lengths = np.fromiter(map(len, payloads), np.intp, n)
+        starts, f, j = byte_positions(lengths)
+        data = np.frombuffer(b"".join(payloads), np.uint8)[np.lexsort((f, j))]
+        return b"".join([BODY_HEADER.pack(n, base),
+                         bytes(p["bus"] for p in packets),
+                         bytes(len(p["data"]) | (0x80 if p["fd"] else 0) for p in packets),
+                         bytes(kinds),
+                         struct.pack("<{}I".format(n), *[min(t - base, 0xffffffff) for t in ts]),
+                         struct.pack("<{}I".format(n), *[p["id"] for p in packets]),
+                         data.tobytes()])
+
+    def compress(self, body):
+        if self.zdict:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, self.zdict)
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9)
+        return c.compress(body) + c.flush()
+
+    def packet(self):
+        """Return the next packet, or None if nothing is queued"""
+        with self.lock:
+            candidates = [p for queue in self.pending.values() for p in queue.values()]
+            if not candidates: return None
+            budget = self.max_size - PACKET_HEADER.size
+            # Start from the number of frames that filled the last packet and correct by the compression ratio
+            k = min(len(candidates), self.hint)
+            best = None
+            bad = len(candidates) + 1
+            for i in range(ADAPT_STEPS):
+                body = self.body(candidates[:k])
+                data = self.compress(body)
+                if len(data) <= budget:
+                    best = (k, body, data)
+                    if k + 1 >= bad or k == len(candidates): break
+                    k = min(max(k + 1, k*budget//len(data)), bad - 1, len(candidates))
+                else:
+                    bad = k
+                    if k == 1: break
+                    k = max(min(k - 1, k*budget//len(data)), best[0] + 1 if best else 1)
+                    if best is not None and k >= bad: break
+            if best is None:
+                k = 1
+                body = self.body(candidates[:1])
+                best = (1, body, self.compress(body))
+            k, body, data = best
+            self.hint = max(k, 1)
+            for p in candidates[:k]:
+                key = (p["bus"], p["id"])
+                prio = self.rule(key)[0]
+                del self.pending[prio][key]
+                epoch = self.number//self.key_interval
+                if self.reference(key, p["data"]) is None: self.key_frames[key] = (p["data"], epoch)
+            packet = PACKET_HEADER.pack(TELEMETRY_MAGIC, self.number & 0xff, epoch & 0xff, self.dict_id) + data
+            self.number += 1
+            self.last_body = body
+            self.stats["packets"] += 1
+            self.stats["sent"] += k
+            self.stats["bytes"] += len(packet)
+            return packet
+
+    def backlog(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+
+class TelemetryDecoder:
+    """Receiver side of the telemetry codec
+
+    The key frame of every id is kept in a table so the delta frames of a
+    packet are restored with a few array operations. Delta frames whose key
+    frame was lost are dropped until their id is sent whole again.
+    """
+    def __init__(self, zdict=b""):
+        self.zdict = load_zdict(zdict)
+        self.dict_id = dict_id(self.zdict)
+        self.seq = None
+        self.keys = np.zeros(0, np.uint64)
+        self.order = np.zeros(0, np.intp)
+        self.table = np.zeros((0, MAX_DATA), np.uint8)
+        self.length = np.zeros(0, np.uint8)
+        # Epoch of each key frame, -1 before the first
+        self.key_epoch = np.zeros(0, np.int16)
+        self.packets = 0
+        self.frames = 0
+        self.lost = 0
+        self.dropped = 0
+        self.errors = 0
+        self.warned = False
+
+    def rows(self, keys):
+        """Return the table rows of keys, unknown keys get a new row"""
+        new = np.setdiff1d(keys, self.keys)
+        if len(new):
+            self.keys = np.concatenate([self.keys, new])
+            self.order = np.argsort(self.keys, kind="stable")
+            self.table = np.concatenate([self.table, np.zeros((len(new), MAX_DATA), np.uint8)])
+            self.length = np.concatenate([self.length, np.zeros(len(new), np.uint8)])
+            self.key_epoch = np.concatenate([self.key_epoch, np.full(len(new), -1, np.int16)])
+        return self.order[np.searchsorted(self.keys[self.order], keys)]
+
+    def decompress(self, data):
+        if self.zdict: return zlib.decompressobj(-15, self.zdict).decompress(data)
+        return zlib.decompressobj(-15).decompress(data)
+
+    def decode(self, payload):
+        """Return the frames of a packet as a FrameBatch, None if it is not a valid packet"""
+        if len(payload) < PACKET_HEADER.size: return None
+        magic, seq, epoch, did = PACKET_HEADER.unpack_from(payload)
+        if magic != TELEMETRY_MAGIC: return None
+        if did != self.dict_id:
+            if not self.warned: print("Telemetry packet uses a different dictionary ({:04x}, expected {:04x})".format(did, self.dict_id))
+            self.warned = True
+            self.errors += 1
+            return None
+        if self.seq is not None and seq != (self.seq + 1) & 0xff:
+            self.lost += (seq - self.seq - 1) & 0xff
+        self.seq = seq
+        try:
+            body = self.decompress(payload[PACKET_HEADER.size:])
+            n, base = BODY_HEADER.unpack_from(body)
+        except (zlib.error, struct.error):
+            self.errors += 1
+            return None
+        o = BODY_HEADER.size
+        if len(body) < o + 11*n:
+            self.errors += 1
+            return None
+        bus = np.frombuffer(body, np.uint8, n, o)
+        length = np.frombuffer(body, np.uint8, n, o + n)
+        delta = np.frombuffer(body, np.uint8, n, o + 2*n).astype(bool)
+        ts = np.frombuffer(body, "<u4", n, o + 3*n).astype(np.int64) + base
+        id = np.frombuffer(body, "<u4", n, o + 7*n)
+        o += 11*n
+        lengths = length & 0x7f
+        starts, f, j = byte_positions(lengths)
+        total = len(f)
+        if len(body) < o + total:
+            self.errors += 1
+            return None
+        rows = self.rows((bus.astype(np.uint64) << np.uint64(32)) | id)
+        data = np.empty(total, np.uint8)
+        data[np.lexsort((f, j))] = np.frombuffer(body, np.uint8, total, o)
+        ok = ~delta | ((self.key_epoch[rows] == epoch) & (self.length[rows] == lengths))
+        # Key frames are from earlier packets, the sender sends an id at most once per packet
+        d = delta[f]
+        data[d] ^= self.table[rows[f[d]], j[d]]
+        k = ~d
+        self.table[rows[f[k]], j[k]] = data[k]
+        self.length[rows[~delta]] = lengths[~delta]
+        self.key_epoch[rows[~delta]] = epoch
+        batch = frames.FrameBatch(data.tobytes(), bus, id, lengths, length >> 7, ts, starts)
+        self.packets += 1
+        self.frames += n
+        if not ok.all():
+            self.dropped += int(n - ok.sum())
+            batch = batch.select(ok)
+        return batch
+
+    def dump_stats(self):
+        return {"telemetry_lost": self.lost, "telemetry_dropped": self.dropped}
+
+
+class ATParser:
+    """Incremental parser of the AT responses of an RYLR radio
+
+    feed() takes whatever was read and returns the complete responses in
+    it, the rest is buffered until the next call. Responses that start with
+    prefix ("+RCV=address,length,payload,rssi,snr") carry binary payloads
+    of the given length that may contain line breaks, they are returned as
+    ("data", address, payload, [trailing fields]), all other lines as
+    ("line", line).
+    """
+    def __init__(self, prefix=b"+RCV="):
+        self.prefix = prefix
+        self.buf = bytearray()
+        self.pos = 0
+        self.state = AT_LINE
+        self.address = 0
+        self.length = 0
+        self.payload = b""
+
+    def header(self):
+        """Parse the header of a framed response at pos, returns False if more data is needed"""
+        buf = self.buf
+        start = self.pos + len(self.prefix)
+        end = min(len(buf), start + AT_MAX_HEADER)
+        c1 = buf.find(b",", start, end)
+        c2 = buf.find(b",", c1 + 1, end) if c1 >= 0 else -1
+        if c2 < 0: return end - start == AT_MAX_HEADER or buf.find(b"\n", start, end) >= 0
+        try:
+            self.address, self.length = int(buf[start:c1]), int(buf[c1+1:c2])
+        except ValueError:
+            return True
+        self.pos = c2 + 1
+        self.state = AT_PAYLOAD
+        return True
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        events = []
+        while True:
+            if self.state == AT_LINE:
+                rest = len(buf) - self.pos
+                if rest < len(self.prefix) and self.prefix.startswith(buf[self.pos:]): break
+                if buf.startswith(self.prefix, self.pos):
+                    if not self.header(): break
+                    # A header that does not parse is handled as a line
+                    if self.state != AT_LINE: continue
+                nl = buf.find(b"\n", self.pos)
+                if nl < 0: break
+                line = bytes(buf[self.pos:nl]).rstrip(b"\r")
+                self.pos = nl + 1
+                if line: events.append(("line", line))
+            elif self.state == AT_PAYLOAD:
+                if len(buf) - self.pos < self.length: break
+                self.payload = bytes(buf[self.pos:self.pos+self.length])
+                self.pos += self.length
+                self.state = AT_TRAILER
+            else:
+                nl = buf.find(b"\n", self.pos)
+                if nl < 0: break
+                events.append(("data", self.address, self.payload, bytes(buf[self.pos:nl]).rstrip(b"\r").split(b",")[1:]))
+                self.pos = nl + 1
+                self.state = AT_LINE
+        # Drop the parsed data once it is most of the buffer, so removing it is cheap on average
+        if self.pos > len(buf)//2:
+            del buf[:self.pos]
+            self.pos = 0
+        return events
+
+
+class FakeRadio:
+    """RYLR radio on a pseudo terminal, for running the serial sources without hardware
+
+    port is the path of the terminal to open. Commands are answered with
+    +OK, receive() delivers a packet as +RCV. Packets sent with AT+SEND go
+    to peer, another FakeRadio, if there is one. chunk splits what is
+    written into pieces of that many bytes to exercise partial reads.
+    """
+    def __init__(self, address=LORA_RECEIVER_ADDRESS, peer=None, rssi=-40, snr=10, chunk=None):
+        # Pseudo terminals are POSIX only, importing tty here keeps the module importable on Windows
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.address = address
+        self.peer = peer
+        self.rssi = rssi
+        self.snr = snr
+        self.chunk = chunk
+        self.parser = ATParser(b"AT+SEND=")
+        self.commands = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def write(self, data):
+        with self.lock:
+            step = self.chunk or len(data)
+            for i in range(0, len(data), step):
+                view = memoryview(data)[i:i+step]
+                while view:
+                    view = view[os.write(self.master, view):]
+
+    def receive(self, address, payload):
+        self.write("+RCV={},{},".format(address, len(payload)).encode() + payload + ",{},{}\r\n".format(self.rssi, self.snr).encode())
+
+    def run(self):
+        while self.running:
+            if not select.select([self.master], [], [], READ_TIMEOUT)[0]: continue
+            try:
+                data = os.read(self.master, READ_SIZE)
+            except OSError:
+                break
+            for event in self.parser.feed(data):
+                if event[0] == "data":
+                    if self.peer is not None: self.peer.receive(self.address, event[2])
+                else:
+                    self.commands.append(event[1])
+                    if event[1].startswith(b"AT+ADDRESS="): self.address = int(event[1][11:])
+                self.write(b"+OK\r\n")
+
+
+class TelemetrySender:
+    """Car side of the link, stands in for the logger
+
+    Takes the place of MCan for a source (e.g. a Replay of a log) and sends
+    its frames through an RYLR radio on port, a packet every interval
+    seconds (by default the airtime of a full packet).
+    """
+    def __init__(self, port, encoder=None, address=LORA_RECEIVER_ADDRESS, interval=None):
+        self.port = port
+        self.encoder = encoder if encoder is not None else TelemetryEncoder()
+        self.address = address
+        self.interval = interval if interval is not None else 1.25*lora_airtime(self.encoder.max_size)
+        self.running = False
+        self.thread = None
+        self.s = None
+
+    def onrecv(self, packet):
+        self.encoder.put(packet)
+
+    def onrecv_batch(self, batch):
+        self.encoder.put_batch(batch)
+
+    def start(self):
+        self.s = serial.Serial(self.port, 115200, timeout=0)
+        self.s.write("AT+BAND={},M\r\n".format(LORA_BAND).encode())
+        self.s.write("AT+PARAMETER={},{},{},{}\r\n".format(*LORA_PARAMETERS).encode())
+        self.s.write("AT+NETWORKID={}\r\n".format(LORA_NETWORK_ID).encode())
+        self.s.write("AT+ADDRESS={}\r\n".format(LORA_SENDER_ADDRESS).encode())
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        if self.s is not None: self.s.close()
+
+    def send(self, packet):
+        self.s.write("AT+SEND={},{},".format(self.address, len(packet)).encode() + packet + b"\r\n")
+
+    def run(self):
+        due = time.monotonic()
+        while self.running:
+            # The radio's +OK replies are not needed
+            if self.s.in_waiting: self.s.read(self.s.in_waiting)
+            packet = self.encoder.packet()
+            if packet is not None: self.send(packet)
+            due = max(due + self.interval, time.monotonic())
+            time.sleep(max(due - time.monotonic(), 0))
+
+    def dump_stats(self):
+        return {"telemetry_backlog": self.encoder.backlog()}
@@ -0,0 +1,287 @@
+import queue
+import threading
+import time
+import collections
+import contextlib
+import os
+import random
+import json
+import socket
+
+import pytest
+
+import mcan
+from mcan import frames, firmware, bootloader
+
+import mcan_bench
+import mcan_sim
+
+
+@pytest.fixture
+def manager(tmp_path):
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    sent = queue.Queue()
+    m.transmit = sent.put
+    bm = m.boot_manager
+    bm.onrecv(frames.CANFrame(1, (1<<30) | (1<<18), bytes(8), fd=True))
+    try:
+        yield bm, sent
+    finally:
+        bm.close()
+
+
+def test_responses_and_timeouts_from_threads(manager, capsys):
+    bm, sent = manager
+    nreads = 200
+    steps = []
+    errors = []
+    bm.on_error = errors.append
+
+    drain = threading.Event()
+    stepping = threading.Event()
+
+    def reads_gen(board):
+        for address in range(nreads):
+            yield bm.make_read(1, board, address, 8, 1)
+            steps.append(bm.boards[board]["last_packet"]["id"] & 0x7fff)
+            # The second answer arrives while the operation is stepped
+            stepping.set()
+            time.sleep(0.001)
+
+    def answer(address):
+        bm.onrecv(frames.CANFrame(1, (1<<30) | (1<<18) | (1<<16) | address, bytes(8), fd=True))
+
+    def respond():
+        # Answers a read once it was sent again, the second answer arrives after the timer thread ended the wait for it
+        first = set()
+        while True:
+            packet = sent.get()
+            if packet is None: return
+            address = packet["id"] & 0xffff
+            if address not in first:
+                first.add(address)
+                continue
+            try:
+                answer(address)
+                drain.set()
+                stepping.wait(1)
+                stepping.clear()
+                answer(address)
+            except Exception as e:
+                errors.append(e)
+
+    def time_out():
+        # Times out every read once, like the operation timer
+        timed_out = set()
+        while bm.boards[1]["op_generator"] is not None:
+            try:
+                waiting = bm.boards[1]["waiting"]
+                if waiting is not None and waiting[0]["id"] not in timed_out:
+                    timed_out.add(waiting[0]["id"])
+                    bm.operation_timeout(1)
+                if drain.wait(0.001):
+                    drain.clear()
+                    bm.drained(1)
+            except Exception as e:
+                errors.append(e)
+
+    responder = threading.Thread(target=respond)
+    responder.start()
+    bm.start_operation(1, reads_gen(1))
+    timer = threading.Thread(target=time_out)
+    timer.start()
+    timer.join(30)
+    sent.put(None)
+    responder.join(30)
+    assert errors == []
+    # onrecv prints the errors of the operations it steps
+    assert "Error" not in capsys.readouterr().out
+    assert bm.boards[1]["status"] == "done"
+    # Each read stepped the operation once, with its own answer
+    assert steps == list(range(nreads))
+
+
+
+def attach(target):
+    """Count the writes a simulated target is given and the answers to them, and note the writes whose read-back it corrupted"""
+    bm = target.inst.boot_manager
+    record = {"writes": collections.Counter(), "answers": collections.Counter(), "corrupted": set(), "inflight": 0}
+    transmit, respond = target.transmit, target.respond
+
+    def on_transmit(packet):
+        if packet["id"] & (1<<17) and not packet["id"] & (1<<16):
+            board = (packet["id"]>>18) & 0x7f
+            record["writes"][(board, packet["id"] & 0x7fff)] += 1
+            record["inflight"] = max(record["inflight"], len(bm.boards[board]["inflight"]))
+        transmit(packet)
+
+    def on_respond(board, packet):
+        response = respond(board, packet)
+        if packet["id"] & (1<<17) and not packet["id"] & (1<<16):
+            key = (board, packet["id"] & 0x7fff)
+            record["answers"][key] += 1
+            if response["data"][:len(packet["data"])] != bytes(packet["data"]): record["corrupted"].add(key)
+        return response
+    target.transmit = on_transmit
+    target.respond = on_respond
+    return record
+
+
+@pytest.fixture
+def image(tmp_path):
+    fname = str(tmp_path / "image.hex")
+    return fname, mcan_bench.make_ihex(fname, 4096)
+
+
+@pytest.mark.parametrize("window", [1, 8])
+def test_flash_window(image, window):
+    fname, data = image
+    m = mcan_bench.make_inst()
+    try:
+        target = mcan_sim.SimulatedTarget(m, latency=0.001)
+        record = attach(target)
+        with mcan_bench.simulated_boards(m, [target]):
+            assert mcan_bench.flash_image(m, fname, window) is not None
+        assert target.bank(1)[:len(data)] == data
+        assert record["inflight"] == window
+        assert len(record["writes"]) == len(data)//firmware.CHUNK_SIZE and set(record["writes"].values()) == {1}
+    finally:
+        m.boot_manager.close()
+
+
+def test_flash_errors(image):
+    # Lost frames, corrupted read-backs and answers that arrive after the write timed out
+    fname, data = image
+    m = mcan_bench.make_inst()
+    try:
+        target = mcan_sim.SimulatedTarget(m, latency=0.001, loss=0.05, corrupt=0.05, late=0.03, seed=2)
+        record = attach(target)
+        with mcan_bench.simulated_boards(m, [target]):
+            assert mcan_bench.flash_image(m, fname, 8) is not None
+        assert target.bank(1)[:len(data)] == data
+        lost = {key for key, n in record["writes"].items() if record["answers"][key] < n}
+        assert lost and record["corrupted"]
+        # Every write that was lost or read back wrong was sent again
+        assert all(record["writes"][key] > 1 for key in lost | record["corrupted"])
+    finally:
+        m.boot_manager.close()
+
+
+def test_program_all(tmp_path):
+    fname = str(tmp_path / "image.hex")
+    data = mcan_bench.make_ihex(fname, 8192)
+    m = mcan_bench.make_inst()
+    bm = m.boot_manager
+    try:
+        targets = [mcan_sim.SimulatedTarget(m, boards=(1, 2), bus=1, latency=0.001), mcan_sim.SimulatedTarget(m, boards=(3, 4), bus=2, latency=0.001)]
+        inflight = collections.Counter()
+        for target in targets:
+            transmit = target.transmit
+
+            def on_transmit(packet, target=target, transmit=transmit):
+                n = sum(len(bm.boards[b].get("inflight") or ()) for b in target.flash if bm.boards.get(b, {}).get("op_generator") is not None)
+                inflight[target.bus] = max(inflight[target.bus], n)
+                transmit(packet)
+            target.transmit = on_transmit
+        with mcan_bench.simulated_boards(m, targets) as boards:
+            # A window per board larger than the bus can take
+            for b in boards: bm.boards[b]["config"].update(program=fname, write_window=bootloader.BUS_WINDOW)
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                bm.program_all()
+                mcan_bench.wait_operations(bm, boards, 30)
+            assert [bm.boards[b]["status"] for b in boards] == ["done"]*4
+        # The programmed bank is running after the bank swap
+        assert all(t.bank(b, 0)[:len(data)] == data for t in targets for b in t.flash)
+        assert inflight == {1: bootloader.BUS_WINDOW, 2: bootloader.BUS_WINDOW}
+    finally:
+        bm.close()
+
+
+def test_delta(tmp_path):
+    old = mcan_bench.make_ihex(str(tmp_path / "old.hex"), 8192)
+    new = bytearray(old)
+    new[1000:1010] = bytes(10)
+    new[5000] ^= 0xff
+    mcan_bench.write_ihex(str(tmp_path / "new.hex"), new)
+    nchunks = len(old)//firmware.CHUNK_SIZE
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    m = mcan.MCan(str(config_dir), command_server=False)
+    try:
+        target = mcan_sim.SimulatedTarget(m, latency=0.001)
+        record = attach(target)
+        with mcan_bench.simulated_boards(m, [target]):
+            def flash(name):
+                record["writes"].clear()
+                assert mcan_bench.flash_image(m, str(tmp_path / name), delta=True) is not None
+                return sum(record["writes"].values())
+            # Without hashes of the bank all chunks are written
+            assert flash("old.hex") == nchunks and target.bank(1)[:len(old)] == old
+            assert flash("new.hex") == 2 and target.bank(1)[:len(new)] == new
+            assert flash("new.hex") == 0
+            # Another computer programmed the bank with another image, the hashes are stale
+            target.bank(1)[:len(old)] = random.Random(1).randbytes(len(old))
+            assert flash("new.hex") == nchunks and target.bank(1)[:len(new)] == new
+            m.boot_manager.page_hashes.clear()
+            assert flash("old.hex") == nchunks and target.bank(1)[:len(old)] == old
+    finally:
+        m.boot_manager.close()
+
+
+@pytest.mark.parametrize("contents", [None, "{}", "[1, 2]", "not json"])
+def test_delta_page_hashes_file(tmp_path, contents):
+    fname = str(tmp_path / "image.hex")
+    data = mcan_bench.make_ihex(fname, 4096)
+    if contents is not None: (tmp_path / bootloader.PAGE_HASHES).write_text(contents)
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    try:
+        target = mcan_sim.SimulatedTarget(m, latency=0.001)
+        record = attach(target)
+        with mcan_bench.simulated_boards(m, [target]):
+            assert mcan_bench.flash_image(m, fname, delta=True) is not None
+        assert target.bank(1)[:len(data)] == data
+        assert sum(record["writes"].values()) == len(data)//firmware.CHUNK_SIZE
+    finally:
+        m.boot_manager.close()
+
+
+@pytest.fixture
+def server(tmp_path):
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    bm = m.boot_manager
+    for board in (1, 2): bm.onrecv(frames.CANFrame(1, (1<<30) | (board<<18), bytes(8), fd=True))
+    bm.server = bootloader.CommandServer(bm, 0)
+    try:
+        yield bm.server
+    finally:
+        bm.close()
+
+
+def connect(server):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=10)
+    return sock, sock.makefile("rb")
+
+
+def test_server_pipelined(server):
+    sock, f = connect(server)
+    sock.sendall(b"status 1\nstatus 2\nstatus\n"*20)
+    for i in range(20):
+        assert [[b["board"] for b in json.loads(f.readline())["boards"]] for n in range(3)] == [[1], [2], [1, 2]]
+    sock.close()
+
+
+def test_server_malformed(server):
+    sock, f = connect(server)
+    other, other_f = connect(server)
+    sock.sendall(b"status 1\nflash 1\nstatus x\nprogram\nprogram one\nboot 9\n\xff\xfe\x00\nstatus 2\n")
+    replies = [json.loads(f.readline()) for i in range(8)]
+    assert [r["event"] for r in replies] == ["status"] + ["error"]*6 + ["status"]
+    assert replies[-1]["boards"][0]["board"] == 2
+    # A line that never ends drops its client, the others are still served
+    sock.sendall(b"x"*(bootloader.SERVER_MAX_LINE + 4096))
+    assert json.loads(f.readline())["error"] == "Line too long"
+    assert f.readline() == b""
+    other.sendall(b"status 1\n")
+    assert json.loads(other_f.readline())["boards"][0]["board"] == 1
+    sock.close()
+    other.close()
@@ -0,0 +1,59 @@
+from mcan import frames, mcan_main
+
+
+def make_packets():
+    return [frames.CANFrame(bus, id, bytes([i]), i) for i, (bus, id) in enumerate([(1, 0x10), (2, 0x10), (1, 0x20), (1, 0x7ff), (3, 0x10)])]
+
+
+def test_dispatch_table():
+    root = mcan_main.CANStream()
+    seen = {"bus1": [], "id10": [], "all": [], "called": []}
+    root.filter_range(0x10, 0x20, busses=[1]).exec(seen["bus1"].append)
+
+    def accept(bus, id):
+        seen["called"].append((bus, id))
+        return id == 0x10
+    root.filter_id(accept).exec(seen["id10"].append)
+    root.exec(seen["all"].append)
+    packets = make_packets()
+    for _ in range(3):
+        for p in packets: root.apply(p)
+    assert seen["bus1"] == [p for p in packets if p.bus == 1 and p.id <= 0x20]*3
+    assert seen["id10"] == [p for p in packets if p.id == 0x10]*3
+    assert seen["all"] == packets*3
+    # filter_id is called once per (bus, id) pair
+    assert sorted(seen["called"]) == sorted((p.bus, p.id) for p in packets)
+    assert set(root.dispatch) == {(p.bus, p.id) for p in packets}
+
+
+def test_branch_added_later():
+    root = mcan_main.CANStream()
+    first = []
+    stream = root.filter_id(lambda bus, id: bus == 1)
+    stream.exec(first.append)
+    packets = make_packets()
+    for p in packets: root.apply(p)
+    # Tables of the stream and its parents are rebuilt for the new branch
+    later = []
+    stream.filter_id(lambda bus, id: id == 0x20).exec(later.append)
+    for p in packets: root.apply(p)
+    assert later == [packets[2]]
+    assert first == [p for p in packets if p.bus == 1]*2
+    root.set_enabled(0, False)
+    for p in packets: root.apply(p)
+    assert later == [packets[2]]
+
+
+def test_dispatch_size():
+    root = mcan_main.CANStream()
+    out = []
+    root.filter_id(lambda bus, id: id & 1).exec(out.append)
+    for id in range(3*mcan_main.DISPATCH_SIZE): root.apply(frames.CANFrame(1, id, b"", 0))
+    assert len(root.dispatch) <= mcan_main.DISPATCH_SIZE
+    assert [p.id for p in out] == list(range(1, 3*mcan_main.DISPATCH_SIZE, 2))
+    # Batches through the key cache of a filter without a vectorized form
+    batch = frames.from_packets([frames.CANFrame(1, id, b"", 0) for id in range(3*mcan_main.DISPATCH_SIZE)])
+    out.clear()
+    root.apply_batch(batch)
+    assert len(root.key_cache) <= mcan_main.DISPATCH_SIZE
+    assert [p.id for p in out] == list(range(1, 3*mcan_main.DISPATCH_SIZE, 2))
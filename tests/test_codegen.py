@@ -0,0 +1,138 @@
+import os
+import math
+import random
+import struct
+
+import cantools
+import pytest
+
+import mcan
+from mcan import codegen
+
+DBC = os.path.join(os.path.dirname(__file__), "test.dbc")
+
+FLOAT_CHOICES = """VERSION ""
+
+
+NS_ :
+
+BS_:
+
+BU_: N
+
+BO_ 300 Float: 8 N
+ SG_ Value : 0|32@1- (1,0) [0|0] "" N
+ SG_ Gain : 32|32@1- (2,0) [0|0] "" N
+
+VAL_ 300 Value 3 "Three" 0 "Zero" ;
+VAL_ 300 Gain 2 "Two" ;
+SIG_VALTYPE_ 300 Value : 1;
+SIG_VALTYPE_ 300 Gain : 1;
+"""
+
+
+@pytest.fixture(scope="module")
+def db():
+    return cantools.database.load_file(DBC)
+
+
+def test_matches_cantools(db):
+    decoders = codegen.compile_database(db)
+    assert len(decoders) == len(db.messages)
+    assert codegen.verify_database(db, decoders, samples=200) == []
+
+
+def test_standard_and_extended_ids(db):
+    # Status and ExtStatus share frame_id 352
+    decoders = codegen.compile_database(db)
+    data = bytes(range(1, 9))
+    for message in (db.get_message_by_name("Status"), db.get_message_by_name("ExtStatus")):
+        assert decoders[codegen.database_id(message)](data) == message.decode(data)
+
+
+def test_choice_mapper(db):
+    rng = random.Random(0)
+    decoders = codegen.compile_database(db)
+    for message in db.messages:
+        mapper = codegen.choice_mapper(message)
+        if mapper is None: continue
+        for i in range(200):
+            data = rng.randbytes(message.length)
+            try:
+                expected = message.decode(data)
+            except Exception:
+                continue
+            assert mapper(decoders[codegen.database_id(message)](data, False)) == expected
+
+
+def test_decode_plan(db, tmp_path):
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    try:
+        m.load_file(1, DBC)
+        data = bytes(range(1, 9))
+        for id, name in ((352, "Status"), (352 | (1<<30), "ExtStatus")):
+            msg, frame_id, decode, mapper, check = m.decode_plan(1, id, True)
+            assert msg.name == name
+            assert decode(data) == db.get_message_by_name(name).decode(data)
+    finally:
+        m.boot_manager.close()
+
+
+def test_frame_checker(db):
+    rng = random.Random(0)
+    for message in db.messages:
+        check = codegen.frame_checker(message)
+        for i in range(500):
+            data = rng.randbytes(message.length + rng.choice((-1, 0, 0, 2)))
+            try:
+                message.decode(data)
+                valid = True
+            except Exception:
+                valid = False
+            assert check(data) == valid, (message.name, data)
+
+
+def test_decode_plan_reload(tmp_path):
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    try:
+        m.load_file(1, DBC)
+        data = bytes(range(1, 9))
+        packet = {"bus": 1, "id": 352, "data": data}
+        m.can_decode(packet)
+        assert packet["decoded"]["Mode"] == 5
+        # Options cantools takes are passed on
+        m.can_decode(packet, scaling=False)
+        assert packet["decoded"]["Mode"] == 2
+        # The cached plans are dropped when a DBC is loaded again
+        fname = tmp_path / "changed.dbc"
+        with open(DBC) as f:
+            fname.write_text(f.read().replace("8|4@1+ (2,1)", "8|4@1+ (3,1)"))
+        m.load_file(1, str(fname))
+        packet = {"bus": 1, "id": 352, "data": data}
+        m.can_decode(packet)
+        assert packet["message"] is m.can_db[1].get_message_by_name("Status")
+        assert packet["decoded"]["Mode"] == 7
+    finally:
+        m.boot_manager.close()
+
+
+def test_float_choices():
+    message = cantools.database.load_string(FLOAT_CHOICES).messages[0]
+    # Left to cantools
+    assert codegen.compile_message(message) is None
+    mapper = codegen.choice_mapper(message)
+    check = codegen.frame_checker(message)
+    for value in (3.0, 0.0, -0.0, 1.0, 3.5, 1e30, float("nan"), float("inf")):
+        data = struct.pack("<ff", value, value)
+        raw = message.decode(data, False)
+        mapped = mapper(raw)
+        if not math.isfinite(value):
+            assert not check(data)
+            assert math.isnan(mapped["Value"]) if math.isnan(value) else mapped["Value"] == value
+            continue
+        assert check(data)
+        if value.is_integer():
+            assert mapped == message.decode(data)
+        else:
+            # Not truncated to the choice of the integer part
+            assert mapped == raw
@@ -0,0 +1,96 @@
+import os
+import struct
+
+import pytest
+
+from mcan import firmware
+
+
+def ihex_record(type, address, data):
+    record = bytes([len(data)]) + struct.pack(">HB", address, type) + data
+    return ":{}{:02X}".format(record.hex().upper(), -sum(record) & 0xff)
+
+
+def make_elf(segments):
+    """ELF32 file with a PT_LOAD program header per (vaddr, paddr, data) segment"""
+    phoff = 52
+    offset = phoff + 32*len(segments)
+    headers = []
+    contents = []
+    for vaddr, paddr, data in segments:
+        headers.append(struct.pack("<8I", firmware.ELF_PT_LOAD, offset, vaddr, paddr, len(data), len(data) or 0x100, 5, 4))
+        contents.append(data)
+        offset += len(data)
+    ident = firmware.ELF_MAGIC + bytes([1, 1, 1]) + bytes(9)
+    header = struct.pack("<16sHHIIIIIHHHHHH", ident, 2, 40, 1, firmware.FLASH_BASE, phoff, 0, 0, 52, 32, len(segments), 40, 0, 0)
+    return header + b"".join(headers) + b"".join(contents)
+
+
+def test_build_image():
+    image = firmware.build_image([(firmware.FLASH_BASE + 4, b"\x01\x02"), (firmware.FLASH_BASE + 16, b"\x03"*8)])
+    assert image.start == firmware.FLASH_BASE
+    assert bytes(image.data) == b"\xff"*4 + b"\x01\x02" + b"\xff"*10 + b"\x03"*8
+    assert bytes(image.present) == b"\x01\x00\x01"
+    # Both segments are in the first CHUNK_SIZE block, the gap is written as 0xff
+    assert image.chunks == [(0, bytes(image.data))]
+
+
+@pytest.mark.parametrize("address, length", [
+    (firmware.FLASH_BASE - 8, 16),
+    (firmware.FLASH_BASE + firmware.FLASH_SIZE - 8, 16),
+    (0x20000000, 8),
+])
+def test_segment_outside_of_flash(address, length):
+    with pytest.raises(ValueError):
+        firmware.build_image([(firmware.FLASH_BASE, b"\x00"*8), (address, b"\x00"*length)])
+
+
+def test_whole_bank():
+    image = firmware.build_image([(firmware.FLASH_BASE, b"\x00"*firmware.FLASH_SIZE)])
+    assert len(image) == firmware.FLASH_SIZE
+
+
+def test_parse_ihex():
+    text = "\n".join([
+        ihex_record(4, 0, b"\x08\x00"),
+        ihex_record(0, 0x0010, b"\x01\x02\x03"),
+        # Extended segment address, replaces the linear base with 16*0x1000
+        ihex_record(2, 0, b"\x10\x00"),
+        ihex_record(0, 0x0004, b"\x04"),
+        ihex_record(1, 0, b""),
+        ihex_record(0, 0, b"\xff"),
+    ])
+    assert firmware.parse_ihex(text) == [(0x08000010, b"\x01\x02\x03"), (0x00010004, b"\x04")]
+    with pytest.raises(ValueError):
+        firmware.parse_ihex("garbage")
+
+
+def test_parse_elf():
+    raw = make_elf([(0x08000000, 0x08000000, b"\x11"*24),
+                    # .data runs in RAM and is loaded from FLASH, .bss has nothing in the file
+                    (0x20000000, 0x08000100, b"\x22"*8),
+                    (0x20000100, 0x20000100, b"")])
+    assert firmware.parse_elf(raw) == [(0x08000000, b"\x11"*24), (0x08000100, b"\x22"*8)]
+    image = firmware.parse_image(raw, "app.elf")
+    assert image.start == firmware.FLASH_BASE and len(image) == 0x108
+    assert image.chunks == [(0, b"\x11"*24), (0x20, b"\x22"*8)]
+
+
+def test_parse_image_formats():
+    data = bytes(range(40))
+    text = ihex_record(4, 0, b"\x08\x00") + "\n" + ihex_record(0, 0, data) + "\n" + ihex_record(1, 0, b"")
+    for raw, fname in ((data, "app.bin"), (text.encode(), "app.hex"), (text.encode(), "")):
+        image = firmware.parse_image(raw, fname)
+        assert image.start == firmware.FLASH_BASE and bytes(image.data) == data
+    with pytest.raises(ValueError):
+        firmware.parse_image(data, "app.txt")
+
+
+def test_load_image(tmp_path):
+    fname = str(tmp_path / "app.bin")
+    with open(fname, "wb") as f: f.write(b"\x01"*16)
+    image = firmware.load_image(fname)
+    assert firmware.load_image(fname) is image
+    with open(fname, "wb") as f: f.write(b"\x02"*24)
+    os.utime(fname, ns=(0, 1))
+    assert bytes(firmware.load_image(fname).data) == b"\x02"*24
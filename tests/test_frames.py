@@ -0,0 +1,124 @@
+import random
+import struct
+
+import numpy as np
+
+from mcan import frames
+
+
+def make_cf(nframes, seed=0):
+    """MCAN wire format with a timestamp frame every 16 frames, and the frames parsing it should return"""
+    rng = random.Random(seed)
+    parts = []
+    expected = []
+    first = None
+    for i in range(nframes):
+        if i % 16 == 0:
+            msb = 100 + i//16
+            if first is None: first = msb
+            parts.append(struct.pack("<BBHII", 4, 4, 0, 0, msb))
+        length = rng.choice((0, 3, 8, 64))
+        fd = length > 8
+        bus, id, ts = rng.choice((1, 2, 3)), rng.randrange(1 << 29), rng.randrange(1 << 16)
+        data = rng.randbytes(length)
+        parts.append(struct.pack("<BBHI", bus, length | (0x80 if fd else 0), ts, id) + data)
+        # The first timestamp frame sets the base of the timestamps
+        expected.append(frames.CANFrame(bus, id, data, ((msb - first) << 16) + ts, int(fd)))
+    return b"".join(parts), expected
+
+
+def test_parse_cf():
+    data, expected = make_cf(300)
+    batch, end = frames.parse_cf(data)
+    assert end == len(data)
+    assert isinstance(batch, frames.FrameBatch)
+    assert batch.packets() == expected
+
+
+def test_parse_cf_small():
+    data, expected = make_cf(20)
+    packets, end = frames.parse_cf(data, small=frames.SMALL_BATCH)
+    assert isinstance(packets, list)
+    assert end == len(data)
+    assert packets == expected
+    assert frames.parse_cf(data)[0].packets() == expected
+
+
+def test_parse_cf_chunks():
+    data, expected = make_cf(300)
+    state = frames.TimestampState()
+    packets = []
+    pending = b""
+    for i in range(0, len(data), 97):
+        pending += data[i:i+97]
+        batch, n = frames.parse_cf(pending, state, small=8)
+        packets.extend(batch)
+        pending = pending[n:]
+    assert pending == b""
+    assert packets == expected
+
+
+def test_parse_cf_buffer():
+    # A receive buffer with a partial frame at the end is parsed in place, the batch keeps a copy of the complete frames
+    data, expected = make_cf(300)
+    buf = bytearray(data + b"\x01\x08\x00" + bytes(1000))
+    for small in (0, 1000):
+        batch, end = frames.parse_cf(memoryview(buf)[:len(data) + 3], small=small)
+        assert end == len(data)
+        if not small: assert type(batch.buf) is bytes and len(batch.buf) == len(data)
+        buf[:len(data)] = bytes(len(data))
+        packets = batch if small else batch.packets()
+        assert packets == expected and all(type(p.data) is bytes for p in packets)
+        buf[:len(data)] = data
+
+
+def test_scan_cf():
+    data, expected = make_cf(50)
+    offsets, end = frames.scan_cf(data)
+    assert len(offsets) == 50 + 4
+    assert end == len(data)
+    # A frame cut anywhere after its first byte is left for the next call
+    last = offsets[-1]
+    for cut in range(last + 1, len(data)):
+        assert frames.scan_cf(data[:cut]) == (offsets[:-1], last)
+
+
+def test_empty():
+    batch, end = frames.parse_cf(b"\x01\x08")
+    assert len(batch) == 0 and end == 0
+
+
+def test_canframe_mapping():
+    frame = frames.CANFrame(1, 0x123, b"\x01\x02", 5)
+    assert frame["bus"] == 1 and frame["data"] == b"\x01\x02"
+    assert "decoded" not in frame and frame.get("decoded") is None
+    frame["decoded"] = {"A": 1}
+    frame["priority"] = 0
+    assert "decoded" in frame and frame["priority"] == 0
+    assert frame == {"bus": 1, "id": 0x123, "data": b"\x01\x02", "ts": 5, "fd": 0, "decoded": {"A": 1}, "priority": 0}
+    assert frames.as_frame({"bus": 1, "id": 2, "data": b"", "ts": 3, "fd": 0, "x": 4})["x"] == 4
+
+
+def test_from_packets_select():
+    data, expected = make_cf(40)
+    batch = frames.from_packets(expected)
+    assert batch.packets() == expected
+    mask = np.arange(len(batch)) % 3 == 0
+    assert batch.select(mask).packets() == expected[::3]
+
+
+def test_concat_batches():
+    data, expected = make_cf(300)
+    state = frames.TimestampState()
+    batches = []
+    pending = b""
+    for i in range(0, len(data), 500):
+        pending += data[i:i+500]
+        batch, n = frames.parse_cf(pending, state)
+        batches.append(batch)
+        pending = pending[n:]
+    joined = frames.concat_batches(iter(batches))
+    assert joined.packets() == expected
+    # Only the payloads are kept
+    assert len(joined.buf) == sum(len(p.data) for p in expected)
+    assert len(frames.concat_batches([])) == 0
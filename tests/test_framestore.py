@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("tkinter")
+from mcan import frames
+from mcan.mcan_dash import FrameStore
+
+
+def test_latest_frame_and_cycle():
+    store = FrameStore()
+    for ts in (0, 100, 250):
+        store.put(frames.CANFrame(1, 0x10, bytes([ts & 0xff]), ts), "main")
+    store.put(frames.CANFrame(2, 0x10, b"", 7), "main")
+    entries = store.drain()
+    packet, count, cycle, pages = entries[("main", 1, 0x10)]
+    assert (packet.ts, count, cycle, pages) == (250, 3, 150, None)
+    assert entries[("main", 2, 0x10)][1:] == [1, None, None]
+    assert len(store) == 0 and store.drain() == {}
+
+
+def test_mux_pages():
+    # The first byte is the multiplexer, every page keeps its own latest frame and count
+    store = FrameStore(page=lambda packet: packet.data[0])
+    sent = [(0, 0), (1, 10), (0, 20), (2, 30), (0, 40), (1, 50)]
+    for page, ts in sent:
+        store.put(frames.CANFrame(1, 0x20, bytes([page, ts]), ts), "main")
+    packet, count, cycle, pages = store.drain()[("main", 1, 0x20)]
+    assert (packet.ts, count, cycle) == (50, 6, 10)
+    assert {p: (e[0].ts, e[1], e[2]) for p, e in pages.items()} == {0: (40, 3, 20), 1: (50, 2, 40), 2: (30, 1, None)}
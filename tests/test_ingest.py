@@ -0,0 +1,24 @@
+import socket
+
+import mcan
+from mcan import frames, ingest, sources
+
+
+def test_stop_sources_taken_over(tmp_path):
+    m = mcan.MCan(str(tmp_path), command_server=False)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(10)
+    try:
+        source = sources.MCAN_Ethernet(m, "127.0.0.1", receiver.getsockname()[1])
+        p = ingest.ProcessIngest(m)
+        assert p.add(source)
+        # The source transmits after the worker took its receiving over
+        source.transmit(frames.CANFrame(1, 0x10, b"\x01", 0))
+        assert receiver.recv(1024)[8:] == b"\x01"
+        assert source.tx.thread is not None and source.socket is not None
+        p.stop()
+        assert source.tx.thread is None and source.socket is None
+    finally:
+        receiver.close()
+        m.boot_manager.close()
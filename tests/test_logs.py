@@ -0,0 +1,104 @@
+import os
+import random
+import zlib
+
+import cantools
+import numpy as np
+import pytest
+
+import mcan
+from mcan import frames, recorder, logs
+
+import mcan_bench
+
+DBC = os.path.join(os.path.dirname(__file__), "test.dbc")
+
+# Cell is in branches 0, 1 and 3 of the multiplexer
+EXTENDED_MUX = """VERSION ""
+
+
+NS_ :
+
+BS_:
+
+BU_: N
+
+BO_ 703 Cells: 8 N
+ SG_ Cells_mux M : 0|8@1+ (1,0) [0|3] "" N
+ SG_ Cell m0 : 8|16@1+ (0.001,0) [0|65] "V" N
+ SG_ Extra m2 : 24|8@1+ (1,0) [0|255] "" N
+
+SG_MUL_VAL_ 703 Cell Cells_mux 0-1, 3-3;
+"""
+
+
+def make_packets(dbcs, nframes, seed=0):
+    rng = random.Random(seed)
+    messages = [(bus, message) for bus, db in dbcs.items() for message in db.messages]
+    packets = []
+    for i in range(nframes):
+        bus, message = rng.choice(messages)
+        data = bytearray(rng.randbytes(message.length))
+        # Mostly valid multiplexer values
+        muxes = {"Cells": (0, 1, 2, 3, 3, 9), "BMS_Voltages": (0, 1, 2, 5), "Ext": (0x30, 0x30, 0x50)}
+        if message.name in muxes: data[0] = rng.choice(muxes[message.name])
+        id = message.frame_id | (1<<30 if message.is_extended_frame else 0)
+        packets.append(frames.CANFrame(bus, id, bytes(data), 1000*i))
+    return packets
+
+
+def expected_series(dbcs, packets):
+    series = {}
+    for p in packets:
+        message = dbcs[p.bus].get_message_by_frame_id((p.id & 0x1fffffff) | (0x80000000 if p.id & (1<<30) else 0))
+        try:
+            decoded = message.decode(p.data, decode_choices=False)
+        except Exception:
+            continue
+        for name, value in decoded.items():
+            ts, values = series.setdefault((p.bus, message.name, name), ([], []))
+            ts.append(p.ts)
+            values.append(value)
+    return series
+
+
+@pytest.mark.parametrize("format", ["zcf", "pcap"])
+def test_load_log_matches_cantools(tmp_path, format):
+    dbcs = {1: cantools.database.load_file(DBC), 2: cantools.database.load_string(EXTENDED_MUX)}
+    if format == "pcap":
+        # pcap files do not store the bus
+        dbcs = {1: dbcs[1]}
+    packets = make_packets(dbcs, 20000)
+    fname = str(tmp_path / ("log." + format))
+    r = recorder.Recorder(fname, format=format)
+    for p in packets: r.record(p)
+    r.close()
+
+    log = mcan.load_log(fname, dbcs, bus=1)
+    expected = expected_series(dbcs, packets)
+    # Signals of branches without valid frames have empty series
+    assert {key for key, series in log.series.items() if len(series)} == set(expected)
+    for key, (ts, values) in expected.items():
+        assert log[key].ts.tolist() == ts, key
+        assert np.allclose(log[key].values, values), key
+    if format == "zcf": assert len(log["Cell"]) > len(log["Extra"]) > 0
+
+
+def test_zcf_snapshots(tmp_path, monkeypatch):
+    # A ZCF log without restart points is seeked through the snapshots, the least recently used are dropped
+    monkeypatch.setattr(logs, "ZCF_SNAPSHOT_INTERVAL", 4*frames.ZCF_CHUNK_SIZE)
+    monkeypatch.setattr(logs, "ZCF_MAX_SNAPSHOTS", 4)
+    fname = str(tmp_path / "log.zcf")
+    with open(fname, "wb") as f: f.write(zlib.compress(mcan_bench.make_cf(100000)))
+    with open(fname, "rb") as f: packets = [p for b in frames.iter_zcf(f) for p in b]
+    index = logs.build_index(fname)
+    assert not index.restarts and len(index.snapshots) == 4
+    reader = logs.LogReader(fname, index=index)
+    try:
+        for target in (index.ts[len(index.ts)//2], index.ts[1], index.ts[-1], index.ts[len(index.ts)//3]):
+            assert next(reader.packets(target)) == next(p for p in packets if p["ts"] >= target)
+            assert len(index.snapshots) <= 4 and index.snapshot_offsets == sorted(index.snapshots)
+        # Seeking back to the start made a snapshot there that pushed out one of the end
+        assert index.snapshot_offsets[0] < index.points[1][1] + logs.ZCF_SNAPSHOT_INTERVAL
+    finally:
+        reader.close()
@@ -0,0 +1,90 @@
+import os
+import random
+
+from mcan import frames, logs, recorder
+
+
+def make_packets(nframes, step=1000, seed=0):
+    rng = random.Random(seed)
+    packets = []
+    ts = 5 << 16
+    for i in range(nframes):
+        ts += rng.randrange(step)
+        length = rng.choice((1, 8, 64))
+        packets.append(frames.CANFrame(rng.choice((1, 2)), rng.randrange(0x800), rng.randbytes(length), ts, int(length > 8)))
+    return packets
+
+
+def record(fname, packets, **kwargs):
+    r = recorder.Recorder(fname, **kwargs)
+    for i, p in enumerate(packets):
+        r.record(p)
+        if i % 500 == 499: r.flush()
+    r.close()
+    return r
+
+
+def test_pcap(tmp_path):
+    fname = str(tmp_path / "log.pcap")
+    packets = make_packets(2000)
+    record(fname, packets)
+    # pcap files do not store the bus
+    expected = [frames.CANFrame(7, p.id, p.data, p.ts, p.fd) for p in packets]
+    assert logs.read_log(fname, 7).packets() == expected
+    reader = logs.LogReader(fname, bus=7)
+    if reader.builder is not None: reader.builder.join()
+    assert list(reader.packets()) == expected
+    start = packets[1500].ts
+    assert list(reader.packets(start)) == [p for p in expected if p.ts >= start]
+    reader.close()
+
+
+def test_zcf(tmp_path):
+    fname = str(tmp_path / "log.zcf")
+    packets = make_packets(5000)
+    record(fname, packets, format="zcf", index_interval=0.1)
+    # Timestamps start at the MSBs of the first packet
+    base = packets[0].ts >> 16 << 16
+    expected = [frames.CANFrame(p.bus, p.id, p.data, p.ts - base, p.fd) for p in packets]
+    assert logs.read_log(fname).packets() == expected
+
+    # Points are only added where a flush starts, one restart point per flush after the first
+    index = logs.find_index(fname)
+    assert index is not None and len(index.restarts) == 9
+    reader = logs.LogReader(fname)
+    assert reader.builder is None
+    assert list(reader.packets()) == expected
+    for i in (0, 1234, 2500, 4999):
+        start = expected[i].ts
+        assert list(reader.packets(start)) == [p for p in expected if p.ts >= start]
+    reader.close()
+
+
+def test_zcf_without_sidecar(tmp_path):
+    fname = str(tmp_path / "log.zcf")
+    packets = make_packets(3000)
+    record(fname, packets, format="zcf", index_interval=0.1)
+    os.remove(fname + ".idx")
+    reader = logs.LogReader(fname)
+    reader.builder.join()
+    built = logs.find_index(fname)
+    assert built is not None and built.restarts == []
+    start = reader.index.points[len(reader.index.points)//2][0]
+    assert [p.ts for p in reader.packets(start)] == [p.ts - (packets[0].ts >> 16 << 16) for p in packets if p.ts - (packets[0].ts >> 16 << 16) >= start]
+    reader.close()
+
+
+def test_dropped_timestamp(tmp_path):
+    # A timestamp frame dropped with its packet is written with the next packet
+    fname = str(tmp_path / "log.zcf")
+    r = recorder.Recorder(fname, format="zcf", ring_size=256, flush_interval=60)
+    # Holding the lock keeps the writer thread from emptying the ring
+    with r.lock:
+        r.record(frames.CANFrame(1, 1, bytes(8), 1 << 16))
+        for i in range(4): r.record(frames.CANFrame(1, 2, bytes(64), (1 << 16) + i))
+        r.record(frames.CANFrame(1, 3, bytes(64), 2 << 16))
+    assert r.dropped == 2
+    r.flush()
+    r.record(frames.CANFrame(1, 4, bytes(8), (2 << 16) + 5))
+    r.close()
+    assert [(p.id, p.ts) for p in logs.read_log(fname)] == [(1, 0), (2, 0), (2, 1), (2, 2), (4, (1 << 16) + 5)]
@@ -0,0 +1,50 @@
+import threading
+
+from mcan import frames, runtime
+
+
+class Inst:
+    def __init__(self):
+        self.packets = []
+        self.threads = set()
+
+    def onrecv(self, packet):
+        self.packets.append(packet)
+        self.threads.add(threading.current_thread())
+
+    def onrecv_batch(self, batch):
+        for packet in batch: self.onrecv(packet)
+
+
+class ThreadSource:
+    def __init__(self, inst, packets):
+        self.inst = inst
+        self.packets = packets
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=lambda: [self.inst.onrecv(p) for p in self.packets])
+        self.thread.start()
+
+    def stop(self):
+        self.thread.join()
+
+
+def test_thread_sources():
+    inst = Inst()
+    rt = runtime.SourceRuntime(inst)
+    rt.start()
+    packets = [frames.CANFrame(1, i, b"", i) for i in range(1000)]
+    sources = [ThreadSource(inst, packets[:500]), ThreadSource(inst, packets[500:])]
+    for s in sources: rt.add(s)
+    assert all(isinstance(s.inst, runtime.SyncAdapter) for s in sources)
+    for s in sources: s.stop()
+    rt.remove(sources[0])
+    assert sources[0].inst is inst
+    loop_thread = rt.thread
+    rt.stop()
+    # Frames reach the instance on the loop thread, each source in order
+    assert sorted(inst.packets, key=lambda p: p.ts) == packets
+    assert [p for p in inst.packets if p.ts < 500] == packets[:500]
+    assert inst.threads == {loop_thread}
+    assert sources[1].inst is inst and rt.adapted == []
@@ -0,0 +1,90 @@
+import random
+import struct
+
+from mcan import frames, telemetry
+
+
+def make_traffic(nframes, nids=30, seed=0):
+    """Counters and slowly changing signals, some ids with FD payloads"""
+    rng = random.Random(seed)
+    ids = [(rng.choice((1, 2, 3)), 0x100 + i, rng.choice((8, 8, 20))) for i in range(nids)]
+    packets = []
+    t = 0
+    while len(packets) < nframes:
+        for bus, id, length in ids:
+            value = (t*id) & 0xffff
+            data = (struct.pack("<BHHB", t & 0xff, value, value//2, 0x11) + bytes(length))[:length]
+            packets.append(frames.CANFrame(bus, id, data, t*1000, int(length > 8)))
+        t += 1
+    return packets[:nframes]
+
+
+def run_link(packets, zdict=b"", lost=()):
+    """Send packets through an encoder that can only send one packet per 20 frames, returns the decoder and what it decoded"""
+    encoder = telemetry.TelemetryEncoder(zdict)
+    decoder = telemetry.TelemetryDecoder(zdict)
+    sent = []
+    for i in range(0, len(packets), 20):
+        encoder.put_batch(packets[i:i+20])
+        sent.append(encoder.packet())
+    while encoder.backlog(): sent.append(encoder.packet())
+    decoded = []
+    for n, payload in enumerate(sent):
+        assert len(payload) <= telemetry.LORA_MAX_PAYLOAD
+        if n in lost: continue
+        decoded.extend(decoder.decode(payload))
+    return encoder, decoder, decoded
+
+
+def test_round_trip():
+    packets = make_traffic(3000)
+    encoder, decoder, decoded = run_link(packets)
+    assert len(decoded) == encoder.stats["sent"] > 0
+    originals = {(p.bus, p.id, p.ts): p for p in packets}
+    assert all(originals[(p.bus, p.id, p.ts)] == p for p in decoded)
+    assert decoder.lost == decoder.dropped == decoder.errors == 0
+
+
+def test_loss():
+    packets = make_traffic(3000)
+    # Packets 16 and 32 start a key epoch, the others carry only deltas
+    lost = {1, 16, 32, 40, 41, 90}
+    encoder, decoder, decoded = run_link(packets, lost=lost)
+    assert decoder.lost == len(lost)
+    # Deltas to a lost key frame are dropped, everything that is decoded is correct
+    assert decoder.dropped > 0
+    originals = {(p.bus, p.id, p.ts): p for p in packets}
+    assert all(originals[(p.bus, p.id, p.ts)] == p for p in decoded)
+
+
+def test_zdict():
+    packets = make_traffic(2000)
+    zdict = telemetry.build_zdict(make_traffic(500, seed=1))
+    encoder, decoder, decoded = run_link(packets, zdict)
+    originals = {(p.bus, p.id, p.ts): p for p in packets}
+    assert len(decoded) == encoder.stats["sent"]
+    assert all(originals[(p.bus, p.id, p.ts)] == p for p in decoded)
+    # A decoder with another dictionary rejects the packets
+    other = telemetry.TelemetryDecoder(b"x"*100)
+    encoder = telemetry.TelemetryEncoder(zdict)
+    encoder.put_batch(packets[:10])
+    assert other.decode(encoder.packet()) is None and other.errors == 1
+
+
+def test_at_parser():
+    payloads = [b"ab\ncd", b"\r\n+RCV=", bytes(range(256))[:200], b""]
+    stream = b"+OK\r\n" + b"".join(b"+RCV=6,%d," % len(p) + p + b",-40,10\r\n" for p in payloads) + b"+ERR=4\r\n"
+    expected = [("line", b"+OK")] + [("data", 6, p, [b"-40", b"10"]) for p in payloads] + [("line", b"+ERR=4")]
+    for size in (1, 2, 3, 7, 64, len(stream)):
+        parser = telemetry.ATParser()
+        events = []
+        for i in range(0, len(stream), size): events.extend(parser.feed(stream[i:i+size]))
+        assert events == expected
+
+
+def test_timestamp_offsets():
+    # Frames queued far apart end up in one packet
+    packets = [frames.CANFrame(1, 0x100 + i, bytes([i])*8, t) for i, t in enumerate((5, 100005, 250000, 3000000, 70000000))]
+    encoder, decoder, decoded = run_link(packets)
+    assert sorted(decoded, key=lambda p: p.ts) == packets
+    assert decoder.packets == 1